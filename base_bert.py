@@ -4,11 +4,23 @@ from config import BertConfig, PretrainedConfig
 from utils import *
 
 
+def pack_qkv_weights(state_dict, prefix=""):
+  """
+  Packs the separate query/key/value projections of older checkpoints (state_dict keys
+  "<prefix>...query.weight" etc.) into the fused "qkv" projection of BertSelfAttention, in place.
+  """
+  query_keys = [re.match(r"^((?:.*\.)?)query\.(weight|bias)$", k) for k in state_dict if k.startswith(prefix)]
+  for module_prefix, name in [m.groups() for m in query_keys if m is not None]:
+    state_dict[f"{module_prefix}qkv.{name}"] = torch.cat(
+      [state_dict.pop(f"{module_prefix}{proj}.{name}") for proj in ("query", "key", "value")], dim=0)
+
+
 class BertPreTrainedModel(nn.Module):
   config_class = BertConfig
   base_model_prefix = "bert"
   _keys_to_ignore_on_load_missing = [r"position_ids"]
   _keys_to_ignore_on_load_unexpected = None
+  _config_options = ()
 
   def __init__(self, config: PretrainedConfig, *inputs, **kwargs):
     super().__init__()
@@ -68,6 +80,10 @@ class BertPreTrainedModel(nn.Module):
     else:
       model_kwargs = kwargs
 
+    for key in cls._config_options:
+      if key in model_kwargs:
+        setattr(config, key, model_kwargs.pop(key))
+
     # Load model
     if pretrained_model_name_or_path is not None:
       pretrained_model_name_or_path = str(pretrained_model_name_or_path)
@@ -171,6 +187,9 @@ class BertPreTrainedModel(nn.Module):
     if metadata is not None:
       state_dict._metadata = metadata
 
+    # Older checkpoints (e.g. the huggingface ones) have separate query/key/value projections.
+    pack_qkv_weights(state_dict)
+
     your_bert_params = [f"bert.{x[0]}" for x in model.named_parameters()]
     for k in state_dict:
       if k not in your_bert_params and not k.startswith("cls."):
@@ -0,0 +1,335 @@
+'''
+CPU micro-benchmarks for the BERT implementation.
+
+Models are randomly initialized from the default BertConfig (bert-base sizes), so no pretrained
+weights are needed (batch_encode only loads the bert-base-uncased vocabulary). Run e.g.
+
+    python benchmark.py pair_forward --batch_sizes 8 16 32 64 128
+    python benchmark.py fused_qkv --seq_lens 32 128 512
+    python benchmark.py adamw
+    python benchmark.py adamw_state --steps 200
+    python benchmark.py batch_encode --num_examples 20000
+
+Benchmarks pick their own default batch sizes and sequence lengths when --batch_sizes or --seq_lens
+are not given.
+'''
+
+import argparse
+import io
+import multiprocessing
+import os
+import time
+
+import torch
+
+import torch.nn.functional as F
+
+from bert import BertLayer, BertModel
+from config import BertConfig
+
+
+def random_batch(batch_size, seq_len, vocab_size):
+    '''Random token ids and a right-padded attention mask; the first row always has the full length.'''
+    lengths = torch.randint(1, seq_len + 1, (batch_size,))
+    lengths[0] = seq_len
+    attention_mask = (torch.arange(seq_len)[None, :] < lengths[:, None]).long()
+    input_ids = torch.randint(1, vocab_size, (batch_size, seq_len)) * attention_mask
+    return input_ids, attention_mask
+
+
+def time_per_call(fn, repeats):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def saved_activation_mb(fn, parameters):
+    '''
+    Size of the tensors autograd saves for backward while running fn, `parameters` excluded (i.e. activation
+    memory). Tensors that torch.utils.checkpoint keeps for recomputing are not seen.
+    '''
+    saved = {}
+    parameter_storages = {p.untyped_storage().data_ptr() for p in parameters}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameter_storages:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(saved.values()) / 2 ** 20
+
+
+def bench_pair_forward(args):
+    '''Two separate BERT passes per sentence pair vs. one stacked pass (BertModel.forward_pair).'''
+    config = BertConfig()
+    model = BertModel(config).eval()
+    seq_len = (args.seq_lens or [64])[0]
+    with torch.no_grad():
+        for batch_size in args.batch_sizes or [8, 16, 32, 64, 128]:
+            input_ids_1, attention_mask_1 = random_batch(batch_size, seq_len, config.vocab_size)
+            input_ids_2, attention_mask_2 = random_batch(batch_size, seq_len, config.vocab_size)
+
+            two_pass = time_per_call(lambda: (model(input_ids_1, attention_mask_1)['pooler_output'],
+                                              model(input_ids_2, attention_mask_2)['pooler_output']), args.repeats)
+            shared = time_per_call(lambda: model.forward_pair(input_ids_1, attention_mask_1,
+                                                              input_ids_2, attention_mask_2), args.repeats)
+            print(f"batch size {batch_size} :: two-pass {batch_size / two_pass :.1f} pairs/s, "
+                  f"shared {batch_size / shared :.1f} pairs/s, speedup {two_pass / shared :.2f}x")
+
+
+def bench_fused_qkv(args):
+    '''Query/key/value projections of one BertLayer: three separate matmuls vs. the fused [hidden, 3 * hidden] one.'''
+    config = BertConfig()
+    layer = BertLayer(config).eval()
+    attention = layer.self_attention
+    heads, head_size = attention.num_attention_heads, attention.attention_head_size
+    # The separate projections are the row blocks of the fused weight.
+    weights = attention.qkv.weight.detach().chunk(3)
+    biases = attention.qkv.bias.detach().chunk(3)
+
+    def separate(x):
+        bs, seq_len = x.shape[:2]
+        return [F.linear(x, w, b).view(bs, seq_len, heads, head_size).transpose(1, 2) for w, b in zip(weights, biases)]
+
+    with torch.no_grad():
+        for batch_size in args.batch_sizes or [8]:
+            for seq_len in args.seq_lens or [32, 128, 512]:
+                x = torch.randn(batch_size, seq_len, config.hidden_size)
+                attention_mask = torch.zeros(batch_size, 1, 1, seq_len)
+                t_separate = time_per_call(lambda: separate(x), args.repeats)
+                t_fused = time_per_call(lambda: attention.transform(x), args.repeats)
+                t_layer = time_per_call(lambda: layer(x, attention_mask), args.repeats)
+                print(f"batch size {batch_size}, seq len {seq_len} :: separate qkv {1000 * t_separate :.2f} ms, "
+                      f"fused qkv {1000 * t_fused :.2f} ms, speedup {t_separate / t_fused :.2f}x, "
+                      f"whole layer {1000 * t_layer :.2f} ms")
+
+
+def bench_unpadded(args):
+    '''BertModel forward on right-padded batches with random lengths: padded vs. unpadded execution.'''
+    config = BertConfig()
+    padded = BertModel(config).eval()
+    config = BertConfig()
+    config.unpadded = True
+    unpadded = BertModel(config).eval()
+    unpadded.load_state_dict(padded.state_dict())
+    with torch.no_grad():
+        for batch_size in args.batch_sizes or [32]:
+            for seq_len in args.seq_lens or [64, 128]:
+                input_ids, attention_mask = random_batch(batch_size, seq_len, config.vocab_size)
+                t_padded = time_per_call(lambda: padded(input_ids, attention_mask), args.repeats)
+                t_unpadded = time_per_call(lambda: unpadded(input_ids, attention_mask), args.repeats)
+                print(f"batch size {batch_size}, seq len {seq_len}, padding {1 - attention_mask.float().mean() :.2f} :: "
+                      f"padded {1000 * t_padded :.1f} ms, unpadded {1000 * t_unpadded :.1f} ms, "
+                      f"speedup {t_padded / t_unpadded :.2f}x")
+
+
+def bench_precision(args):
+    '''One training step (forward, loss, backward, AdamW step) of BERT plus a linear head in fp32, bf16 and fp16 autocast.'''
+    from optimizer import AdamW
+    config = BertConfig()
+    model = BertModel(config).train()
+    head = torch.nn.Linear(config.hidden_size, 5)
+    optimizer = AdamW(list(model.parameters()) + list(head.parameters()), lr=1e-5)
+    for batch_size in args.batch_sizes or [16]:
+        for seq_len in args.seq_lens or [128]:
+            input_ids, attention_mask = random_batch(batch_size, seq_len, config.vocab_size)
+            labels = torch.randint(0, 5, (batch_size,))
+            results = {}
+            for precision, dtype in (('fp32', None), ('bf16', torch.bfloat16), ('fp16', torch.float16)):
+                def step():
+                    optimizer.zero_grad()
+                    with torch.autocast('cpu', dtype=dtype, enabled=dtype is not None):
+                        logits = head(model(input_ids, attention_mask)['pooler_output'])
+                        loss = torch.nn.functional.cross_entropy(logits, labels)
+                    loss.backward()
+                    optimizer.step()
+                    return loss
+
+                activations = saved_activation_mb(step, optimizer.param_groups[0]['params'])
+                results[precision] = (time_per_call(step, args.repeats), activations)
+            for precision, (seconds, activations) in results.items():
+                print(f"batch size {batch_size}, seq len {seq_len}, {precision} :: step {1000 * seconds :.0f} ms "
+                      f"({results['fp32'][0] / seconds :.2f}x), saved activations {activations :.0f} MB "
+                      f"({activations / results['fp32'][1] :.2f}x)")
+
+
+def bench_checkpointing(args):
+    '''Training step (forward + backward) of BERT with activation checkpointing of none, every 4th, 2nd and every layer.'''
+    for batch_size in args.batch_sizes or [8]:
+        for seq_len in args.seq_lens or [128]:
+            config = BertConfig()
+            input_ids, attention_mask = random_batch(batch_size, seq_len, config.vocab_size)
+            results = {}
+            for checkpoint_every in (0, 4, 2, 1):
+                config = BertConfig()
+                config.checkpoint_every = checkpoint_every
+                model = BertModel(config).train()
+
+                def step():
+                    model.zero_grad()
+                    loss = model(input_ids, attention_mask)['pooler_output'].sum()
+                    loss.backward()
+
+                activations = saved_activation_mb(lambda: model(input_ids, attention_mask), model.parameters())
+                results[checkpoint_every] = (time_per_call(step, args.repeats), activations)
+            for checkpoint_every, (seconds, activations) in results.items():
+                print(f"batch size {batch_size}, seq len {seq_len}, checkpoint every {checkpoint_every} :: "
+                      f"step {1000 * seconds :.0f} ms ({seconds / results[0][0] :.2f}x), "
+                      f"saved activations {activations :.0f} MB ({activations / results[0][1] :.2f}x)")
+
+
+def bench_adamw(args):
+    '''
+    AdamW on all BERT parameters with random gradients: step time and time to serialize the optimizer state dict
+    of the per-parameter loop, the foreach update and the flattened buffers.
+    '''
+    from optimizer import AdamW
+    model = BertModel(BertConfig())
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+    results = {}
+    for name, options in (('loop', {}), ('foreach', {'foreach': True}), ('flat', {'flatten': True})):
+        optimizer = AdamW(model.parameters(), lr=1e-5, weight_decay=0.01, **options)
+        step = time_per_call(optimizer.step, args.repeats)
+        save = time_per_call(lambda: torch.save(optimizer.state_dict(), io.BytesIO()), args.repeats)
+        results[name] = (step, save)
+        del optimizer
+    for name, (step, save) in results.items():
+        print(f"{sum(p.numel() for p in model.parameters()) / 1e6 :.1f}M parameters, {name} :: "
+              f"step {1000 * step :.0f} ms ({results['loop'][0] / step :.2f}x), "
+              f"state dict save {1000 * save :.0f} ms ({results['loop'][1] / save :.2f}x)")
+
+
+def rss_mb():
+    '''Resident set size of this process (Linux).'''
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def train_with_state_dtype(state_dtype, args, results):
+    '''
+    Fine-tunes BERT plus a linear head with AdamW(state_dtype=...) on a synthetic sentence classification task
+    (do most tokens come from the lower half of the vocabulary?) and puts the losses and RSS into `results`.
+    '''
+    from optimizer import AdamW
+    torch.manual_seed(11711)
+    config = BertConfig()
+    model = BertModel(config).train()
+    head = torch.nn.Linear(config.hidden_size, 2)
+    batch_size, seq_len = (args.batch_sizes or [16])[0], (args.seq_lens or [32])[0]
+
+    def loss_fn():
+        input_ids, attention_mask = random_batch(batch_size, seq_len, config.vocab_size)
+        labels = ((input_ids < config.vocab_size // 2) & attention_mask.bool()).sum(dim=1) * 2 > attention_mask.sum(dim=1)
+        logits = head(model(input_ids, attention_mask)['pooler_output'])
+        return F.cross_entropy(logits, labels.long())
+
+    # Gradients are allocated before the first measurement, so the difference is the optimizer state.
+    loss_fn().backward()
+    rss_before = rss_mb()
+    optimizer = AdamW(list(model.parameters()) + list(head.parameters()), lr=args.lr, weight_decay=0.01,
+                      state_dtype=state_dtype)
+    losses = []
+    for _ in range(args.steps):
+        optimizer.zero_grad()
+        loss = loss_fn()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    state_mb = sum(value.nbytes for state in optimizer.state.values() for key, value in state.items()
+                   if torch.is_tensor(value)) / 2 ** 20
+    results.put((state_dtype, losses, rss_before, rss_mb(), state_mb))
+
+
+def bench_adamw_state(args):
+    '''
+    Convergence and memory of AdamW with float32, bfloat16 and blockwise 8-bit moments. Each run is a fresh
+    process, so its RSS is not affected by the others.
+    '''
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    runs = {}
+    for state_dtype in ('float32', 'bfloat16', 'int8'):
+        process = context.Process(target=train_with_state_dtype, args=(state_dtype, args, results))
+        process.start()
+        state_dtype, *run = results.get()
+        process.join()
+        runs[state_dtype] = run
+    reference = runs['float32'][0]
+    window = max(1, args.steps // 10)
+    for state_dtype, (losses, rss_before, rss_after, state_mb) in runs.items():
+        deviation = sum(abs(a - b) for a, b in zip(losses, reference)) / len(losses)
+        print(f"{state_dtype} moments :: loss first {sum(losses[:window]) / window :.4f}, "
+              f"last {sum(losses[-window:]) / window :.4f} (mean |loss - float32 loss| {deviation :.4f}), "
+              f"optimizer state {state_mb :.0f} MB, RSS {rss_before :.0f} -> {rss_after :.0f} MB "
+              f"(+{rss_after - rss_before :.0f} MB)")
+
+
+def bench_batch_encode(args):
+    '''
+    BertTokenizer.batch_encode_plus of sentence pairs made of random vocabulary words, in one process and with
+    num_proc = 2 .. --num_proc forked processes. Every run must give the same ids as the serial one.
+    '''
+    from tokenizer import BertTokenizer
+    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+    words = [w for w in tokenizer.vocab if w.isalpha()]
+    generator = torch.Generator().manual_seed(11711)
+    seq_len = (args.seq_lens or [12])[0]
+
+    def sentence():
+        indices = torch.randint(len(words), (int(torch.randint(1, 2 * seq_len, (1,), generator=generator)),),
+                                generator=generator)
+        return ' '.join(words[i] for i in indices.tolist()).capitalize() + '.'
+
+    pairs = [(sentence(), sentence()) for _ in range(args.num_examples)]
+    reference = None
+    for num_proc in range(1, args.num_proc + 1):
+        start = time.perf_counter()
+        input_ids = tokenizer.batch_encode_plus(pairs, truncation=True, num_proc=num_proc)['input_ids']
+        seconds = time.perf_counter() - start
+        reference = reference or (input_ids, seconds)
+        assert input_ids == reference[0], f"num_proc={num_proc} changed the encoding"
+        print(f"{len(pairs)} pairs, num_proc {num_proc} :: {seconds :.2f} s, {len(pairs) / seconds :.0f} pairs/s "
+              f"({reference[1] / seconds :.2f}x)")
+
+
+BENCHMARKS = {
+    'pair_forward': bench_pair_forward,
+    'fused_qkv': bench_fused_qkv,
+    'unpadded': bench_unpadded,
+    'precision': bench_precision,
+    'checkpointing': bench_checkpointing,
+    'adamw': bench_adamw,
+    'adamw_state': bench_adamw_state,
+    'batch_encode': bench_batch_encode,
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", type=str, choices=tuple(BENCHMARKS.keys()))
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=None)
+    parser.add_argument("--seq_lens", type=int, nargs='+', default=None)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--steps", type=int, default=200, help='adamw_state: number of training steps')
+    parser.add_argument("--lr", type=float, default=1e-5, help='adamw_state: learning rate')
+    parser.add_argument("--num_examples", type=int, default=20000, help='batch_encode: number of sentence pairs')
+    parser.add_argument("--num_proc", type=int, default=os.cpu_count(),
+                        help='batch_encode: largest number of tokenizer processes')
+    parser.add_argument("--num_threads", type=int, default=None)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(11711)
+    BENCHMARKS[args.benchmark](args)
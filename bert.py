@@ -1,9 +1,30 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from base_bert import BertPreTrainedModel
+from base_bert import BertPreTrainedModel, pack_qkv_weights
 from utils import *
 import math
+from torch.utils.checkpoint import checkpoint
+
+
+ATTENTION_BACKENDS = ('reference', 'sdpa')
+
+
+def get_extended_attention_mask(attention_mask, dtype):
+  """
+  Additive attention mask in `dtype`: 0 for tokens that can be attended to, a large negative number otherwise.
+  [bs, seq_len] masks become [bs, 1, 1, seq_len]; block-diagonal [bs, seq_len, seq_len] masks of packed rows
+  become [bs, 1, seq_len, seq_len].
+  The large negative number is -10000, clamped to what `dtype` can represent. It is deliberately not
+  finfo(dtype).min: scores plus that overflow to -inf, and fully masked rows (padding of packed rows)
+  would then turn into NaN.
+  """
+  if attention_mask.dim() == 3:
+    extended_attention_mask = attention_mask[:, None, :, :]
+  else:
+    extended_attention_mask = attention_mask[:, None, None, :]
+  extended_attention_mask = extended_attention_mask.to(dtype=dtype)
+  return (1.0 - extended_attention_mask) * max(-10000.0, torch.finfo(dtype).min)
 
 
 class BertSelfAttention(nn.Module):
@@ -14,25 +35,40 @@ class BertSelfAttention(nn.Module):
     self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
     self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-    # Initialize the linear transformation layers for key, value, query.
-    self.query = nn.Linear(config.hidden_size, self.all_head_size)
-    self.key = nn.Linear(config.hidden_size, self.all_head_size)
-    self.value = nn.Linear(config.hidden_size, self.all_head_size)
+    # Initialize the linear transformation layer for query, key and value, fused into one
+    # [hidden_size, 3 * all_head_size] projection (rows of the weight: query, then key, then value).
+    self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
     # This dropout is applied to normalized attention scores following the original
     # implementation of transformer. Although it is a bit unusual, we empirically
     # observe that it yields better performance.
     self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
-
-  def transform(self, x, linear_layer):
-    # The corresponding linear_layer of k, v, q are used to project the hidden_state (x).
-    bs, seq_len = x.shape[:2]
-    proj = linear_layer(x)
-    # Next, we need to produce multiple heads for the proj. This is done by spliting the
+    # 'reference' is self.attention below; 'sdpa' dispatches to torch's scaled_dot_product_attention,
+    # which picks a flash/memory-efficient kernel where available and the math kernel otherwise.
+    self.attention_backend = getattr(config, 'attention_backend', 'reference')
+    if self.attention_backend not in ATTENTION_BACKENDS:
+      raise ValueError(f"Unknown attention backend {self.attention_backend!r}, expected one of {ATTENTION_BACKENDS}")
+
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    # Checkpoints saved before the fused projection have separate query/key/value layers.
+    pack_qkv_weights(state_dict, prefix)
+    super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+  def transform(self, x, unpadded=None):
+    # The fused linear layer projects the hidden_state (x) to query, key and value at once.
+    proj = self.qkv(x)
+    if unpadded is not None:
+      # x holds the real tokens only ([total_tokens, hidden_size]); scatter them back to the padded
+      # layout for the attention itself.
+      indices, bs, seq_len = unpadded
+      proj = proj.new_zeros(bs * seq_len, proj.size(-1)).index_copy(0, indices, proj)
+    else:
+      bs, seq_len = x.shape[:2]
+    # Next, we need to produce multiple heads for each projection. This is done by spliting the
     # hidden state to self.num_attention_heads, each of size self.attention_head_size.
-    proj = proj.view(bs, seq_len, self.num_attention_heads, self.attention_head_size)
-    # By proper transpose, we have proj of size [bs, num_attention_heads, seq_len, attention_head_size].
-    proj = proj.transpose(1, 2)
-    return proj
+    proj = proj.view(bs, seq_len, 3, self.num_attention_heads, self.attention_head_size)
+    # By proper permute, we have proj of size [3, bs, num_attention_heads, seq_len, attention_head_size].
+    proj = proj.permute(2, 0, 3, 1, 4)
+    return proj.unbind(0)
 
   def attention(self, key, query, value, attention_mask):
     # Each attention is calculated following eq. (1) of https://arxiv.org/pdf/1706.03762.pdf.
@@ -67,23 +103,32 @@ class BertSelfAttention(nn.Module):
 
     return concatentation
 
+  def sdpa_attention(self, key, query, value, attention_mask):
+    # Same computation as self.attention in a single fused op; the [bs, num_attention_heads, seq_len, seq_len]
+    # score matrix is never materialized by the flash/memory-efficient kernels.
+    dropout_p = self.dropout.p if self.training else 0.0
+    attn = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask.to(query.dtype), dropout_p=dropout_p)
+    bs, _, seq_len, _ = attn.shape
+    return attn.transpose(1, 2).reshape(bs, seq_len, self.all_head_size)
 
-
-
-  def forward(self, hidden_states, attention_mask):
+  def forward(self, hidden_states, attention_mask, unpadded=None):
     """
     hidden_states: [bs, seq_len, hidden_state]
     attention_mask: [bs, 1, 1, seq_len]
-    output: [bs, seq_len, hidden_state]
+    unpadded: optional (indices, bs, seq_len) when hidden_states only holds the real tokens, see BertModel.encode
+    output: [bs, seq_len, hidden_state], or [total_tokens, hidden_state] if unpadded
     """
     # First, we have to generate the key, value, query for each token for multi-head attention
     # using self.transform (more details inside the function).
     # Size of *_layer is [bs, num_attention_heads, seq_len, attention_head_size].
-    key_layer = self.transform(hidden_states, self.key)
-    value_layer = self.transform(hidden_states, self.value)
-    query_layer = self.transform(hidden_states, self.query)
+    query_layer, key_layer, value_layer = self.transform(hidden_states, unpadded)
     # Calculate the multi-head attention.
-    attn_value = self.attention(key_layer, query_layer, value_layer, attention_mask)
+    if self.attention_backend == 'sdpa':
+      attn_value = self.sdpa_attention(key_layer, query_layer, value_layer, attention_mask)
+    else:
+      attn_value = self.attention(key_layer, query_layer, value_layer, attention_mask)
+    if unpadded is not None:
+      attn_value = attn_value.reshape(-1, self.all_head_size).index_select(0, unpadded[0])
     return attn_value
 
 
@@ -126,10 +171,11 @@ class BertLayer(nn.Module):
 
 
 
-  def forward(self, hidden_states, attention_mask):
+  def forward(self, hidden_states, attention_mask, unpadded=None):
     """
     hidden_states: either from the embedding layer (first BERT layer) or from the previous BERT layer
     as shown in the left of Figure 1 of https://arxiv.org/pdf/1706.03762.pdf.
+    unpadded: optional (indices, bs, seq_len) when hidden_states only holds the real tokens, see BertModel.encode
     Each block consists of:
     1. A multi-head attention layer (BertSelfAttention).
     2. An add-norm operation that takes the input and output of the multi-head attention layer.
@@ -137,7 +183,7 @@ class BertLayer(nn.Module):
     4. An add-norm operation that takes the input and output of the feed forward layer.
     """
     ### TODO
-    step_1 = self.self_attention(hidden_states, attention_mask)
+    step_1 = self.self_attention(hidden_states, attention_mask, unpadded)
     step_2 = self.add_norm(hidden_states, step_1, self.attention_dense, self.attention_dropout, self.attention_layer_norm)
     #Review this step
     step_3 = self.interm_af(self.interm_dense(step_2))
@@ -154,6 +200,10 @@ class BertModel(BertPreTrainedModel):
   2. A stack of n BERT layers (used in self.encode).
   3. A linear transformation layer for the [CLS] token (used in self.forward, as given).
   """
+  # Options of this implementation that are not part of the pretrained configs; they can be passed
+  # to from_pretrained, e.g. BertModel.from_pretrained('bert-base-uncased', attention_backend='sdpa').
+  _config_options = ('attention_backend', 'unpadded', 'checkpoint_every')
+
   def __init__(self, config):
     super().__init__(config)
     self.config = config
@@ -170,6 +220,11 @@ class BertModel(BertPreTrainedModel):
 
     # BERT encoder.
     self.bert_layers = nn.ModuleList([BertLayer(config) for _ in range(config.num_hidden_layers)])
+    # Run the dense/LayerNorm/feed forward parts of the layers on the real (non-padding) tokens only.
+    self.unpadded = getattr(config, 'unpadded', False)
+    # Activation (gradient) checkpointing while training: 0 keeps all activations, k > 0 checkpoints every
+    # k-th layer (1 = every layer), whose activations are then recomputed during backward.
+    self.checkpoint_every = getattr(config, 'checkpoint_every', 0)
 
     # [CLS] token transformations.
     self.pooler_dense = nn.Linear(config.hidden_size, config.hidden_size)
@@ -177,7 +232,7 @@ class BertModel(BertPreTrainedModel):
 
     self.init_weights()
 
-  def embed(self, input_ids):
+  def embed(self, input_ids, token_type_ids=None, position_ids=None):
     input_shape = input_ids.size()
     seq_length = input_shape[1]
 
@@ -187,16 +242,18 @@ class BertModel(BertPreTrainedModel):
     input_embeds = self.word_embedding(input_ids)
 
     # Use pos_ids to get position embedding from self.pos_embedding into pos_embeds.
-    pos_ids = self.position_ids[:, :seq_length]
+    # Packed rows (see datasets.pack_sentences) pass their own position ids, restarting at every sentence.
+    pos_ids = self.position_ids[:, :seq_length] if position_ids is None else position_ids
     pos_embeds = None
     ### TODO
     pos_embeds = self.pos_embedding(pos_ids)
 
 
-    # Get token type ids. Since we are not considering token type, this embedding is
-    # just a placeholder.
-    tk_type_ids = torch.zeros(input_shape, dtype=torch.long, device=input_ids.device)
-    tk_type_embeds = self.tk_type_embedding(tk_type_ids)
+    # Get token type ids. Single sentences (and each side of a separately encoded pair) are all
+    # segment 0; cross-encoded pairs pass 0 for "[CLS] a [SEP]" and 1 for "b [SEP]".
+    if token_type_ids is None:
+      token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=input_ids.device)
+    tk_type_embeds = self.tk_type_embedding(token_type_ids)
 
     # Add three embeddings together; then apply embed_layer_norm and dropout and return.
     ### TODO
@@ -210,35 +267,119 @@ class BertModel(BertPreTrainedModel):
   def encode(self, hidden_states, attention_mask):
     """
     hidden_states: the output from the embedding layer [batch_size, seq_len, hidden_size]
-    attention_mask: [batch_size, seq_len]
+    attention_mask: [batch_size, seq_len], or [batch_size, seq_len, seq_len] for packed rows
     """
     # Get the extended attention mask for self-attention.
-    # Returns extended_attention_mask of size [batch_size, 1, 1, seq_len].
+    # Returns extended_attention_mask of size [batch_size, 1, 1, seq_len] ([batch_size, 1, seq_len, seq_len] for packed rows).
     # Distinguishes between non-padding tokens (with a value of 0) and padding tokens
     # (with a value of a large negative number).
-    extended_attention_mask: torch.Tensor = get_extended_attention_mask(attention_mask, self.dtype)
+    # Under autocast the scores are computed in the autocast dtype rather than the parameter dtype.
+    device_type = hidden_states.device.type
+    dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else self.dtype
+    extended_attention_mask: torch.Tensor = get_extended_attention_mask(attention_mask, dtype)
+    if attention_mask.dim() == 3:
+      # Block-diagonal mask of packed rows: a token is real iff it attends to itself.
+      attention_mask = attention_mask.diagonal(dim1=1, dim2=2)
+
+    # In unpadded mode the real tokens of the batch are gathered into a [total_tokens, hidden_size] tensor;
+    # only the attention scatters them back to [batch_size, seq_len].
+    unpadded = None
+    if self.unpadded:
+      batch_size, seq_len, hidden_size = hidden_states.shape
+      indices = attention_mask.flatten().nonzero(as_tuple=True)[0]
+      hidden_states = hidden_states.reshape(-1, hidden_size).index_select(0, indices)
+      unpadded = (indices, batch_size, seq_len)
 
     # Pass the hidden states through the encoder layers.
     for i, layer_module in enumerate(self.bert_layers):
       # Feed the encoding from the last bert_layer to the next.
-      hidden_states = layer_module(hidden_states, extended_attention_mask)
+      if self.checkpoint_every and i % self.checkpoint_every == 0 and self.training and torch.is_grad_enabled():
+        # The RNG state is restored for the recompute, so dropout masks match the forward pass.
+        hidden_states = checkpoint(layer_module, hidden_states, extended_attention_mask, unpadded,
+                                   use_reentrant=False, preserve_rng_state=True)
+      else:
+        hidden_states = layer_module(hidden_states, extended_attention_mask, unpadded)
+
+    if unpadded is not None:
+      # Padding positions of the output are zero.
+      hidden_states = hidden_states.new_zeros(batch_size * seq_len, hidden_size).index_copy(0, indices, hidden_states)
+      hidden_states = hidden_states.view(batch_size, seq_len, hidden_size)
 
     return hidden_states
 
-  def forward(self, input_ids, attention_mask):
+  def forward(self, input_ids, attention_mask, token_type_ids=None, position_ids=None, cls_positions=None):
     """
     input_ids: [batch_size, seq_len], seq_len is the max length of the batch
     attention_mask: same size as input_ids, 1 represents non-padding tokens, 0 represents padding tokens
+    token_type_ids: optional, same size as input_ids, segment (0 or 1) of each token; all 0 if not given
+
+    Packed rows of several sentences (see datasets.pack_sentences) pass a block-diagonal
+    [batch_size, seq_len, seq_len] attention_mask, position_ids restarting at every sentence and the flat
+    cls_positions of the sentences; pooler_output then has one row per packed sentence.
     """
     # Get the embedding for each input token.
-    embedding_output = self.embed(input_ids=input_ids)
+    embedding_output = self.embed(input_ids=input_ids, token_type_ids=token_type_ids, position_ids=position_ids)
 
     # Feed to a transformer (a stack of BertLayers).
     sequence_output = self.encode(embedding_output, attention_mask=attention_mask)
 
     # Get cls token hidden state.
-    first_tk = sequence_output[:, 0]
+    if cls_positions is not None:
+      first_tk = sequence_output.reshape(-1, sequence_output.size(-1)).index_select(0, cls_positions)
+    else:
+      first_tk = sequence_output[:, 0]
     first_tk = self.pooler_dense(first_tk)
     first_tk = self.pooler_af(first_tk)
 
     return {'last_hidden_state': sequence_output, 'pooler_output': first_tk}
+
+  def forward_pair(self, input_ids_1, attention_mask_1, input_ids_2, attention_mask_2):
+    """
+    Encodes both sentences of a batch of pairs in a single pass: the two sides are right-padded to a common
+    length and stacked into one [2 * batch_size, seq_len] batch.
+    Returns the pooled [CLS] outputs of the first and of the second sentences.
+    """
+    batch_size = input_ids_1.size(0)
+    seq_len = max(input_ids_1.size(1), input_ids_2.size(1))
+    input_ids = torch.cat([
+      F.pad(input_ids_1, (0, seq_len - input_ids_1.size(1)), value=self.config.pad_token_id),
+      F.pad(input_ids_2, (0, seq_len - input_ids_2.size(1)), value=self.config.pad_token_id),
+    ])
+    attention_mask = torch.cat([
+      F.pad(attention_mask_1, (0, seq_len - attention_mask_1.size(1))),
+      F.pad(attention_mask_2, (0, seq_len - attention_mask_2.size(1))),
+    ])
+    pooled = self.forward(input_ids, attention_mask)['pooler_output']
+    return pooled[:batch_size], pooled[batch_size:]
+
+  def cross_encode_pair(self, input_ids_1, attention_mask_1, input_ids_2, attention_mask_2):
+    """
+    Builds the cross-encoded "[CLS] a [SEP] b [SEP]" batch from two separately tokenized sides (each
+    "[CLS] x [SEP]", right-padded), i.e. the layout of BertTokenizer.build_inputs_with_special_tokens.
+    Returns input_ids, token_type_ids and attention_mask. Pairs longer than max_position_embeddings are cut
+    like tokenizer(a, b, truncation=True) cuts them (see datasets.longest_first_lengths).
+    """
+    len_1 = attention_mask_1.sum(dim=1, keepdim=True)
+    len_2 = attention_mask_2.sum(dim=1, keepdim=True)
+    # Tokens of a and b kept under 'longest_first' truncation to max_position_embeddings in total.
+    budget = self.config.max_position_embeddings - 3
+    kept_1 = torch.minimum(len_1 - 2, torch.clamp(budget - (len_2 - 2), min=(budget + 1) // 2))
+    kept_2 = torch.minimum(len_2 - 2, budget - kept_1)
+    # Position of the first [SEP] and length of the whole pair.
+    sep_1 = kept_1 + 1
+    total_len = kept_1 + kept_2 + 3
+    seq_len = int(total_len.max())
+
+    positions = torch.arange(seq_len, device=input_ids_1.device).unsqueeze(0)
+    first = positions < sep_1
+    second = (positions > sep_1) & (positions < total_len - 1)
+    sep = (positions == sep_1) | (positions == total_len - 1)
+    ids_1 = input_ids_1.gather(1, positions.clamp(max=input_ids_1.size(1) - 1).expand(len(first), -1))
+    ids_2 = input_ids_2.gather(1, (positions - sep_1).clamp(0, input_ids_2.size(1) - 1))
+    sep_ids = input_ids_1.gather(1, len_1 - 1).expand(-1, seq_len)
+
+    input_ids = torch.full_like(ids_1, self.config.pad_token_id)
+    input_ids = torch.where(first, ids_1, torch.where(second, ids_2, torch.where(sep, sep_ids, input_ids)))
+    token_type_ids = ((positions > sep_1) & (positions < total_len)).long()
+    attention_mask = (positions < total_len).long()
+    return input_ids, token_type_ids, attention_mask
@@ -4,12 +4,15 @@ import csv
 
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader
 from sklearn.metrics import f1_score, accuracy_score
 
-from tokenizer import BertTokenizer
 from bert import BertModel
+from embedding_cache import EmbeddingCache
+from datasets import TokenizedDataset, build_train_dataloader, dataloader_options, load_tokenizer, PaddingEfficiency
 from optimizer import AdamW
+from quantize import is_quantized, load_model
+from train_utils import autocast_context, training_arguments_parser, training_options
 from tqdm import tqdm
 
 
@@ -37,7 +40,10 @@ class BertSentimentClassifier(torch.nn.Module):
     def __init__(self, config):
         super(BertSentimentClassifier, self).__init__()
         self.num_labels = config.num_labels
-        self.bert = BertModel.from_pretrained('bert-base-uncased')
+        self.bert = BertModel.from_pretrained('bert-base-uncased',
+                                              attention_backend=getattr(config, 'attention_backend', 'reference'),
+                                              unpadded=getattr(config, 'unpadded', False),
+                                              checkpoint_every=getattr(config, 'checkpoint_every', 0))
 
         # Pretrain mode does not require updating BERT paramters.
         for param in self.bert.parameters():
@@ -46,6 +52,14 @@ class BertSentimentClassifier(torch.nn.Module):
             elif config.option == 'finetune':
                 param.requires_grad = True
 
+        # With frozen BERT parameters the encoder outputs can be computed once and served from disk.
+        self.embedding_cache = None
+        if getattr(config, 'embedding_cache_dir', None) is not None:
+            if config.option != 'pretrain':
+                raise ValueError("The embedding cache requires frozen BERT parameters (option 'pretrain')")
+            self.embedding_cache = EmbeddingCache(config.embedding_cache_dir, self.bert,
+                                                  dtype=getattr(config, 'embedding_cache_dtype', 'float16'))
+
         # Create any instance variables you need to classify the sentiment of BERT embeddings.
         ### TODO
         self.Linear = torch.nn.Linear(config.hidden_size, config.num_labels)
@@ -60,9 +74,11 @@ class BertSentimentClassifier(torch.nn.Module):
         ### TODO
 
         #Review this
-        pooled_rep = self.bert.forward(input_ids, attention_mask)
-
-        logits = pooled_rep['pooler_output']
+        if self.embedding_cache is not None:
+            logits = self.embedding_cache.pooler_output(self.bert, input_ids, attention_mask)
+        else:
+            pooled_rep = self.bert.forward(input_ids, attention_mask)
+            logits = pooled_rep['pooler_output']
         logits = self.dropout(logits)
         logits = self.Linear(logits)
 
@@ -71,11 +87,11 @@ class BertSentimentClassifier(torch.nn.Module):
 
 
 
-class SentimentDataset(Dataset):
+class SentimentDataset(TokenizedDataset):
     def __init__(self, dataset, args):
         self.dataset = dataset
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = load_tokenizer(fast=getattr(args, 'fast_tokenizer', False))
 
     def __len__(self):
         return len(self.dataset)
@@ -83,14 +99,18 @@ class SentimentDataset(Dataset):
     def __getitem__(self, idx):
         return self.dataset[idx]
 
+    def example_lengths(self):
+        '''Token length of every example (special tokens included), e.g. for LengthBucketBatchSampler.'''
+        return [len(ids) for ids in self.tokenizer([x[0] for x in self.dataset], truncation=True)['input_ids']]
+
     def pad_data(self, data):
         sents = [x[0] for x in data]
         labels = [x[1] for x in data]
         sent_ids = [x[2] for x in data]
 
         encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
+        token_ids = encoding['input_ids']
+        attention_mask = encoding['attention_mask']
         labels = torch.LongTensor(labels)
 
         return token_ids, attention_mask, labels, sents, sent_ids
@@ -109,11 +129,11 @@ class SentimentDataset(Dataset):
         return batched_data
 
 
-class SentimentTestDataset(Dataset):
+class SentimentTestDataset(TokenizedDataset):
     def __init__(self, dataset, args):
         self.dataset = dataset
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = load_tokenizer(fast=getattr(args, 'fast_tokenizer', False))
 
     def __len__(self):
         return len(self.dataset)
@@ -126,8 +146,8 @@ class SentimentTestDataset(Dataset):
         sent_ids = [x[1] for x in data]
 
         encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
+        token_ids = encoding['input_ids']
+        attention_mask = encoding['attention_mask']
 
         return token_ids, attention_mask, sents, sent_ids
 
@@ -186,7 +206,7 @@ def model_eval(dataloader, model, device):
         b_mask = b_mask.to(device)
 
         logits = model(b_ids, b_mask)
-        logits = logits.detach().cpu().numpy()
+        logits = logits.detach().float().cpu().numpy()
         preds = np.argmax(logits, axis=1).flatten()
 
         b_labels = b_labels.flatten()
@@ -215,7 +235,7 @@ def model_test_eval(dataloader, model, device):
         b_mask = b_mask.to(device)
 
         logits = model(b_ids, b_mask)
-        logits = logits.detach().cpu().numpy()
+        logits = logits.detach().float().cpu().numpy()
         preds = np.argmax(logits, axis=1).flatten()
 
         y_pred.extend(preds)
@@ -249,17 +269,23 @@ def train(args):
     train_dataset = SentimentDataset(train_data, args)
     dev_dataset = SentimentDataset(dev_data, args)
 
-    train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=args.batch_size,
-                                  collate_fn=train_dataset.collate_fn)
+    loader_options = dataloader_options(args)
+    train_dataloader = build_train_dataloader(train_dataset, args.batch_size, args.bucket_boundaries, args.max_tokens,
+                                              **loader_options)
     dev_dataloader = DataLoader(dev_dataset, shuffle=False, batch_size=args.batch_size,
-                                collate_fn=dev_dataset.collate_fn)
+                                collate_fn=dev_dataset.collate_fn, **loader_options)
 
     # Init model.
     config = {'hidden_dropout_prob': args.hidden_dropout_prob,
               'num_labels': num_labels,
               'hidden_size': 768,
               'data_dir': '.',
-              'option': args.option}
+              'option': args.option,
+              'attention_backend': args.attention_backend,
+              'unpadded': args.unpadded,
+              'checkpoint_every': args.checkpoint_every,
+              'embedding_cache_dir': args.embedding_cache_dir,
+              'embedding_cache_dtype': args.embedding_cache_dtype}
 
     config = SimpleNamespace(**config)
 
@@ -267,7 +293,10 @@ def train(args):
     model = model.to(device)
 
     lr = args.lr
-    optimizer = AdamW(model.parameters(), lr=lr)
+    optimizer = AdamW(model.parameters(), lr=lr, foreach=args.adamw_impl == 'foreach',
+                      flatten=args.adamw_impl == 'flat', state_dtype=args.adamw_state_dtype)
+    # Loss scaling keeps small fp16 gradients from flushing to zero; a no-op for fp32 and bf16.
+    scaler = torch.amp.GradScaler(device.type, enabled=args.precision == 'fp16')
     best_dev_acc = 0
 
     # Run for the specified number of epochs.
@@ -275,58 +304,72 @@ def train(args):
         model.train()
         train_loss = 0
         num_batches = 0
+        padding = PaddingEfficiency()
         for batch in tqdm(train_dataloader, desc=f'train-{epoch}', disable=TQDM_DISABLE):
             b_ids, b_mask, b_labels = (batch['token_ids'],
                                        batch['attention_mask'], batch['labels'])
+            padding.update(b_mask)
 
-            b_ids = b_ids.to(device)
-            b_mask = b_mask.to(device)
-            b_labels = b_labels.to(device)
+            b_ids = b_ids.to(device, non_blocking=args.pin_memory)
+            b_mask = b_mask.to(device, non_blocking=args.pin_memory)
+            b_labels = b_labels.to(device, non_blocking=args.pin_memory)
 
             optimizer.zero_grad()
-            logits = model(b_ids, b_mask)
-            loss = F.cross_entropy(logits, b_labels.view(-1), reduction='sum') / args.batch_size
+            with autocast_context(args.precision, device):
+                logits = model(b_ids, b_mask)
+                loss = F.cross_entropy(logits, b_labels.view(-1), reduction='sum') / b_labels.size(0)
 
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             train_loss += loss.item()
             num_batches += 1
 
         train_loss = train_loss / (num_batches)
 
-        train_acc, train_f1, *_  = model_eval(train_dataloader, model, device)
-        dev_acc, dev_f1, *_ = model_eval(dev_dataloader, model, device)
+        with autocast_context(args.precision, device):
+            train_acc, train_f1, *_  = model_eval(train_dataloader, model, device)
+            dev_acc, dev_f1, *_ = model_eval(dev_dataloader, model, device)
 
         if dev_acc > best_dev_acc:
             best_dev_acc = dev_acc
             save_model(model, optimizer, args, config, args.filepath)
+        if model.embedding_cache is not None:
+            model.embedding_cache.flush()
 
-        print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, train acc :: {train_acc :.3f}, dev acc :: {dev_acc :.3f}")
+        print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, train acc :: {train_acc :.3f}, dev acc :: {dev_acc :.3f}, padding efficiency :: {padding.value :.3f}")
 
 
 def test(args):
     with torch.no_grad():
         device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
-        saved = torch.load(args.filepath)
-        config = saved['model_config']
-        model = BertSentimentClassifier(config)
-        model.load_state_dict(saved['model'])
+        # An fp32 checkpoint, or an int8 model saved by quantize.py, which runs without autocast.
+        model, config = load_model(args.filepath, BertSentimentClassifier)
+        if is_quantized(model) and args.use_gpu:
+            raise ValueError(f"{args.filepath} is an int8 model, which runs on the CPU only; drop --use_gpu")
         model = model.to(device)
+        precision = 'fp32' if is_quantized(model) else args.precision
         print(f"load model from {args.filepath}")
 
         dev_data = load_data(args.dev, 'valid')
         dev_dataset = SentimentDataset(dev_data, args)
-        dev_dataloader = DataLoader(dev_dataset, shuffle=False, batch_size=args.batch_size, collate_fn=dev_dataset.collate_fn)
+        loader_options = dataloader_options(args)
+        dev_dataloader = DataLoader(dev_dataset, shuffle=False, batch_size=args.batch_size, collate_fn=dev_dataset.collate_fn,
+                                    **loader_options)
 
         test_data = load_data(args.test, 'test')
         test_dataset = SentimentTestDataset(test_data, args)
-        test_dataloader = DataLoader(test_dataset, shuffle=False, batch_size=args.batch_size, collate_fn=test_dataset.collate_fn)
+        test_dataloader = DataLoader(test_dataset, shuffle=False, batch_size=args.batch_size, collate_fn=test_dataset.collate_fn,
+                                     **loader_options)
 
-        dev_acc, dev_f1, dev_pred, dev_true, dev_sents, dev_sent_ids = model_eval(dev_dataloader, model, device)
-        print('DONE DEV')
-        test_pred, test_sents, test_sent_ids = model_test_eval(test_dataloader, model, device)
+        with autocast_context(precision, device):
+            dev_acc, dev_f1, dev_pred, dev_true, dev_sents, dev_sent_ids = model_eval(dev_dataloader, model, device)
+            print('DONE DEV')
+            test_pred, test_sents, test_sent_ids = model_test_eval(test_dataloader, model, device)
         print('DONE Test')
+        if model.embedding_cache is not None:
+            model.embedding_cache.flush()
         with open(args.dev_out, "w+") as f:
             print(f"dev acc :: {dev_acc :.3f}")
             f.write(f"id \t Predicted_Sentiment \n")
@@ -340,7 +383,7 @@ def test(args):
 
 
 def get_args():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(parents=[training_arguments_parser()])
     parser.add_argument("--seed", type=int, default=11711)
     parser.add_argument("--epochs", type=int, default=10)
     parser.add_argument("--option", type=str,
@@ -373,6 +416,7 @@ if __name__ == "__main__":
         dev='data/ids-sst-dev.csv',
         test='data/ids-sst-test-student.csv',
         option=args.option,
+        **training_options(args),
         dev_out = 'predictions/' + args.option + '-sst-dev-out.csv',
         test_out = 'predictions/' + args.option + '-sst-test-out.csv'
     )
@@ -394,6 +438,7 @@ if __name__ == "__main__":
         dev='data/ids-cfimdb-dev.csv',
         test='data/ids-cfimdb-test-student.csv',
         option=args.option,
+        **training_options(args),
         dev_out = 'predictions/' + args.option + '-cfimdb-dev-out.csv',
         test_out = 'predictions/' + args.option + '-cfimdb-test-out.csv'
     )
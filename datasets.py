@@ -8,11 +8,21 @@ Feel free to edit code in this file if you wish to modify the way in which the d
 examples are preprocessed.
 '''
 
+import argparse
+import bisect
 import csv
+import hashlib
+import os
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
-from tokenizer import BertTokenizer
+from torch.utils.data import DataLoader, Dataset, Sampler
+from tokenizer import BertTokenizer, BertTokenizerFast
+
+
+# Bump whenever load_multitask_data/preprocess_string change how sentences are produced,
+# so that previously compiled token caches are invalidated.
+TOKEN_CACHE_VERSION = 1
 
 
 def preprocess_string(s):
@@ -24,31 +34,388 @@ def preprocess_string(s):
                     .split())
 
 
-class SentenceClassificationDataset(Dataset):
-    def __init__(self, dataset, args):
+def file_checksum(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def vocab_checksum(tokenizer):
+    sha = hashlib.sha1()
+    for token, index in sorted(tokenizer.get_vocab().items(), key=lambda kv: kv[1]):
+        sha.update(f'{index}\t{token}\n'.encode('utf-8'))
+    sha.update(f'do_lower_case={tokenizer.do_lower_case}'.encode('utf-8'))
+    return sha.hexdigest()
+
+
+_TOKENIZERS = {}
+
+
+def load_tokenizer(name='bert-base-uncased', fast=False):
+    '''
+    The tokenizer of this process, built on first use and shared by all datasets. Datasets do not pickle
+    it, so every DataLoader worker started with spawn builds its own once; forked workers inherit it.
+    fast selects BertTokenizerFast (Rust backend, same ids) instead of BertTokenizer.
+    '''
+    if (name, fast) not in _TOKENIZERS:
+        _TOKENIZERS[name, fast] = (BertTokenizerFast if fast else BertTokenizer).from_pretrained(name)
+    return _TOKENIZERS[name, fast]
+
+
+class TokenizedDataset(Dataset):
+    '''
+    Base of the datasets below; self.tokenizer is the load_tokenizer() of the process using the dataset,
+    fast if args.fast_tokenizer is set.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['fast_tokenizer'] = state.pop('tokenizer').is_fast
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        fast = state.pop('fast_tokenizer', False)
+        self.__dict__.update(state)
+        self.tokenizer = load_tokenizer(fast=fast)
+
+
+class TokenCache:
+    '''
+    Pre-tokenized sentences stored on disk as one flat int32 array of token ids (special tokens
+    included) plus an int64 offsets index, both memory-mapped. Sentence i is
+    ids[offsets[i]:offsets[i + 1]].
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ids = np.load(prefix + '.ids.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+
+    @staticmethod
+    def key(tokenizer, source_filename, column, truncation=True):
+        sha = hashlib.sha1()
+        for part in (TOKEN_CACHE_VERSION, vocab_checksum(tokenizer), truncation,
+                     tokenizer.model_max_length, file_checksum(source_filename), column):
+            sha.update(f'{part}\0'.encode('utf-8'))
+        return sha.hexdigest()
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '.ids.npy') and os.path.exists(prefix + '.offsets.npy')
+
+    @classmethod
+    def compile(cls, sents, tokenizer, prefix, truncation=True, chunk_size=4096):
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        chunks = []
+        lengths = np.zeros(len(sents), dtype=np.int64)
+        for start in range(0, len(sents), chunk_size):
+            encoding = tokenizer(sents[start:start + chunk_size], truncation=truncation)
+            for i, ids in enumerate(encoding['input_ids']):
+                lengths[start + i] = len(ids)
+                chunks.append(np.asarray(ids, dtype=np.int32))
+        ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+        offsets = np.zeros(len(sents) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # Write to temporary files first so concurrent readers never see a partial cache.
+        for suffix, array in (('.ids.npy', ids), ('.offsets.npy', offsets)):
+            tmp = f'{prefix}.{os.getpid()}.tmp{suffix}'
+            np.save(tmp, array)
+            os.replace(tmp, prefix + suffix)
+        return cls(prefix)
+
+    @classmethod
+    def load_or_compile(cls, sents, tokenizer, source_filename, column, cache_dir, truncation=True):
+        prefix = os.path.join(cache_dir, cls.key(tokenizer, source_filename, column, truncation))
+        if cls.exists(prefix):
+            cache = cls(prefix)
+            if len(cache) == len(sents):
+                return cache
+        return cls.compile(sents, tokenizer, prefix, truncation=truncation)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.ids[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # Memory maps are reopened rather than copied when the cache is sent to DataLoader workers.
+    def __getstate__(self):
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state['prefix'])
+
+
+def pad_cached_ids(rows, pad_token_id):
+    '''Pads token id rows read from a TokenCache into (token_ids, token_type_ids, attention_mask).'''
+    max_len = max(len(row) for row in rows)
+    token_ids = torch.full((len(rows), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), max_len), dtype=torch.long)
+    for i, row in enumerate(rows):
+        token_ids[i, :len(row)] = torch.from_numpy(row.astype(np.int64))
+        attention_mask[i, :len(row)] = 1
+    token_type_ids = torch.zeros_like(token_ids)
+    return token_ids, token_type_ids, attention_mask
+
+
+def longest_first_lengths(length_1, length_2, max_tokens):
+    '''
+    Number of tokens each side of a pair keeps when both are cut to max_tokens tokens in total the way the
+    tokenizer's 'longest_first' truncation does it: one token at a time from the longer side, from the
+    second side on ties.
+    '''
+    kept_1 = min(length_1, max((max_tokens + 1) // 2, max_tokens - length_2))
+    return kept_1, min(length_2, max_tokens - kept_1)
+
+
+def pad_cached_pair_ids(rows_1, rows_2, pad_token_id, max_length):
+    '''
+    Cross-encodes token id rows of two TokenCaches as "[CLS] a [SEP] b [SEP]" (the [CLS] of the
+    second side is dropped) and pads them into (token_ids, token_type_ids, attention_mask).
+    Pairs longer than max_length are cut like tokenizer(a, b, truncation=True) cuts them.
+    '''
+    pairs = []
+    for row_1, row_2 in zip(rows_1, rows_2):
+        kept_1, kept_2 = longest_first_lengths(len(row_1) - 2, len(row_2) - 2, max_length - 3)
+        pairs.append((np.concatenate([row_1[:kept_1 + 1], row_1[-1:]]),
+                      np.concatenate([row_2[1:kept_2 + 1], row_2[-1:]])))
+    token_ids, _, attention_mask = pad_cached_ids([np.concatenate(pair) for pair in pairs], pad_token_id)
+    token_type_ids = torch.zeros_like(token_ids)
+    for i, (row_1, row_2) in enumerate(pairs):
+        token_type_ids[i, len(row_1):len(row_1) + len(row_2)] = 1
+    return token_ids, token_type_ids, attention_mask
+
+
+def pack_sentences(rows, pad_token_id, pack_length):
+    '''
+    Packs token id rows (one "[CLS] x [SEP]" sentence each) into as few rows of `pack_length` tokens as
+    possible (first-fit decreasing); sentences longer than `pack_length` are cut and keep their final token.
+    Returns
+    - token_ids [num_rows, pack_length],
+    - attention_mask [num_rows, pack_length, pack_length], block-diagonal: a token only attends to the
+      tokens of its own sentence,
+    - position_ids [num_rows, pack_length], restarting from 0 at every sentence,
+    - cls_positions [num_sentences], the flat index (row * pack_length + column) of the [CLS] token of
+      every sentence, in the order of `rows`.
+    '''
+    rows = [row if len(row) <= pack_length else np.concatenate([row[:pack_length - 1], row[-1:]]) for row in rows]
+    free, placement = [], [None] * len(rows)
+    for i in sorted(range(len(rows)), key=lambda i: -len(rows[i])):
+        row = next((r for r, space in enumerate(free) if space >= len(rows[i])), len(free))
+        if row == len(free):
+            free.append(pack_length)
+        placement[i] = (row, pack_length - free[row])
+        free[row] -= len(rows[i])
+
+    token_ids = torch.full((len(free), pack_length), pad_token_id, dtype=torch.long)
+    position_ids = torch.zeros((len(free), pack_length), dtype=torch.long)
+    segments = torch.zeros((len(free), pack_length), dtype=torch.long)
+    cls_positions = torch.zeros(len(rows), dtype=torch.long)
+    for i, (row, start) in enumerate(placement):
+        length = len(rows[i])
+        token_ids[row, start:start + length] = torch.as_tensor(np.asarray(rows[i], dtype=np.int64))
+        position_ids[row, start:start + length] = torch.arange(length)
+        segments[row, start:start + length] = i + 1
+        cls_positions[i] = row * pack_length + start
+    attention_mask = ((segments[:, :, None] == segments[:, None, :]) & (segments[:, :, None] > 0)).long()
+    return token_ids, attention_mask, position_ids, cls_positions
+
+
+class LengthBucketBatchSampler(Sampler):
+    '''
+    Batch sampler that groups examples of similar token length so that padding each batch to its
+    longest member wastes little compute. Examples are assigned to buckets by `bucket_boundaries`
+    (bucket i holds lengths in [boundaries[i-1], boundaries[i])), shuffled within their bucket and
+    cut into batches; the order of the batches is then shuffled across buckets.
+    '''
+    def __init__(self, lengths, batch_size, bucket_boundaries, shuffle=True, drop_last=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_boundaries = sorted(bucket_boundaries)
+        self.buckets = [[] for _ in range(len(self.bucket_boundaries) + 1)]
+        for idx, length in enumerate(lengths):
+            self.buckets[bisect.bisect_right(self.bucket_boundaries, length)].append(idx)
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = [bucket[i] for i in torch.randperm(len(bucket)).tolist()]
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start:start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(bucket) // self.batch_size for bucket in self.buckets)
+        return sum((len(bucket) + self.batch_size - 1) // self.batch_size for bucket in self.buckets)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    '''
+    Batch sampler that packs examples into variable-size batches whose padded size
+    (examples x longest length in the batch) stays within `max_tokens`. Examples are sorted by
+    length (ties broken randomly) before packing and the batch order is shuffled, so short
+    sentences form large batches and long ones small batches. An example longer than the
+    budget gets a batch of its own. For sentence pairs the budget applies to each side.
+    '''
+    def __init__(self, lengths, max_tokens, shuffle=True, drop_last=False):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_batches = len(self._pack(sorted(range(len(self.lengths)), key=self.lengths.__getitem__)))
+
+    def _pack(self, indices):
+        batches = []
+        batch, batch_max_len = [], 0
+        for idx in indices:
+            max_len = max(batch_max_len, self.lengths[idx])
+            if batch and (len(batch) + 1) * max_len > self.max_tokens:
+                batches.append(batch)
+                batch, max_len = [], self.lengths[idx]
+            batch.append(idx)
+            batch_max_len = max_len
+        if batch and not self.drop_last:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            indices = torch.randperm(len(indices)).tolist()
+        indices.sort(key=self.lengths.__getitem__)
+        batches = self._pack(indices)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return self.num_batches
+
+
+class PaddingEfficiency:
+    '''Accumulates real tokens / padded tokens over the attention masks of the batches seen.'''
+    def __init__(self):
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def update(self, *attention_masks):
+        for attention_mask in attention_masks:
+            self.real_tokens += int(attention_mask.sum())
+            self.padded_tokens += attention_mask.numel()
+
+    @property
+    def value(self):
+        return self.real_tokens / self.padded_tokens if self.padded_tokens else 1.0
+
+
+def dataloader_options(args):
+    '''
+    DataLoader keyword arguments for --num_workers, --prefetch_factor, --persistent_workers and --pin_memory.
+    With workers, batches are tokenized and collated in the background while the model works on earlier ones.
+    '''
+    options = {'num_workers': getattr(args, 'num_workers', 0), 'pin_memory': getattr(args, 'pin_memory', False)}
+    if options['num_workers'] > 0:
+        options['prefetch_factor'] = getattr(args, 'prefetch_factor', 2)
+        options['persistent_workers'] = getattr(args, 'persistent_workers', False)
+    return options
+
+
+def data_arguments_parser():
+    '''
+    Command line options for batching, tokenization and DataLoader workers (see dataloader_options),
+    shared by classifier.py and multitask_classifier.py through train_utils.training_arguments_parser.
+    '''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--bucket_boundaries", type=int, nargs='+', default=None,
+                        help='token-length bucket boundaries for batching training examples of similar length, e.g. 16 32 64 128')
+    parser.add_argument("--max_tokens", type=int, default=None,
+                        help='token budget (batch size x padded length) per training batch; overrides --batch_size for training')
+    parser.add_argument("--fast_tokenizer", action='store_true',
+                        help='tokenize with BertTokenizerFast (Rust tokenizers backend, same ids) instead of BertTokenizer')
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help='DataLoader worker processes for tokenizing and collating batches; 0 loads in the main process')
+    parser.add_argument("--prefetch_factor", type=int, default=2,
+                        help='batches loaded in advance by each worker (with --num_workers > 0)')
+    parser.add_argument("--persistent_workers", action='store_true',
+                        help='keep the DataLoader workers (and their tokenizers) alive between epochs')
+    parser.add_argument("--pin_memory", action='store_true',
+                        help='collate batches into pinned memory so host-to-GPU copies can overlap with compute')
+    return parser
+
+
+def build_train_dataloader(dataset, batch_size, bucket_boundaries=None, max_tokens=None, **loader_options):
+    '''
+    Shuffled training DataLoader. With max_tokens, batch sizes vary to fit that token budget;
+    otherwise examples of similar length are batched together if bucket_boundaries is given.
+    loader_options are passed on to the DataLoader (see dataloader_options).
+    '''
+    if max_tokens:
+        batch_sampler = TokenBudgetBatchSampler(dataset.example_lengths(), max_tokens)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn, **loader_options)
+    if bucket_boundaries:
+        batch_sampler = LengthBucketBatchSampler(dataset.example_lengths(), batch_size, bucket_boundaries)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn, **loader_options)
+    return DataLoader(dataset, shuffle=True, batch_size=batch_size, collate_fn=dataset.collate_fn, **loader_options)
+
+
+class SentenceClassificationDataset(TokenizedDataset):
+    def __init__(self, dataset, args, token_cache=None, pack_length=None):
         self.dataset = dataset
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_cache = token_cache
+        # Also return the batch packed into rows of pack_length tokens (see pack_sentences) as packed_*.
+        self.pack_length = pack_length
+        self.tokenizer = load_tokenizer(fast=getattr(args, 'fast_tokenizer', False))
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
+        # With a token cache the example index is appended so pad_data can read its token ids.
+        if self.token_cache is not None:
+            return self.dataset[idx] + (idx,)
         return self.dataset[idx]
 
+    def example_lengths(self):
+        '''Token length of every example (special tokens included), e.g. for LengthBucketBatchSampler.'''
+        if self.token_cache is not None:
+            return self.token_cache.lengths().tolist()
+        return [len(ids) for ids in self.tokenizer([x[0] for x in self.dataset], truncation=True)['input_ids']]
+
     def pad_data(self, data):
 
         sents = [x[0] for x in data]
         labels = [x[1] for x in data]
         sent_ids = [x[2] for x in data]
 
-        encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
+        if self.token_cache is not None:
+            rows = [self.token_cache[x[-1]] for x in data]
+            token_ids, _, attention_mask = pad_cached_ids(rows, self.tokenizer.pad_token_id)
+        else:
+            encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
+            token_ids = encoding['input_ids']
+            attention_mask = encoding['attention_mask']
         labels = torch.LongTensor(labels)
 
         return token_ids, attention_mask, labels, sents, sent_ids
 
+    def pack_data(self, token_ids, attention_mask):
+        rows = [ids[:length].numpy() for ids, length in zip(token_ids, attention_mask.sum(dim=1).tolist())]
+        return pack_sentences(rows, self.tokenizer.pad_token_id, self.pack_length)
+
     def collate_fn(self, all_data):
         token_ids, attention_mask, labels, sents, sent_ids= self.pad_data(all_data)
 
@@ -60,29 +427,47 @@ class SentenceClassificationDataset(Dataset):
                 'sent_ids': sent_ids
             }
 
+        if self.pack_length is not None:
+            packed_token_ids, packed_attention_mask, packed_position_ids, cls_positions = \
+                self.pack_data(token_ids, attention_mask)
+            batched_data.update({
+                'packed_token_ids': packed_token_ids,
+                'packed_attention_mask': packed_attention_mask,
+                'packed_position_ids': packed_position_ids,
+                'packed_cls_positions': cls_positions
+            })
+
         return batched_data
 
 
 # Unlike SentenceClassificationDataset, we do not load labels in SentenceClassificationTestDataset.
-class SentenceClassificationTestDataset(Dataset):
-    def __init__(self, dataset, args):
+class SentenceClassificationTestDataset(TokenizedDataset):
+    def __init__(self, dataset, args, token_cache=None):
         self.dataset = dataset
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_cache = token_cache
+        self.tokenizer = load_tokenizer(fast=getattr(args, 'fast_tokenizer', False))
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
+        # With a token cache the example index is appended so pad_data can read its token ids.
+        if self.token_cache is not None:
+            return self.dataset[idx] + (idx,)
         return self.dataset[idx]
 
     def pad_data(self, data):
         sents = [x[0] for x in data]
         sent_ids = [x[1] for x in data]
 
-        encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
+        if self.token_cache is not None:
+            rows = [self.token_cache[x[-1]] for x in data]
+            token_ids, _, attention_mask = pad_cached_ids(rows, self.tokenizer.pad_token_id)
+        else:
+            encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
+            token_ids = encoding['input_ids']
+            attention_mask = encoding['attention_mask']
 
         return token_ids, attention_mask, sents, sent_ids
 
@@ -99,35 +484,58 @@ class SentenceClassificationTestDataset(Dataset):
         return batched_data
 
 
-class SentencePairDataset(Dataset):
-    def __init__(self, dataset, args, isRegression=False):
+class SentencePairDataset(TokenizedDataset):
+    def __init__(self, dataset, args, isRegression=False, token_cache=None, cross_encode=False):
         self.dataset = dataset
         self.p = args
         self.isRegression = isRegression
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_cache = token_cache
+        # Also return the "[CLS] sent1 [SEP] sent2 [SEP]" encoding of each pair as token_ids/token_type_ids/attention_mask.
+        self.cross_encode = cross_encode
+        self.tokenizer = load_tokenizer(fast=getattr(args, 'fast_tokenizer', False))
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
+        # With a token cache the example index is appended so pad_data can read its token ids.
+        if self.token_cache is not None:
+            return self.dataset[idx] + (idx,)
         return self.dataset[idx]
 
+    def example_lengths(self):
+        '''Longer side of every pair in tokens (special tokens included), e.g. for LengthBucketBatchSampler.'''
+        if self.token_cache is not None:
+            cache1, cache2 = self.token_cache
+            return np.maximum(cache1.lengths(), cache2.lengths()).tolist()
+        lengths1 = [len(ids) for ids in self.tokenizer([x[0] for x in self.dataset], truncation=True)['input_ids']]
+        lengths2 = [len(ids) for ids in self.tokenizer([x[1] for x in self.dataset], truncation=True)['input_ids']]
+        return [max(l1, l2) for l1, l2 in zip(lengths1, lengths2)]
+
     def pad_data(self, data):
         sent1 = [x[0] for x in data]
         sent2 = [x[1] for x in data]
         labels = [x[2] for x in data]
         sent_ids = [x[3] for x in data]
 
-        encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
-        encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
+        if self.token_cache is not None:
+            cache1, cache2 = self.token_cache
+            pad_token_id = self.tokenizer.pad_token_id
+            token_ids, token_type_ids, attention_mask = pad_cached_ids(
+                [cache1[x[-1]] for x in data], pad_token_id)
+            token_ids2, token_type_ids2, attention_mask2 = pad_cached_ids(
+                [cache2[x[-1]] for x in data], pad_token_id)
+        else:
+            encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
+            encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
 
-        token_ids = torch.LongTensor(encoding1['input_ids'])
-        attention_mask = torch.LongTensor(encoding1['attention_mask'])
-        token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
+            token_ids = encoding1['input_ids']
+            attention_mask = encoding1['attention_mask']
+            token_type_ids = encoding1['token_type_ids']
 
-        token_ids2 = torch.LongTensor(encoding2['input_ids'])
-        attention_mask2 = torch.LongTensor(encoding2['attention_mask'])
-        token_type_ids2 = torch.LongTensor(encoding2['token_type_ids'])
+            token_ids2 = encoding2['input_ids']
+            attention_mask2 = encoding2['attention_mask']
+            token_type_ids2 = encoding2['token_type_ids']
         if self.isRegression:
             labels = torch.DoubleTensor(labels)
         else:
@@ -137,6 +545,15 @@ class SentencePairDataset(Dataset):
                 token_ids2, token_type_ids2, attention_mask2,
                 labels,sent_ids)
 
+    def pad_cross_encoded(self, data):
+        if self.token_cache is not None:
+            cache1, cache2 = self.token_cache
+            return pad_cached_pair_ids([cache1[x[-1]] for x in data], [cache2[x[-1]] for x in data],
+                                       self.tokenizer.pad_token_id, self.tokenizer.model_max_length)
+        encoding = self.tokenizer([x[0] for x in data], [x[1] for x in data],
+                                  return_tensors='pt', padding=True, truncation=True)
+        return encoding['input_ids'], encoding['token_type_ids'], encoding['attention_mask']
+
     def collate_fn(self, all_data):
         (token_ids, token_type_ids, attention_mask,
          token_ids2, token_type_ids2, attention_mask2,
@@ -153,20 +570,30 @@ class SentencePairDataset(Dataset):
                 'sent_ids': sent_ids
             }
 
+        if self.cross_encode:
+            (batched_data['token_ids'], batched_data['token_type_ids'],
+             batched_data['attention_mask']) = self.pad_cross_encoded(all_data)
+
         return batched_data
 
 
 # Unlike SentencePairDataset, we do not load labels in SentencePairTestDataset.
-class SentencePairTestDataset(Dataset):
-    def __init__(self, dataset, args):
+class SentencePairTestDataset(TokenizedDataset):
+    def __init__(self, dataset, args, token_cache=None, cross_encode=False):
         self.dataset = dataset
         self.p = args
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_cache = token_cache
+        # Also return the "[CLS] sent1 [SEP] sent2 [SEP]" encoding of each pair as token_ids/token_type_ids/attention_mask.
+        self.cross_encode = cross_encode
+        self.tokenizer = load_tokenizer(fast=getattr(args, 'fast_tokenizer', False))
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
+        # With a token cache the example index is appended so pad_data can read its token ids.
+        if self.token_cache is not None:
+            return self.dataset[idx] + (idx,)
         return self.dataset[idx]
 
     def pad_data(self, data):
@@ -174,22 +601,39 @@ class SentencePairTestDataset(Dataset):
         sent2 = [x[1] for x in data]
         sent_ids = [x[2] for x in data]
 
-        encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
-        encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
+        if self.token_cache is not None:
+            cache1, cache2 = self.token_cache
+            pad_token_id = self.tokenizer.pad_token_id
+            token_ids, token_type_ids, attention_mask = pad_cached_ids(
+                [cache1[x[-1]] for x in data], pad_token_id)
+            token_ids2, token_type_ids2, attention_mask2 = pad_cached_ids(
+                [cache2[x[-1]] for x in data], pad_token_id)
+        else:
+            encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
+            encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
 
-        token_ids = torch.LongTensor(encoding1['input_ids'])
-        attention_mask = torch.LongTensor(encoding1['attention_mask'])
-        token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
+            token_ids = encoding1['input_ids']
+            attention_mask = encoding1['attention_mask']
+            token_type_ids = encoding1['token_type_ids']
 
-        token_ids2 = torch.LongTensor(encoding2['input_ids'])
-        attention_mask2 = torch.LongTensor(encoding2['attention_mask'])
-        token_type_ids2 = torch.LongTensor(encoding2['token_type_ids'])
+            token_ids2 = encoding2['input_ids']
+            attention_mask2 = encoding2['attention_mask']
+            token_type_ids2 = encoding2['token_type_ids']
 
 
         return (token_ids, token_type_ids, attention_mask,
                 token_ids2, token_type_ids2, attention_mask2,
                sent_ids)
 
+    def pad_cross_encoded(self, data):
+        if self.token_cache is not None:
+            cache1, cache2 = self.token_cache
+            return pad_cached_pair_ids([cache1[x[-1]] for x in data], [cache2[x[-1]] for x in data],
+                                       self.tokenizer.pad_token_id, self.tokenizer.model_max_length)
+        encoding = self.tokenizer([x[0] for x in data], [x[1] for x in data],
+                                  return_tensors='pt', padding=True, truncation=True)
+        return encoding['input_ids'], encoding['token_type_ids'], encoding['attention_mask']
+
     def collate_fn(self, all_data):
         (token_ids, token_type_ids, attention_mask,
          token_ids2, token_type_ids2, attention_mask2,
@@ -205,6 +649,10 @@ class SentencePairTestDataset(Dataset):
                 'sent_ids': sent_ids
             }
 
+        if self.cross_encode:
+            (batched_data['token_ids'], batched_data['token_type_ids'],
+             batched_data['attention_mask']) = self.pad_cross_encoded(all_data)
+
         return batched_data
 
 
@@ -270,3 +718,49 @@ def load_multitask_data(sentiment_filename,paraphrase_filename,similarity_filena
     print(f"Loaded {len(similarity_data)} {split} examples from {similarity_filename}")
 
     return sentiment_data, num_labels, paraphrase_data, similarity_data
+
+
+def compile_multitask_data(sentiment_filename, paraphrase_filename, similarity_filename, split='train',
+                           cache_dir=None):
+    '''
+    Loads the three datasets with load_multitask_data and compiles (or reuses) a TokenCache for every
+    sentence column, keyed by the tokenizer vocab, truncation settings and source file checksum.
+
+    Returns the load_multitask_data tuple followed by a dict with the sentiment TokenCache and the
+    (sentence1, sentence2) TokenCache pairs for paraphrase and similarity. If cache_dir is None
+    nothing is compiled and every cache is None, so the datasets tokenize in collate_fn as before.
+    '''
+    sentiment_data, num_labels, paraphrase_data, similarity_data = \
+        load_multitask_data(sentiment_filename, paraphrase_filename, similarity_filename, split=split)
+
+    if cache_dir is None:
+        return sentiment_data, num_labels, paraphrase_data, similarity_data, \
+            {'sst': None, 'para': None, 'sts': None}
+
+    tokenizer = load_tokenizer()
+
+    def load_or_compile(data, column_idx, filename, column):
+        return TokenCache.load_or_compile([x[column_idx] for x in data], tokenizer, filename,
+                                          f'{split}/{column}', cache_dir)
+
+    token_caches = {
+        'sst': load_or_compile(sentiment_data, 0, sentiment_filename, 'sentence'),
+        'para': (load_or_compile(paraphrase_data, 0, paraphrase_filename, 'sentence1'),
+                 load_or_compile(paraphrase_data, 1, paraphrase_filename, 'sentence2')),
+        'sts': (load_or_compile(similarity_data, 0, similarity_filename, 'sentence1'),
+                load_or_compile(similarity_data, 1, similarity_filename, 'sentence2')),
+    }
+    print(f"Token caches for {split} split ready in {cache_dir}")
+
+    return sentiment_data, num_labels, paraphrase_data, similarity_data, token_caches
+
+
+if __name__ == "__main__":
+    # Offline compile step: python datasets.py --cache_dir data/token_cache
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache_dir", type=str, default="data/token_cache")
+    args = parser.parse_args()
+
+    for split, prefix in (('train', 'train'), ('dev', 'dev'), ('test', 'test-student')):
+        compile_multitask_data(f"data/ids-sst-{prefix}.csv", f"data/quora-{prefix}.csv",
+                               f"data/sts-{prefix}.csv", split=split, cache_dir=args.cache_dir)
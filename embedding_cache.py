@@ -0,0 +1,148 @@
+'''
+On-disk cache of frozen BERT outputs for the "pretrain" option.
+
+When the BERT parameters are frozen, the encoder output of a sentence never changes, so it only
+has to be computed once. EmbeddingCache keys every sentence by its (unpadded) token ids, runs
+BERT only on sentences it has not seen yet and serves `pooler_output` (and, if requested,
+`last_hidden_state`) from memory-mapped float16/float32 arrays afterwards, across epochs,
+evaluation and later runs.
+
+Cached outputs are computed with BERT in eval mode, i.e. without dropout inside the encoder.
+'''
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import torch
+
+
+def encoder_fingerprint(bert):
+    '''Hash of the encoder weights, so a cache is never served for a different (or fine-tuned) BERT.'''
+    sha = hashlib.sha1()
+    for name, tensor in bert.state_dict().items():
+        sha.update(name.encode('utf-8'))
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+class GrowableMemmap:
+    '''2-d memory-mapped array of fixed width whose number of rows grows by doubling.'''
+    def __init__(self, filename, width, dtype, rows=0):
+        self.filename = filename
+        self.width = width
+        self.dtype = np.dtype(dtype)
+        self.rows = rows
+        if not os.path.exists(filename):
+            open(filename, 'wb').close()
+        self.capacity = os.path.getsize(filename) // (self.width * self.dtype.itemsize)
+        self._open()
+
+    def _open(self):
+        self.array = np.memmap(self.filename, dtype=self.dtype, mode='r+', shape=(self.capacity, self.width)) \
+            if self.capacity else np.zeros((0, self.width), dtype=self.dtype)
+
+    def append(self, values):
+        start = self.rows
+        if start + len(values) > self.capacity:
+            if isinstance(self.array, np.memmap):
+                self.array.flush()
+            self.capacity = max(2 * self.capacity, start + len(values), 1024)
+            with open(self.filename, 'r+b') as fp:
+                fp.truncate(self.capacity * self.width * self.dtype.itemsize)
+            self._open()
+        self.array[start:start + len(values)] = values
+        self.rows += len(values)
+        return start
+
+    def flush(self):
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, bert, dtype='float16', hidden_states=False):
+        self.hidden_states = hidden_states
+        hidden_size = bert.config.hidden_size
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = os.path.join(cache_dir, f'{encoder_fingerprint(bert)}-{dtype}')
+        self.index_filename = prefix + '.index'
+
+        # index maps a sentence key to (pooled row, first hidden-state row, number of tokens).
+        self.index = {}
+        pooled_rows = hidden_rows = 0
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as fp:
+                self.index, pooled_rows, hidden_rows = pickle.load(fp)
+        self.pooled = GrowableMemmap(prefix + '.pooled', hidden_size, dtype, rows=pooled_rows)
+        self.hidden = GrowableMemmap(prefix + '.hidden', hidden_size, dtype, rows=hidden_rows) \
+            if hidden_states else None
+        if hidden_states and any(entry[1] is None for entry in self.index.values()):
+            # Entries written without hidden states have to be recomputed.
+            self.index = {key: entry for key, entry in self.index.items() if entry[1] is not None}
+
+    def __len__(self):
+        return len(self.index)
+
+    @staticmethod
+    def _keys(input_ids, attention_mask, token_type_ids):
+        lengths = attention_mask.sum(dim=1).tolist()
+        input_ids = input_ids.cpu().numpy()
+        token_type_ids = token_type_ids.cpu().numpy() if token_type_ids is not None else None
+        keys = []
+        for i, length in enumerate(lengths):
+            key = input_ids[i, :length].tobytes()
+            if token_type_ids is not None:
+                key += token_type_ids[i, :length].tobytes()
+            keys.append(key)
+        return keys, lengths
+
+    def _fill(self, bert, input_ids, attention_mask, token_type_ids):
+        keys, lengths = self._keys(input_ids, attention_mask, token_type_ids)
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self.index and key not in missing:
+                missing[key] = i
+        if missing:
+            rows = list(missing.values())
+            was_training = bert.training
+            bert.eval()
+            with torch.no_grad():
+                outputs = bert(input_ids[rows], attention_mask[rows],
+                               token_type_ids=token_type_ids[rows] if token_type_ids is not None else None)
+            bert.train(was_training)
+
+            pooled_start = self.pooled.append(outputs['pooler_output'].float().cpu().numpy())
+            for j, (key, i) in enumerate(missing.items()):
+                hidden_start = None
+                if self.hidden is not None:
+                    hidden_start = self.hidden.append(outputs['last_hidden_state'][j, :lengths[i]].float().cpu().numpy())
+                self.index[key] = (pooled_start + j, hidden_start, lengths[i])
+        return [self.index[key] for key in keys]
+
+    def pooler_output(self, bert, input_ids, attention_mask, token_type_ids=None):
+        '''Cached equivalent of bert(input_ids, attention_mask, token_type_ids)['pooler_output'].'''
+        entries = self._fill(bert, input_ids, attention_mask, token_type_ids)
+        pooled = self.pooled.array[[entry[0] for entry in entries]]
+        return torch.from_numpy(pooled.astype(np.float32)).to(input_ids.device)
+
+    def last_hidden_state(self, bert, input_ids, attention_mask, token_type_ids=None):
+        '''Cached equivalent of bert(...)['last_hidden_state']; padding positions are zero.'''
+        if self.hidden is None:
+            raise ValueError("This EmbeddingCache was created without hidden_states=True")
+        entries = self._fill(bert, input_ids, attention_mask, token_type_ids)
+        hidden = np.zeros((len(entries), input_ids.size(1), self.hidden.width), dtype=np.float32)
+        for i, (_, start, length) in enumerate(entries):
+            hidden[i, :length] = self.hidden.array[start:start + length]
+        return torch.from_numpy(hidden).to(input_ids.device)
+
+    def flush(self):
+        '''Writes the arrays and the index to disk so later runs can reuse them.'''
+        self.pooled.flush()
+        if self.hidden is not None:
+            self.hidden.flush()
+        tmp = f'{self.index_filename}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fp:
+            pickle.dump((self.index, self.pooled.rows, self.hidden.rows if self.hidden is not None else 0), fp)
+        os.replace(tmp, self.index_filename)
@@ -13,6 +13,7 @@ writes all required submission files.
 '''
 
 import random, numpy as np, argparse
+import time
 from types import SimpleNamespace
 
 import torch
@@ -21,7 +22,10 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
 from bert import BertModel
+from embedding_cache import EmbeddingCache
 from optimizer import AdamW
+from quantize import is_quantized, load_model
+from train_utils import autocast_context, training_arguments_parser
 from tqdm import tqdm
 
 from datasets import (
@@ -29,7 +33,11 @@ from datasets import (
     SentenceClassificationTestDataset,
     SentencePairDataset,
     SentencePairTestDataset,
-    load_multitask_data
+    load_multitask_data,
+    compile_multitask_data,
+    build_train_dataloader,
+    dataloader_options,
+    PaddingEfficiency
 )
 
 from evaluation import model_eval_sst, model_eval_multitask, model_eval_test_multitask
@@ -50,6 +58,21 @@ def seed_everything(seed=11711):
     torch.backends.cudnn.deterministic = True
 
 
+class Throughput:
+    '''Accumulates training examples / seconds spent in their forward and backward passes.'''
+    def __init__(self):
+        self.examples = 0
+        self.seconds = 0.0
+
+    def update(self, examples, seconds):
+        self.examples += examples
+        self.seconds += seconds
+
+    @property
+    def value(self):
+        return self.examples / self.seconds if self.seconds else 0.0
+
+
 BERT_HIDDEN_SIZE = 768
 N_SENTIMENT_CLASSES = 5
 
@@ -64,13 +87,26 @@ class MultitaskBERT(nn.Module):
     '''
     def __init__(self, config):
         super(MultitaskBERT, self).__init__()
-        self.bert = BertModel.from_pretrained('bert-base-uncased')
+        self.bert = BertModel.from_pretrained('bert-base-uncased',
+                                              attention_backend=getattr(config, 'attention_backend', 'reference'),
+                                              unpadded=getattr(config, 'unpadded', False),
+                                              checkpoint_every=getattr(config, 'checkpoint_every', 0))
         # Pretrain mode does not require updating BERT paramters.
         for param in self.bert.parameters():
             if config.option == 'pretrain':
                 param.requires_grad = False
             elif config.option == 'finetune':
                 param.requires_grad = True
+        # 'separate' runs BERT once per side of a sentence pair, 'shared' once on both sides stacked together,
+        # 'cross' once on the cross-encoded "[CLS] a [SEP] b [SEP]" pair with its own pair heads.
+        self.pair_forward = getattr(config, 'pair_forward', 'separate')
+        # With frozen BERT parameters the encoder outputs can be computed once and served from disk.
+        self.embedding_cache = None
+        if getattr(config, 'embedding_cache_dir', None) is not None:
+            if config.option != 'pretrain':
+                raise ValueError("The embedding cache requires frozen BERT parameters (option 'pretrain')")
+            self.embedding_cache = EmbeddingCache(config.embedding_cache_dir, self.bert,
+                                                  dtype=getattr(config, 'embedding_cache_dtype', 'float16'))
         # You will want to add layers here to perform the downstream tasks.
         ### TODO
         self.linear_sentiment = nn.Linear(config.hidden_size, 5)
@@ -92,33 +128,68 @@ class MultitaskBERT(nn.Module):
         self.linear_similarity2 = nn.Linear(config.hidden_size, 10)
 =        self.relu_similarity3 = nn.ReLU()
 
-    def forward(self, input_ids, attention_mask):
-        'Takes a batch of sentences and produces embeddings for them.'
+        if self.pair_forward == 'cross':
+            self.dropout_paraphrase_cross = nn.Dropout(config.hidden_dropout_prob)
+            self.linear_paraphrase_cross = nn.Linear(config.hidden_size, 1)
+            self.dropout_similarity_cross = nn.Dropout(config.hidden_dropout_prob)
+            self.linear_similarity_cross = nn.Linear(config.hidden_size, 1)
+
+    def forward(self, input_ids, attention_mask, position_ids=None, cls_positions=None):
+        'Takes a batch of sentences (or packed rows of sentences, see BertModel.forward) and produces embeddings for them.'
         # The final BERT embedding is the hidden state of [CLS] token (the first token)
         # Here, you can start by just returning the embeddings straight from BERT.
         # When thinking of improvements, you can later try modifying this
         # (e.g., by adding other layers).
         ### TODO
-        embeddings = self.bert.forward(input_ids, attention_mask)
+        if self.embedding_cache is not None and cls_positions is None:
+            return self.embedding_cache.pooler_output(self.bert, input_ids, attention_mask)
+        embeddings = self.bert.forward(input_ids, attention_mask, position_ids=position_ids, cls_positions=cls_positions)
         embeddings = embeddings['pooler_output']
 
         return embeddings
 
-
-    def predict_sentiment(self, input_ids, attention_mask):
+    def forward_pair(self,
+                     input_ids_1, attention_mask_1,
+                     input_ids_2, attention_mask_2):
+        '''Embeds both sentences of each pair; with pair_forward == 'shared' they go through BERT in a single pass.'''
+        if self.pair_forward == 'shared' and self.embedding_cache is None:
+            return self.bert.forward_pair(input_ids_1, attention_mask_1, input_ids_2, attention_mask_2)
+        return self.forward(input_ids_1, attention_mask_1), self.forward(input_ids_2, attention_mask_2)
+
+    def forward_cross(self, input_ids, token_type_ids, attention_mask):
+        'Takes a batch of cross-encoded "[CLS] a [SEP] b [SEP]" pairs and produces one embedding per pair.'
+        if self.embedding_cache is not None:
+            return self.embedding_cache.pooler_output(self.bert, input_ids, attention_mask, token_type_ids=token_type_ids)
+        embeddings = self.bert.forward(input_ids, attention_mask, token_type_ids=token_type_ids)
+        return embeddings['pooler_output']
+
+    def predict_paraphrase_cross(self, input_ids, token_type_ids, attention_mask):
+        '''Paraphrase logit of cross-encoded pairs (see SentencePairDataset(cross_encode=True)).'''
+        embeddings = self.forward_cross(input_ids, token_type_ids, attention_mask)
+        return self.linear_paraphrase_cross(self.dropout_paraphrase_cross(embeddings)).float()
+
+    def predict_similarity_cross(self, input_ids, token_type_ids, attention_mask):
+        '''Similarity logit of cross-encoded pairs (see SentencePairDataset(cross_encode=True)).'''
+        embeddings = self.forward_cross(input_ids, token_type_ids, attention_mask)
+        return self.linear_similarity_cross(self.dropout_similarity_cross(embeddings)).squeeze(-1).float()
+
+
+    def predict_sentiment(self, input_ids, attention_mask, position_ids=None, cls_positions=None):
         '''Given a batch of sentences, outputs logits for classifying sentiment.
         There are 5 sentiment classes:
         (0 - negative, 1- somewhat negative, 2- neutral, 3- somewhat positive, 4- positive)
         Thus, your output should contain 5 logits for each sentence.
+        Packed batches pass position_ids and cls_positions as well (see SentenceClassificationDataset(pack_length=...)).
         '''
         ### TODO
-        embeddings = self.forward(input_ids, attention_mask)
+        embeddings = self.forward(input_ids, attention_mask, position_ids=position_ids, cls_positions=cls_positions)
         logits = self.dropout_sentiment(embeddings)
         logits = self.linear_sentiment(logits)
         #logits = self.activation_sentiment(logits)
         #probabilities = self.softmax_sentiment(logits)
 
-        return logits
+        # Logits are returned in fp32 under autocast too, so the evaluation code can convert them to numpy.
+        return logits.float()
 
 
 
@@ -130,8 +201,11 @@ class MultitaskBERT(nn.Module):
         during evaluation.
         '''
         ### TODO
-        embeddings1 = self.forward(input_ids_1, attention_mask_1)
-        embeddings2 = self.forward(input_ids_2, attention_mask_2)
+        if self.pair_forward == 'cross':
+            return self.predict_paraphrase_cross(*self.bert.cross_encode_pair(
+                input_ids_1, attention_mask_1, input_ids_2, attention_mask_2))
+
+        embeddings1, embeddings2 = self.forward_pair(input_ids_1, attention_mask_1, input_ids_2, attention_mask_2)
 
         concat_embeddings = torch.cat((embeddings1, embeddings2), dim = 1)
 
@@ -146,7 +220,7 @@ class MultitaskBERT(nn.Module):
         #print(logit_final)
         #print('\n')
 
-        return logit_final
+        return logit_final.float()
 
     def predict_similarity(self,
                            input_ids_1, attention_mask_1,
@@ -155,8 +229,11 @@ class MultitaskBERT(nn.Module):
         Note that your output should be unnormalized (a logit).
         '''
         ### TODO
-        embeddings1 = self.forward(input_ids_1, attention_mask_1)
-        embeddings2 = self.forward(input_ids_2, attention_mask_2)
+        if self.pair_forward == 'cross':
+            return self.predict_similarity_cross(*self.bert.cross_encode_pair(
+                input_ids_1, attention_mask_1, input_ids_2, attention_mask_2))
+
+        embeddings1, embeddings2 = self.forward_pair(input_ids_1, attention_mask_1, input_ids_2, attention_mask_2)
 
         logit1 = self.dropout_similarity1(embeddings1)
         logit1 = self.linear_similarity1(logit1)
@@ -167,7 +244,7 @@ class MultitaskBERT(nn.Module):
         cosine_similarity = self.cosine_similarity(logit1, logit2)
         logit = self.relu_similarity3(cosine_similarity)
 
-        #return logit
+        return logit.float()
 
 
 
@@ -233,36 +310,39 @@ def train_multitask(args):
     '''
     device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
     # Create the data and its corresponding datasets and dataloader.
-    sst_train_data, num_labels,para_train_data, sts_train_data = load_multitask_data(args.sst_train,args.para_train,args.sts_train, split ='train')
-    sst_dev_data, num_labels,para_dev_data, sts_dev_data = load_multitask_data(args.sst_dev,args.para_dev,args.sts_dev, split ='train')
+    sst_train_data, num_labels,para_train_data, sts_train_data, train_caches = compile_multitask_data(args.sst_train,args.para_train,args.sts_train, split ='train', cache_dir=args.token_cache_dir)
+    sst_dev_data, num_labels,para_dev_data, sts_dev_data, dev_caches = compile_multitask_data(args.sst_dev,args.para_dev,args.sts_dev, split ='train', cache_dir=args.token_cache_dir)
 
     #Loading datasets
-    sst_train_data = SentenceClassificationDataset(sst_train_data, args)
-    sst_dev_data = SentenceClassificationDataset(sst_dev_data, args)
+    loader_options = dataloader_options(args)
+    sst_train_data = SentenceClassificationDataset(sst_train_data, args, token_cache=train_caches['sst'],
+                                                   pack_length=args.pack_length)
+    sst_dev_data = SentenceClassificationDataset(sst_dev_data, args, token_cache=dev_caches['sst'])
 
-    sst_train_dataloader = DataLoader(sst_train_data, shuffle=True, batch_size=args.batch_size,
-                                      collate_fn=sst_train_data.collate_fn)
+    sst_train_dataloader = build_train_dataloader(sst_train_data, args.batch_size, args.bucket_boundaries, args.max_tokens,
+                                                  **loader_options)
     sst_dev_dataloader = DataLoader(sst_dev_data, shuffle=False, batch_size=args.batch_size,
-                                    collate_fn=sst_dev_data.collate_fn)
+                                    collate_fn=sst_dev_data.collate_fn, **loader_options)
 
 
 
-    para_train_data = SentencePairDataset(para_train_data, args)
-    para_dev_data = SentencePairDataset(para_dev_data, args)
+    cross_encode = args.pair_forward == 'cross'
+    para_train_data = SentencePairDataset(para_train_data, args, token_cache=train_caches['para'], cross_encode=cross_encode)
+    para_dev_data = SentencePairDataset(para_dev_data, args, token_cache=dev_caches['para'])
 
-    para_train_dataloader = DataLoader(para_train_data, shuffle=True, batch_size=args.batch_size,
-                                  collate_fn=para_train_data.collate_fn)
+    para_train_dataloader = build_train_dataloader(para_train_data, args.batch_size, args.bucket_boundaries, args.max_tokens,
+                                                   **loader_options)
     para_dev_dataloader = DataLoader(para_dev_data, shuffle=False, batch_size=args.batch_size,
-                                collate_fn=para_dev_data.collate_fn)
+                                collate_fn=para_dev_data.collate_fn, **loader_options)
 
 
-    sts_train_data = SentencePairDataset(sts_train_data, args)
-    sts_dev_data = SentencePairDataset(sts_dev_data, args)
+    sts_train_data = SentencePairDataset(sts_train_data, args, token_cache=train_caches['sts'], cross_encode=cross_encode)
+    sts_dev_data = SentencePairDataset(sts_dev_data, args, token_cache=dev_caches['sts'])
 
-    sts_train_dataloader = DataLoader(sts_train_data, shuffle=True, batch_size=args.batch_size,
-                                  collate_fn=sts_train_data.collate_fn)
+    sts_train_dataloader = build_train_dataloader(sts_train_data, args.batch_size, args.bucket_boundaries, args.max_tokens,
+                                                  **loader_options)
     sts_dev_dataloader = DataLoader(sts_dev_data, shuffle=False, batch_size=args.batch_size,
-                                collate_fn=sts_dev_data.collate_fn)
+                                collate_fn=sts_dev_data.collate_fn, **loader_options)
 
 
 
@@ -271,7 +351,13 @@ def train_multitask(args):
               'num_labels': num_labels,
               'hidden_size': 768,
               'data_dir': '.',
-              'option': args.option}
+              'option': args.option,
+              'pair_forward': args.pair_forward,
+              'attention_backend': args.attention_backend,
+              'unpadded': args.unpadded,
+              'checkpoint_every': args.checkpoint_every,
+              'embedding_cache_dir': args.embedding_cache_dir,
+              'embedding_cache_dtype': args.embedding_cache_dtype}
 
     config = SimpleNamespace(**config)
 
@@ -279,8 +365,14 @@ def train_multitask(args):
     model = model.to(device)
 
     lr = args.lr
-    optimizer = AdamW(model.parameters(), lr=lr)
+    optimizer = AdamW(model.parameters(), lr=lr, foreach=args.adamw_impl == 'foreach',
+                      flatten=args.adamw_impl == 'flat', state_dtype=args.adamw_state_dtype)
+    # Loss scaling keeps small fp16 gradients from flushing to zero; a no-op for fp32 and bf16.
+    scaler = torch.amp.GradScaler(device.type, enabled=args.precision == 'fp16')
     best_dev_acc = 0
+    # Micro-batches accumulated per optimizer step for SST, Quora and STS.
+    sst_accum_steps, para_accum_steps, sts_accum_steps = \
+        args.task_grad_accum_steps or (args.grad_accum_steps,) * 3
 
     print(args.epochs)
     # Run for the specified number of epochs.
@@ -288,83 +380,141 @@ def train_multitask(args):
         model.train()
         train_loss = 0
         num_batches = 0
-        for sst_batch, para_batch, sts_batch in tqdm(zip(sst_train_dataloader, para_train_dataloader, sts_train_dataloader),  total=min([len(sst_train_dataloader), len(para_train_dataloader), len(sts_train_dataloader)]), desc=f'train-{epoch}', disable=TQDM_DISABLE):
+        sst_padding, para_padding, sts_padding = PaddingEfficiency(), PaddingEfficiency(), PaddingEfficiency()
+        sst_throughput, para_throughput, sts_throughput = Throughput(), Throughput(), Throughput()
+        sst_iterator, para_iterator, sts_iterator = \
+            iter(sst_train_dataloader), iter(para_train_dataloader), iter(sts_train_dataloader)
+        # One optimizer step accumulates the gradients of sst_accum_steps SST, para_accum_steps Quora and
+        # sts_accum_steps STS micro-batches.
+        num_steps = min(len(sst_train_dataloader) // sst_accum_steps, len(para_train_dataloader) // para_accum_steps,
+                        len(sts_train_dataloader) // sts_accum_steps)
+        for step in tqdm(range(num_steps), desc=f'train-{epoch}', disable=TQDM_DISABLE):
 
             optimizer.zero_grad()
             #Sst
-            sst_b_ids, sst_b_mask, sst_b_labels = (sst_batch['token_ids'],
-                                      sst_batch['attention_mask'], sst_batch['labels'])
-
-            sst_b_ids = sst_b_ids.to(device)
-            sst_b_mask = sst_b_mask.to(device)
-            sst_b_labels = sst_b_labels.to(device)
-
-            sst_logits = model.predict_sentiment(sst_b_ids, sst_b_mask)
-            loss = F.cross_entropy(sst_logits, sst_b_labels.view(-1), reduction='sum') / args.batch_size
-
-            loss.backward()
-            train_loss += loss.item()
+            # All micro-batches of this step are fetched first, so the loss can be averaged over the examples of the
+            # whole accumulated batch even when micro-batch sizes vary (--max_tokens).
+            sst_batches = list(itertools.islice(sst_iterator, sst_accum_steps))
+            sst_examples = sum(batch['labels'].size(0) for batch in sst_batches)
+            sst_loss = 0
+            start = time.perf_counter()
+            for sst_batch in sst_batches:
+                sst_b_ids, sst_b_mask, sst_b_labels = (sst_batch['token_ids'],
+                                          sst_batch['attention_mask'], sst_batch['labels'])
+
+                sst_b_labels = sst_b_labels.to(device, non_blocking=args.pin_memory)
+                with autocast_context(args.precision, device):
+                    if args.pack_length is not None:
+                        sst_b_mask = sst_batch['packed_attention_mask']
+                        sst_padding.update(sst_b_mask.diagonal(dim1=1, dim2=2))
+                        sst_logits = model.predict_sentiment(sst_batch['packed_token_ids'].to(device, non_blocking=args.pin_memory), sst_b_mask.to(device, non_blocking=args.pin_memory),
+                                                             position_ids=sst_batch['packed_position_ids'].to(device, non_blocking=args.pin_memory),
+                                                             cls_positions=sst_batch['packed_cls_positions'].to(device, non_blocking=args.pin_memory))
+                    else:
+                        sst_padding.update(sst_b_mask)
+                        sst_logits = model.predict_sentiment(sst_b_ids.to(device, non_blocking=args.pin_memory), sst_b_mask.to(device, non_blocking=args.pin_memory))
+                    loss = F.cross_entropy(sst_logits, sst_b_labels.view(-1), reduction='sum') / sst_examples
+
+                scaler.scale(loss).backward()
+                sst_loss += loss.item()
+            sst_throughput.update(sst_examples, time.perf_counter() - start)
+            train_loss += sst_loss
             num_batches += 1
 
             #Para
-            para_b_ids1, para_b_mask1, para_b_ids2, para_b_mask2, para_b_labels = (para_batch['token_ids_1'],
-                                      para_batch['attention_mask_1'], para_batch['token_ids_2'],
-                                                                para_batch['attention_mask_2'], para_batch['labels'])
-
-            para_b_ids1 = para_b_ids1.to(device)
-            para_b_mask1 = para_b_mask1.to(device)
-            para_b_ids2 = para_b_ids2.to(device)
-            para_b_mask2 = para_b_mask2.to(device)
-            para_b_labels = para_b_labels.to(device)
-
-            #embeddings1 = model.forward(para_b_ids1, para_b_mask1)
-            #embeddings2 = model.forward(para_b_ids2, para_b_mask2)
-            #embeddings = torch.cat((embeddings1, embeddings2), dim=0)
-
-            para_logits = model.predict_paraphrase(para_b_ids1, para_b_mask1, para_b_ids2, para_b_mask2)
-            loss = F.binary_cross_entropy_with_logits(para_logits.squeeze(), para_b_labels.float(), reduction='sum') / args.batch_size
-            #loss += nt_xent_loss(embeddings)
-            loss.backward()
-            train_loss += loss.item()
+            # All micro-batches of this step are fetched first, so the loss can be averaged over the examples of the
+            # whole accumulated batch even when micro-batch sizes vary (--max_tokens).
+            para_batches = list(itertools.islice(para_iterator, para_accum_steps))
+            para_examples = sum(batch['labels'].size(0) for batch in para_batches)
+            para_loss = 0
+            start = time.perf_counter()
+            for para_batch in para_batches:
+                para_b_ids1, para_b_mask1, para_b_ids2, para_b_mask2, para_b_labels = (para_batch['token_ids_1'],
+                                          para_batch['attention_mask_1'], para_batch['token_ids_2'],
+                                                                    para_batch['attention_mask_2'], para_batch['labels'])
+
+                para_padding.update(para_b_mask1, para_b_mask2)
+                para_b_ids1 = para_b_ids1.to(device, non_blocking=args.pin_memory)
+                para_b_mask1 = para_b_mask1.to(device, non_blocking=args.pin_memory)
+                para_b_ids2 = para_b_ids2.to(device, non_blocking=args.pin_memory)
+                para_b_mask2 = para_b_mask2.to(device, non_blocking=args.pin_memory)
+                para_b_labels = para_b_labels.to(device, non_blocking=args.pin_memory)
+
+                #embeddings1 = model.forward(para_b_ids1, para_b_mask1)
+                #embeddings2 = model.forward(para_b_ids2, para_b_mask2)
+                #embeddings = torch.cat((embeddings1, embeddings2), dim=0)
+
+                with autocast_context(args.precision, device):
+                    if cross_encode:
+                        para_logits = model.predict_paraphrase_cross(para_batch['token_ids'].to(device, non_blocking=args.pin_memory),
+                                                                     para_batch['token_type_ids'].to(device, non_blocking=args.pin_memory),
+                                                                     para_batch['attention_mask'].to(device, non_blocking=args.pin_memory))
+                    else:
+                        para_logits = model.predict_paraphrase(para_b_ids1, para_b_mask1, para_b_ids2, para_b_mask2)
+                    loss = F.binary_cross_entropy_with_logits(para_logits.squeeze(), para_b_labels.float(), reduction='sum') / para_examples
+                #loss += nt_xent_loss(embeddings)
+                scaler.scale(loss).backward()
+                para_loss += loss.item()
+            para_throughput.update(para_examples, time.perf_counter() - start)
+            train_loss += para_loss
             num_batches += 1
+
             #Sts
-            sts_b_ids1, sts_b_mask1, sts_b_ids2, sts_b_mask2, sts_b_labels = (sts_batch['token_ids_1'],
-                                      sts_batch['attention_mask_1'], sts_batch['token_ids_2'], sts_batch['attention_mask_2'],
-                                      sts_batch['labels'])
-
-            sts_b_ids1 = sts_b_ids1.to(device)
-            sts_b_mask1 = sts_b_mask1.to(device)
-            sts_b_ids2 = sts_b_ids2.to(device)
-            sts_b_mask2 = sts_b_mask2.to(device)
-            sts_b_labels = sts_b_labels.to(device)
-
-            #embeddings1 = model.forward(sts_b_ids1, sts_b_mask1)
-            #embeddings2 = model.forward(sts_b_ids2, sts_b_mask2)
-            #embeddings = torch.cat((embeddings1, embeddings2), dim=0)
-
-            sts_logits = model.predict_similarity(sts_b_ids1, sts_b_mask1, sts_b_ids2, sts_b_mask2)
-            #I multiplied by 5 because when checking sts_train csv file, the similarity scores were between 0 and 5. The cosin_similarity index
-            #is between 0 and 1. So multipying by 5 will get the logits in the rquired range.
-
-            sts_logits = sts_logits * 5
-            sts_logits.requires_grad = True
-            loss = F.mse_loss(sts_logits, sts_b_labels.view(-1).float(), reduction='sum') / args.batch_size
-            #loss = F.cross_entropy(sts_logits, sts_b_labels.view(-1).float(), reduction='sum') / args.batch_size
-            #loss = F.binary_cross_entropy_with_logits(sts_logits.squeeze(), sts_b_labels.float(), reduction='sum') / args.batch_size
-            #loss += nt_xent_loss(embeddings)
-
-            loss.backward()
-            train_loss += loss.item()
+            # All micro-batches of this step are fetched first, so the loss can be averaged over the examples of the
+            # whole accumulated batch even when micro-batch sizes vary (--max_tokens).
+            sts_batches = list(itertools.islice(sts_iterator, sts_accum_steps))
+            sts_examples = sum(batch['labels'].size(0) for batch in sts_batches)
+            sts_loss = 0
+            start = time.perf_counter()
+            for sts_batch in sts_batches:
+                sts_b_ids1, sts_b_mask1, sts_b_ids2, sts_b_mask2, sts_b_labels = (sts_batch['token_ids_1'],
+                                          sts_batch['attention_mask_1'], sts_batch['token_ids_2'], sts_batch['attention_mask_2'],
+                                          sts_batch['labels'])
+
+                sts_padding.update(sts_b_mask1, sts_b_mask2)
+                sts_b_ids1 = sts_b_ids1.to(device, non_blocking=args.pin_memory)
+                sts_b_mask1 = sts_b_mask1.to(device, non_blocking=args.pin_memory)
+                sts_b_ids2 = sts_b_ids2.to(device, non_blocking=args.pin_memory)
+                sts_b_mask2 = sts_b_mask2.to(device, non_blocking=args.pin_memory)
+                sts_b_labels = sts_b_labels.to(device, non_blocking=args.pin_memory)
+
+                #embeddings1 = model.forward(sts_b_ids1, sts_b_mask1)
+                #embeddings2 = model.forward(sts_b_ids2, sts_b_mask2)
+                #embeddings = torch.cat((embeddings1, embeddings2), dim=0)
+
+                with autocast_context(args.precision, device):
+                    if cross_encode:
+                        sts_logits = model.predict_similarity_cross(sts_batch['token_ids'].to(device, non_blocking=args.pin_memory),
+                                                                    sts_batch['token_type_ids'].to(device, non_blocking=args.pin_memory),
+                                                                    sts_batch['attention_mask'].to(device, non_blocking=args.pin_memory))
+                    else:
+                        sts_logits = model.predict_similarity(sts_b_ids1, sts_b_mask1, sts_b_ids2, sts_b_mask2)
+                    #I multiplied by 5 because when checking sts_train csv file, the similarity scores were between 0 and 5. The cosin_similarity index
+                    #is between 0 and 1. So multipying by 5 will get the logits in the rquired range.
+
+                    sts_logits = sts_logits * 5
+                    sts_logits.requires_grad = True
+                    loss = F.mse_loss(sts_logits, sts_b_labels.view(-1).float(), reduction='sum') / sts_examples
+                #loss = F.cross_entropy(sts_logits, sts_b_labels.view(-1).float(), reduction='sum') / args.batch_size
+                #loss = F.binary_cross_entropy_with_logits(sts_logits.squeeze(), sts_b_labels.float(), reduction='sum') / args.batch_size
+                #loss += nt_xent_loss(embeddings)
+
+                scaler.scale(loss).backward()
+                sts_loss += loss.item()
+            sts_throughput.update(sts_examples, time.perf_counter() - start)
+            train_loss += sts_loss
             num_batches += 1
 
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
         if num_batches != 0:
             train_loss = train_loss / (num_batches)
 
-        sentiment_train_accuracy,sst_y_pred, sst_sent_ids, paraphrase_train_accuracy, para_y_pred, para_sent_ids, sts_train_corr, sts_y_pred, sts_sent_ids = model_eval_multitask(sst_train_dataloader, para_train_dataloader, sts_train_dataloader, model, device)
+        with autocast_context(args.precision, device):
+            sentiment_train_accuracy,sst_y_pred, sst_sent_ids, paraphrase_train_accuracy, para_y_pred, para_sent_ids, sts_train_corr, sts_y_pred, sts_sent_ids = model_eval_multitask(sst_train_dataloader, para_train_dataloader, sts_train_dataloader, model, device)
 
-        sentiment_dev_accuracy,sst_y_pred, sst_sent_ids, paraphrase_dev_accuracy, para_y_pred, para_sent_ids, sts_dev_corr, sts_y_pred, sts_sent_ids = model_eval_multitask(sst_dev_dataloader, para_dev_dataloader, sts_dev_dataloader, model, device)
+            sentiment_dev_accuracy,sst_y_pred, sst_sent_ids, paraphrase_dev_accuracy, para_y_pred, para_sent_ids, sts_dev_corr, sts_y_pred, sts_sent_ids = model_eval_multitask(sst_dev_dataloader, para_dev_dataloader, sts_dev_dataloader, model, device)
 
 
         average_train_accuracy = (sentiment_train_accuracy + paraphrase_train_accuracy + sts_train_corr) / 3
@@ -375,7 +525,11 @@ def train_multitask(args):
         if (average_dev_accuracy >= best_dev_acc):
             best_dev_acc = average_dev_accuracy
             save_model(model, optimizer, args, config, args.filepath)
+        if model.embedding_cache is not None:
+            model.embedding_cache.flush()
 
+        print(f"Epoch {epoch}: throughput (examples/s) :: Sst {sst_throughput.value :.1f}, Para {para_throughput.value :.1f}, Sts {sts_throughput.value :.1f}")
+        print(f"Epoch {epoch}: padding efficiency (real/padded tokens) :: Sst {sst_padding.value :.3f}, Para {para_padding.value :.3f}, Sts {sts_padding.value :.3f}")
         print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, Sst train acc :: {sentiment_train_accuracy :.3f}, Sst dev acc :: {sentiment_dev_accuracy :.3f}, Para train acc :: {paraphrase_train_accuracy :.3f}, Para dev acc :: {paraphrase_dev_accuracy :.3f}, Sts train corr :: {sts_train_corr :.3f}, Sts dev  corr :: {sts_dev_corr :.3f}")
 
 
@@ -383,55 +537,59 @@ def test_multitask(args):
     '''Test and save predictions on the dev and test sets of all three tasks.'''
     with torch.no_grad():
         device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
-        saved = torch.load(args.filepath)
-        config = saved['model_config']
-
-        model = MultitaskBERT(config)
-        model.load_state_dict(saved['model'])
+        # An fp32 checkpoint, or an int8 model saved by quantize.py, which runs without autocast.
+        model, config = load_model(args.filepath, MultitaskBERT)
+        if is_quantized(model) and args.use_gpu:
+            raise ValueError(f"{args.filepath} is an int8 model, which runs on the CPU only; drop --use_gpu")
         model = model.to(device)
+        precision = 'fp32' if is_quantized(model) else args.precision
         print(f"Loaded model to test from {args.filepath}")
 
-        sst_test_data, num_labels,para_test_data, sts_test_data = \
-            load_multitask_data(args.sst_test,args.para_test, args.sts_test, split='test')
+        sst_test_data, num_labels,para_test_data, sts_test_data, test_caches = \
+            compile_multitask_data(args.sst_test,args.para_test, args.sts_test, split='test', cache_dir=args.token_cache_dir)
 
-        sst_dev_data, num_labels,para_dev_data, sts_dev_data = \
-            load_multitask_data(args.sst_dev,args.para_dev,args.sts_dev,split='dev')
+        sst_dev_data, num_labels,para_dev_data, sts_dev_data, dev_caches = \
+            compile_multitask_data(args.sst_dev,args.para_dev,args.sts_dev,split='dev', cache_dir=args.token_cache_dir)
 
-        sst_test_data = SentenceClassificationTestDataset(sst_test_data, args)
-        sst_dev_data = SentenceClassificationDataset(sst_dev_data, args)
+        loader_options = dataloader_options(args)
+        sst_test_data = SentenceClassificationTestDataset(sst_test_data, args, token_cache=test_caches['sst'])
+        sst_dev_data = SentenceClassificationDataset(sst_dev_data, args, token_cache=dev_caches['sst'])
 
         sst_test_dataloader = DataLoader(sst_test_data, shuffle=True, batch_size=args.batch_size,
-                                         collate_fn=sst_test_data.collate_fn)
+                                         collate_fn=sst_test_data.collate_fn, **loader_options)
         sst_dev_dataloader = DataLoader(sst_dev_data, shuffle=False, batch_size=args.batch_size,
-                                        collate_fn=sst_dev_data.collate_fn)
+                                        collate_fn=sst_dev_data.collate_fn, **loader_options)
 
-        para_test_data = SentencePairTestDataset(para_test_data, args)
-        para_dev_data = SentencePairDataset(para_dev_data, args)
+        para_test_data = SentencePairTestDataset(para_test_data, args, token_cache=test_caches['para'])
+        para_dev_data = SentencePairDataset(para_dev_data, args, token_cache=dev_caches['para'])
 
         para_test_dataloader = DataLoader(para_test_data, shuffle=True, batch_size=args.batch_size,
-                                          collate_fn=para_test_data.collate_fn)
+                                          collate_fn=para_test_data.collate_fn, **loader_options)
         para_dev_dataloader = DataLoader(para_dev_data, shuffle=False, batch_size=args.batch_size,
-                                         collate_fn=para_dev_data.collate_fn)
+                                         collate_fn=para_dev_data.collate_fn, **loader_options)
 
-        sts_test_data = SentencePairTestDataset(sts_test_data, args)
-        sts_dev_data = SentencePairDataset(sts_dev_data, args, isRegression=True)
+        sts_test_data = SentencePairTestDataset(sts_test_data, args, token_cache=test_caches['sts'])
+        sts_dev_data = SentencePairDataset(sts_dev_data, args, isRegression=True, token_cache=dev_caches['sts'])
 
         sts_test_dataloader = DataLoader(sts_test_data, shuffle=True, batch_size=args.batch_size,
-                                         collate_fn=sts_test_data.collate_fn)
+                                         collate_fn=sts_test_data.collate_fn, **loader_options)
         sts_dev_dataloader = DataLoader(sts_dev_data, shuffle=False, batch_size=args.batch_size,
-                                        collate_fn=sts_dev_data.collate_fn)
-
-        dev_sentiment_accuracy,dev_sst_y_pred, dev_sst_sent_ids, \
-            dev_paraphrase_accuracy, dev_para_y_pred, dev_para_sent_ids, \
-            dev_sts_corr, dev_sts_y_pred, dev_sts_sent_ids = model_eval_multitask(sst_dev_dataloader,
-                                                                    para_dev_dataloader,
-                                                                    sts_dev_dataloader, model, device)
-
-        test_sst_y_pred, \
-            test_sst_sent_ids, test_para_y_pred, test_para_sent_ids, test_sts_y_pred, test_sts_sent_ids = \
-                model_eval_test_multitask(sst_test_dataloader,
-                                          para_test_dataloader,
-                                          sts_test_dataloader, model, device)
+                                        collate_fn=sts_dev_data.collate_fn, **loader_options)
+
+        with autocast_context(precision, device):
+            dev_sentiment_accuracy,dev_sst_y_pred, dev_sst_sent_ids, \
+                dev_paraphrase_accuracy, dev_para_y_pred, dev_para_sent_ids, \
+                dev_sts_corr, dev_sts_y_pred, dev_sts_sent_ids = model_eval_multitask(sst_dev_dataloader,
+                                                                        para_dev_dataloader,
+                                                                        sts_dev_dataloader, model, device)
+
+            test_sst_y_pred, \
+                test_sst_sent_ids, test_para_y_pred, test_para_sent_ids, test_sts_y_pred, test_sts_sent_ids = \
+                    model_eval_test_multitask(sst_test_dataloader,
+                                              para_test_dataloader,
+                                              sts_test_dataloader, model, device)
+        if model.embedding_cache is not None:
+            model.embedding_cache.flush()
 
         with open(args.sst_dev_out, "w+") as f:
             print(f"dev sentiment acc :: {dev_sentiment_accuracy :.3f}")
@@ -468,7 +626,7 @@ def test_multitask(args):
 
 
 def get_args():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(parents=[training_arguments_parser()])
     parser.add_argument("--sst_train", type=str, default="data/ids-sst-train.csv")
     parser.add_argument("--sst_dev", type=str, default="data/ids-sst-dev.csv")
     parser.add_argument("--sst_test", type=str, default="data/ids-sst-test-student.csv")
@@ -487,6 +645,10 @@ def get_args():
                         help='pretrain: the BERT parameters are frozen; finetune: BERT parameters are updated',
                         choices=('pretrain', 'finetune'), default="pretrain")
     parser.add_argument("--use_gpu", action='store_true')
+    parser.add_argument("--pair_forward", type=str,
+                        help='separate: one BERT pass per sentence of a pair; shared: both sentences in a single stacked pass; '
+                             'cross: one pass over the cross-encoded "[CLS] a [SEP] b [SEP]" pair using token_type_ids',
+                        choices=('separate', 'shared', 'cross'), default="separate")
 
     parser.add_argument("--sst_dev_out", type=str, default="predictions/sst-dev-output.csv")
     parser.add_argument("--sst_test_out", type=str, default="predictions/sst-test-output.csv")
@@ -500,6 +662,14 @@ def get_args():
     parser.add_argument("--batch_size", help='sst: 64, cfimdb: 8 can fit a 12GB GPU', type=int, default=8)
     parser.add_argument("--hidden_dropout_prob", type=float, default=0.3)
     parser.add_argument("--lr", type=float, help="learning rate", default=1e-5)
+    parser.add_argument("--grad_accum_steps", type=int, default=1,
+                        help='accumulate the gradients of this many micro-batches per task before each optimizer step')
+    parser.add_argument("--task_grad_accum_steps", type=int, nargs=3, default=None, metavar=('SST', 'PARA', 'STS'),
+                        help='per-task --grad_accum_steps for SST, Quora and STS, e.g. 4 1 2')
+    parser.add_argument("--token_cache_dir", type=str, default=None,
+                        help='directory of pre-tokenized, memory-mapped caches (see datasets.py); disabled if not set')
+    parser.add_argument("--pack_length", type=int, default=None,
+                        help='pack several SST training sentences into rows of this many tokens; disabled if not set')
 
     args = parser.parse_args()
     return args
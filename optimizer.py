@@ -1,10 +1,128 @@
 from typing import Callable, Iterable, Tuple
+import itertools
 import math
 
 import torch
+import torch.nn.functional as F
 from torch.optim import Optimizer
 
 
+STATE_DTYPES = ('float32', 'bfloat16', 'int8')
+QUANTIZATION_BLOCK_SIZE = 256
+_DYNAMIC_CODES = {}
+
+
+def dynamic_code(signed, device):
+    '''
+    The values of the 8-bit codes: zero and magnitudes spaced logarithmically over [1e-7, 1] (signed: both signs),
+    so small entries of a block keep a few percent of relative precision next to its absolute maximum.
+    '''
+    key = (signed, device)
+    if key not in _DYNAMIC_CODES:
+        magnitudes = torch.logspace(-7, 0, 127 if signed else 255, device=device)
+        zero = magnitudes.new_zeros(1)
+        _DYNAMIC_CODES[key] = torch.cat([-magnitudes.flip(0), zero, magnitudes]) if signed \
+            else torch.cat([zero, magnitudes])
+    return _DYNAMIC_CODES[key]
+
+
+def quantize_blockwise(tensor, signed):
+    '''
+    uint8 indices into dynamic_code of `tensor` / absmax, for blocks of QUANTIZATION_BLOCK_SIZE elements. Magnitudes
+    are rounded to the nearest code on the log scale (computed directly rather than searched), those below half
+    the smallest code to zero.
+    '''
+    levels = 127 if signed else 255
+    flat = tensor.reshape(-1)
+    blocks = F.pad(flat, (0, -flat.numel() % QUANTIZATION_BLOCK_SIZE)).view(-1, QUANTIZATION_BLOCK_SIZE)
+    absmax = blocks.abs().amax(dim=1)
+    magnitudes = blocks.abs().div_(absmax.clamp_min(torch.finfo(absmax.dtype).tiny)[:, None])
+    # 0 for zero, 1..levels for the magnitudes of dynamic_code.
+    index = magnitudes.log10().add_(7).mul_((levels - 1) / 7).round_().clamp_(0, levels - 1).add_(1)
+    index.masked_fill_(magnitudes < 0.5e-7, 0)
+    if signed:
+        index = torch.where(blocks < 0, levels - index, levels + index)
+    return index.to(torch.uint8), absmax
+
+
+def dequantize_blockwise(codes, absmax, shape, signed):
+    values = dynamic_code(signed, codes.device)[codes.long()] * absmax[:, None]
+    return values.view(-1)[:math.prod(shape)].view(shape)
+
+
+def store_moment(state, key, value, state_dtype):
+    '''Keeps the Adam moment state[key] ('m' or 'v') in float32, bfloat16 or blockwise-quantized 8 bits.'''
+    if state_dtype == 'float32':
+        state[key] = value
+    elif state_dtype == 'bfloat16':
+        state[key] = value.to(torch.bfloat16)
+    else:
+        # v is stored as sqrt(v), whose dynamic range is that of m (and of the gradients).
+        state[key], state[key + '_absmax'] = quantize_blockwise(value.sqrt() if key == 'v' else value,
+                                                               signed=key == 'm')
+
+
+def load_moment(state, key, param):
+    '''The float32 value of a moment kept by store_moment (or the initial 0).'''
+    value = state[key]
+    if not torch.is_tensor(value):
+        return value
+    if value.dtype == torch.uint8:
+        value = dequantize_blockwise(value, state[key + '_absmax'], param.shape, signed=key == 'm')
+        return value.square() if key == 'v' else value
+    return value.float()
+
+
+class FlatBuffers:
+    '''
+    The trainable parameters of one param group, their gradients and their Adam moments, each kept in one
+    contiguous buffer. Parameter .data and .grad and the 'm'/'v' entries of the optimizer state are views into
+    these buffers, so an optimizer step is a few whole-buffer ops and the state is saved as one storage.
+    '''
+    def __init__(self, params, state):
+        self.params = [p for p in params if p.requires_grad]
+        if any(p.dtype != torch.float32 for p in self.params):
+            raise ValueError("flatten requires float32 parameters (use autocast for lower precision)")
+        if len({p.device for p in self.params}) > 1:
+            raise ValueError("flatten requires all parameters of a param group on the same device")
+        device = self.params[0].device if self.params else None
+        self.offsets = list(itertools.accumulate((p.numel() for p in self.params), initial=0))
+        numel = self.offsets[-1]
+        self.param = torch.empty(numel, device=device)
+        self.grad = torch.zeros(numel, device=device)
+        self.m = torch.zeros(numel, device=device)
+        self.v = torch.zeros(numel, device=device)
+        self.denominator = torch.empty(numel, device=device)
+
+        for p, view in zip(self.params, self.views(self.param)):
+            view.copy_(p.data)
+            p.data = view
+        self.gather_grads()
+        self.bind_state(state)
+
+    def views(self, buffer):
+        return [buffer[start:end].view_as(p) for p, start, end in zip(self.params, self.offsets, self.offsets[1:])]
+
+    def gather_grads(self):
+        '''Points every .grad back into the gradient buffer, e.g. after Module.zero_grad() set them to None.'''
+        for p, view in zip(self.params, self.views(self.grad)):
+            if p.grad is None:
+                view.zero_()
+            elif p.grad.data_ptr() != view.data_ptr():
+                view.copy_(p.grad)
+            p.grad = view
+
+    def bind_state(self, state):
+        '''Moves the moments of `state` into the moment buffers (e.g. after load_state_dict) and replaces them by views.'''
+        for p, m, v in zip(self.params, self.views(self.m), self.views(self.v)):
+            for key, view in (('m', m), ('v', v)):
+                value = state[p].get(key, 0)
+                if torch.is_tensor(value) and value.data_ptr() != view.data_ptr():
+                    view.copy_(value)
+                state[p][key] = view
+            state[p].setdefault('t', 0)
+
+
 class AdamW(Optimizer):
     def __init__(
             self,
@@ -14,6 +132,9 @@ class AdamW(Optimizer):
             eps: float = 1e-6,
             weight_decay: float = 0.0,
             correct_bias: bool = True,
+            foreach: bool = False,
+            flatten: bool = False,
+            state_dtype: str = 'float32',
     ):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
@@ -23,25 +144,77 @@ class AdamW(Optimizer):
             raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[1]))
         if not 0.0 <= eps:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(eps))
-        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
+        if state_dtype not in STATE_DTYPES:
+            raise ValueError("Invalid state dtype: {} - should be one of {}".format(state_dtype, STATE_DTYPES))
+        if state_dtype != 'float32' and (foreach or flatten):
+            raise ValueError("Compressed moments (state_dtype={}) are only supported by the per-parameter update"
+                             .format(state_dtype))
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias,
+                        foreach=foreach, state_dtype=state_dtype)
+        self.flatten = flatten
+        # FlatBuffers of every param group with flatten, None otherwise.
+        self._flat_buffers = []
         super().__init__(params, defaults)
+        # Scratch buffers of the foreach update, allocated once per parameter; not part of the state dict.
+        self._denominators = {}
+
+    def add_param_group(self, param_group):
+        super().add_param_group(param_group)
+        self._flat_buffers.append(FlatBuffers(self.param_groups[-1]['params'], self.state) if self.flatten else None)
+
+    def zero_grad(self, set_to_none: bool = True):
+        super().zero_grad(set_to_none)
+        # Flattened groups keep their .grad views; the gradient buffer is zeroed at once instead.
+        for flat in self._flat_buffers:
+            if flat is not None:
+                flat.grad.zero_()
+                flat.gather_grads()
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        # Optimizer.load_state_dict casts floating point state to the dtype of its parameter; fp32 master
+        # copies and compressed moments are restored in the dtype they were saved in instead.
+        saved_ids = itertools.chain.from_iterable(group['params'] for group in state_dict['param_groups'])
+        params = itertools.chain.from_iterable(group['params'] for group in self.param_groups)
+        for param_id, p in zip(saved_ids, params):
+            for key, value in state_dict['state'].get(param_id, {}).items():
+                if torch.is_tensor(value) and value.dtype != self.state[p][key].dtype:
+                    self.state[p][key] = value.to(device=p.device, copy=True)
+        for flat in self._flat_buffers:
+            if flat is not None:
+                flat.bind_state(self.state)
 
     def step(self, closure: Callable = None):
         loss = None
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        for group, flat in zip(self.param_groups, self._flat_buffers):
+            if flat is not None:
+                self._flat_step(group, flat)
+                continue
+            if group.get("foreach", False):
+                self._foreach_step(group)
+                continue
+
             for p in group["params"]:
                 if p.grad is None:
                     continue
                 grad = p.grad.data
                 if grad.is_sparse:
                     raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+                # The update is always computed in fp32.
+                grad = grad.float()
 
                 # State should be stored in this dictionary.
                 state = self.state[p]
 
+                # Parameters kept in a lower precision (e.g. a model cast to bf16) are updated through an
+                # fp32 master copy, so small updates are not rounded away.
+                if p.data.dtype != torch.float32 and 'master' not in state:
+                    state['master'] = p.data.float()
+                param = state['master'] if 'master' in state else p.data
+
                 # Access hyperparameters from the `group` dictionary.
                 alpha = group["lr"]
 
@@ -72,13 +245,97 @@ class AdamW(Optimizer):
                     state['v'] = 0
 
                 state['t'] = state['t'] + 1
-                state['m'] = beta1*state['m'] + (1-beta1)*grad
-                state['v'] = beta2*state['v'] + (1-beta2)*(grad**2)
+                m = beta1*load_moment(state, 'm', param) + (1-beta1)*grad
+                v = beta2*load_moment(state, 'v', param) + (1-beta2)*(grad**2)
+                store_moment(state, 'm', m, group.get('state_dtype', 'float32'))
+                store_moment(state, 'v', v, group.get('state_dtype', 'float32'))
+
+                m_bias_corrected = m / (1 - (beta1**state['t']))
+                v_bias_corrected = v / (1 - (beta2**state['t']))
+                param = param - ((alpha * m_bias_corrected) / (torch.sqrt(v_bias_corrected) + eps))
+                param = param - param * alpha * weight_decay
 
-                m_bias_corrected = state['m'] / (1 - (beta1**state['t']))
-                v_bias_corrected = state['v'] / (1 - (beta2**state['t']))
-                p.data = p.data - ((alpha * m_bias_corrected) / (torch.sqrt(v_bias_corrected) + eps))
-                p.data = p.data - p.data * alpha * weight_decay
+                if 'master' in state:
+                    state['master'] = param
+                    p.data = param.to(p.data.dtype)
+                else:
+                    p.data = param
 
 
         return loss
+
+    def _foreach_step(self, group):
+        '''
+        The update of step() for all parameters of a group at once: batched torch._foreach_* ops work in place
+        on the parameters and moments, so nothing parameter-sized is allocated per step.
+        '''
+        beta1, beta2 = group['betas']
+        params, grads, ms, vs, denominators, step_sizes, v_corrections, masters = [], [], [], [], [], [], [], []
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+            state = self.state[p]
+            if p.data.dtype != torch.float32 and 'master' not in state:
+                state['master'] = p.data.float()
+            param = state['master'] if 'master' in state else p.data
+
+            # Moments start as zeros (the loop above starts from the scalar 0, which is the same thing).
+            if not torch.is_tensor(state.get('m')):
+                state['m'] = torch.zeros_like(param)
+            if not torch.is_tensor(state.get('v')):
+                state['v'] = torch.zeros_like(param)
+            state['t'] = state.get('t', 0) + 1
+            if p not in self._denominators:
+                self._denominators[p] = torch.empty_like(param)
+
+            params.append(param)
+            grads.append(p.grad.float())
+            ms.append(state['m'])
+            vs.append(state['v'])
+            denominators.append(self._denominators[p])
+            step_sizes.append(-group['lr'] / (1 - beta1 ** state['t']))
+            v_corrections.append(1 - beta2 ** state['t'])
+            if 'master' in state:
+                masters.append((p, param))
+        if not params:
+            return
+
+        torch._foreach_mul_(ms, beta1)
+        torch._foreach_add_(ms, grads, alpha=1 - beta1)
+        torch._foreach_mul_(vs, beta2)
+        torch._foreach_addcmul_(vs, grads, grads, value=1 - beta2)
+
+        # param - lr * (m / (1 - beta1^t)) / (sqrt(v / (1 - beta2^t)) + eps), then the decoupled weight decay.
+        torch._foreach_copy_(denominators, vs)
+        torch._foreach_div_(denominators, v_corrections)
+        torch._foreach_sqrt_(denominators)
+        torch._foreach_add_(denominators, group['eps'])
+        torch._foreach_addcdiv_(params, ms, denominators, step_sizes)
+        if group['weight_decay']:
+            torch._foreach_mul_(params, 1 - group['lr'] * group['weight_decay'])
+
+        for p, master in masters:
+            p.data.copy_(master)
+
+    def _flat_step(self, group, flat):
+        '''
+        The update of step() on the FlatBuffers of a group. Trainable parameters that got no gradient in this
+        step are updated with a zero gradient, i.e. their moments (and weight decay) still apply.
+        '''
+        if not flat.params:
+            return
+        flat.gather_grads()
+        beta1, beta2 = group['betas']
+        t = self.state[flat.params[0]]['t'] + 1
+        for p in flat.params:
+            self.state[p]['t'] = t
+
+        flat.m.mul_(beta1).add_(flat.grad, alpha=1 - beta1)
+        flat.v.mul_(beta2).addcmul_(flat.grad, flat.grad, value=1 - beta2)
+        torch.div(flat.v, 1 - beta2 ** t, out=flat.denominator)
+        flat.denominator.sqrt_().add_(group['eps'])
+        flat.param.addcdiv_(flat.m, flat.denominator, value=-group['lr'] / (1 - beta1 ** t))
+        if group['weight_decay']:
+            flat.param.mul_(1 - group['lr'] * group['weight_decay'])
@@ -0,0 +1,195 @@
+'''
+Dynamic int8 quantization of trained classifiers for CPU inference.
+
+Running e.g.
+
+    python quantize.py --model multitask --filepath pretrain-10-1e-05-multitask.pt --out multitask-int8.pt
+
+quantizes every nn.Linear of a trained MultitaskBERT (or BertSentimentClassifier with --model sst)
+to int8 weights with dynamically quantized activations, saves the quantized module, and reports the
+accuracy delta on the dev sets as well as latency and throughput against the fp32 model.
+
+The quantized module is saved as a whole, so load_model (used by test_multitask / classifier.test,
+which accept the saved file in place of a checkpoint) neither re-quantizes nor loads pretrained BERT
+weights at startup. The report is computed on the model reloaded through load_model, so every run also
+checks the save -> load -> eval round trip that testing goes through.
+'''
+
+import argparse
+import copy
+import io
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic
+from torch.utils.data import DataLoader
+
+
+def quantize_model(model):
+    '''int8 copy of `model` for CPU inference: nn.Linear weights are quantized, activations dynamically.'''
+    if getattr(model, 'embedding_cache', None) is not None:
+        # It would serve cached fp32 BERT outputs instead of running the int8 layers (and get pickled along).
+        raise ValueError("Quantize a model built without embedding_cache_dir, see load_fp32")
+    return quantize_dynamic(model.cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized(model, config, filepath):
+    save_info = {
+        'model': model,
+        'model_config': config,
+        'quantized': True,
+    }
+
+    torch.save(save_info, filepath)
+    print(f"save the quantized model to {filepath}")
+
+
+def load_model(filepath, model_class):
+    '''
+    Model and config saved at `filepath`, in eval mode: either an int8 module written by save_quantized,
+    or a checkpoint written by save_model whose state dict is loaded into model_class(config).
+    '''
+    # Both formats pickle more than tensors (the config namespace, or the quantized module itself).
+    saved = torch.load(filepath, weights_only=False)
+    config = saved['model_config']
+    if saved.get('quantized', False):
+        model = saved['model']
+    else:
+        model = model_class(config)
+        model.load_state_dict(saved['model'])
+    return model.eval(), config
+
+
+def is_quantized(model):
+    '''Whether `model` has int8 layers from quantize_model; their kernels take fp32 activations only.'''
+    return any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules())
+
+
+def model_class(args):
+    if args.model == 'multitask':
+        from multitask_classifier import MultitaskBERT
+        return MultitaskBERT
+    from classifier import BertSentimentClassifier
+    return BertSentimentClassifier
+
+
+def load_fp32(args):
+    saved = torch.load(args.filepath, weights_only=False)
+    if saved.get('quantized', False):
+        raise ValueError(f"{args.filepath} is already quantized")
+    # Both the fp32 baseline and the quantized model run BERT itself rather than serving the outputs of
+    # an embedding cache the checkpoint was trained with.
+    config = copy.copy(saved['model_config'])
+    config.embedding_cache_dir = None
+    model = model_class(args)(config)
+    model.load_state_dict(saved['model'])
+    return model.eval(), config
+
+
+def model_size_mb(model):
+    '''Size of the serialized state dict.'''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2 ** 20
+
+
+def sentence_latency(predict, dataloader, num_sentences):
+    '''Median latency (ms) of predicting single sentences, over the first num_sentences of dataloader.'''
+    timings = []
+    for batch in dataloader:
+        for ids, mask in zip(batch['token_ids'], batch['attention_mask']):
+            length = int(mask.sum())
+            ids, mask = ids[None, :length], mask[None, :length]
+            start = time.perf_counter()
+            predict(ids, mask)
+            timings.append(time.perf_counter() - start)
+            if len(timings) == num_sentences:
+                return 1000 * float(np.median(timings))
+    return 1000 * float(np.median(timings))
+
+
+def dev_loaders(args):
+    if args.model == 'multitask':
+        from datasets import SentenceClassificationDataset, SentencePairDataset, load_multitask_data
+        sst_dev_data, _, para_dev_data, sts_dev_data = \
+            load_multitask_data(args.sst_dev, args.para_dev, args.sts_dev, split='dev')
+        datasets = (SentenceClassificationDataset(sst_dev_data, args),
+                    SentencePairDataset(para_dev_data, args),
+                    SentencePairDataset(sts_dev_data, args, isRegression=True))
+    else:
+        from classifier import SentimentDataset, load_data
+        datasets = (SentimentDataset(load_data(args.sst_dev, 'valid'), args),)
+    return [DataLoader(dataset, shuffle=False, batch_size=args.batch_size, collate_fn=dataset.collate_fn)
+            for dataset in datasets]
+
+
+def evaluate(model, loaders, args):
+    '''Dev metrics by task, number of dev examples per second and single-sentence latency of `model`.'''
+    device = torch.device('cpu')
+    with torch.no_grad():
+        start = time.perf_counter()
+        if args.model == 'multitask':
+            from evaluation import model_eval_multitask
+            sst_acc, _, _, para_acc, _, _, sts_corr, _, _ = model_eval_multitask(*loaders, model, device)
+            metrics = {'sst dev acc': sst_acc, 'para dev acc': para_acc, 'sts dev corr': sts_corr}
+            predict = model.predict_sentiment
+        else:
+            from classifier import model_eval
+            acc, f1, *_ = model_eval(loaders[0], model, device)
+            metrics = {'sst dev acc': acc, 'sst dev f1': f1}
+            predict = model
+        elapsed = time.perf_counter() - start
+        throughput = sum(len(loader.dataset) for loader in loaders) / elapsed
+        latency = sentence_latency(predict, loaders[0], args.latency_sentences)
+    return metrics, throughput, latency
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, choices=('multitask', 'sst'), default='multitask',
+                        help='multitask: a MultitaskBERT checkpoint; sst: a BertSentimentClassifier checkpoint')
+    parser.add_argument("--filepath", type=str, required=True, help='fp32 checkpoint written by save_model')
+    parser.add_argument("--out", type=str, default=None, help="defaults to the checkpoint path with an '-int8' suffix")
+
+    parser.add_argument("--sst_dev", type=str, default="data/ids-sst-dev.csv")
+    parser.add_argument("--para_dev", type=str, default="data/quora-dev.csv")
+    parser.add_argument("--sts_dev", type=str, default="data/sts-dev.csv")
+
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--latency_sentences", type=int, default=200,
+                        help='number of single SST sentences timed for the latency report')
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--skip_report", action='store_true', help='only quantize and save')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.out is None:
+        args.out = args.filepath[:-3] + '-int8.pt' if args.filepath.endswith('.pt') else args.filepath + '-int8'
+
+    model, config = load_fp32(args)
+    save_quantized(quantize_model(model), config, args.out)
+
+    if not args.skip_report:
+        # Report on the model reloaded the way test_multitask / classifier.test load it, i.e. exactly
+        # what inference will run.
+        quantized, _ = load_model(args.out, model_class(args))
+        loaders = dev_loaders(args)
+        fp32_metrics, fp32_throughput, fp32_latency = evaluate(model, loaders, args)
+        int8_metrics, int8_throughput, int8_latency = evaluate(quantized, loaders, args)
+
+        print(f"model size :: fp32 {model_size_mb(model) :.1f} MB, int8 {model_size_mb(quantized) :.1f} MB")
+        for name in fp32_metrics:
+            print(f"{name} :: fp32 {fp32_metrics[name] :.3f}, int8 {int8_metrics[name] :.3f}, "
+                  f"delta {int8_metrics[name] - fp32_metrics[name] :+.3f}")
+        print(f"dev throughput :: fp32 {fp32_throughput :.1f} examples/s, int8 {int8_throughput :.1f} examples/s, "
+              f"speedup {int8_throughput / fp32_throughput :.2f}x")
+        print(f"single sentence latency (median) :: fp32 {fp32_latency :.2f} ms, int8 {int8_latency :.2f} ms, "
+              f"speedup {fp32_latency / int8_latency :.2f}x")
@@ -0,0 +1,92 @@
+'''
+Parity checks for the BertModel execution modes, run with `pytest test_bert.py`.
+
+The attention backends, the unpadded mode and sentence packing all mask padding through the same extended
+attention mask; each is compared against the reference backend on a small randomly initialized model.
+'''
+
+import numpy as np
+import pytest
+import torch
+
+from bert import BertModel
+from config import BertConfig
+from datasets import pack_sentences
+
+
+PAD, CLS, SEP = 0, 1, 2
+
+
+def make_model(**options):
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                        intermediate_size=64, max_position_embeddings=64, pad_token_id=PAD)
+    for name, value in options.items():
+        setattr(config, name, value)
+    return BertModel(config).eval()
+
+
+def sentences(lengths, seed=0):
+    '''"[CLS] x [SEP]" token id rows of the given total lengths; a length of 1 is a lone [CLS].'''
+    rng = np.random.RandomState(seed)
+    rows = []
+    for length in lengths:
+        row = [CLS] + rng.randint(3, 100, size=max(length - 2, 0)).tolist() + [SEP] * (length > 1)
+        rows.append(np.array(row, dtype=np.int64))
+    return rows
+
+
+def right_padded(rows):
+    input_ids = torch.full((len(rows), max(len(row) for row in rows)), PAD, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, row in enumerate(rows):
+        input_ids[i, :len(row)] = torch.from_numpy(row)
+        attention_mask[i, :len(row)] = 1
+    return input_ids, attention_mask
+
+
+# Right-padded batch with a row where only [CLS] is unmasked, a row without padding and a row that is
+# mostly padding.
+LENGTHS = [1, 17, 5, 2, 12]
+
+
+@pytest.mark.parametrize('attention_backend,unpadded', [('sdpa', False), ('reference', True), ('sdpa', True)])
+def test_matches_reference_attention_on_padded_batches(attention_backend, unpadded):
+    reference = make_model()
+    model = make_model(attention_backend=attention_backend, unpadded=unpadded)
+    input_ids, attention_mask = right_padded(sentences(LENGTHS))
+    with torch.no_grad():
+        expected = reference(input_ids, attention_mask)
+        actual = model(input_ids, attention_mask)
+
+    real = attention_mask.bool()
+    torch.testing.assert_close(actual['last_hidden_state'][real], expected['last_hidden_state'][real],
+                               rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(actual['pooler_output'], expected['pooler_output'], rtol=1e-5, atol=1e-5)
+    assert torch.isfinite(actual['last_hidden_state']).all()
+
+
+def test_padding_does_not_change_real_tokens():
+    model = make_model()
+    rows = sentences(LENGTHS)
+    input_ids, attention_mask = right_padded(rows)
+    with torch.no_grad():
+        batched = model(input_ids, attention_mask)['last_hidden_state']
+        for i, row in enumerate(rows):
+            alone = model(*right_padded([row]))['last_hidden_state'][0]
+            torch.testing.assert_close(batched[i, :len(row)], alone, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('attention_backend,unpadded', [('reference', False), ('sdpa', False), ('sdpa', True)])
+def test_packed_sentences_match_unpacked(attention_backend, unpadded):
+    reference = make_model()
+    model = make_model(attention_backend=attention_backend, unpadded=unpadded)
+    rows = sentences(LENGTHS + [9, 3, 30])
+    token_ids, attention_mask, position_ids, cls_positions = pack_sentences(rows, PAD, pack_length=32)
+    with torch.no_grad():
+        expected = reference(*right_padded(rows))['pooler_output']
+        packed = model(token_ids, attention_mask, position_ids=position_ids, cls_positions=cls_positions)
+
+    torch.testing.assert_close(packed['pooler_output'], expected, rtol=1e-5, atol=1e-5)
+    # Padding at the end of packed rows is masked from everything, including itself.
+    assert torch.isfinite(packed['last_hidden_state']).all()
@@ -0,0 +1,123 @@
+'''
+Equivalence checks for the AdamW update variants, run with `pytest test_optimizer.py`.
+
+The foreach and flat updates must match the per-parameter loop; compressed moments must stay close to it;
+and training resumed from a saved state dict must continue exactly like an uninterrupted run.
+'''
+
+import io
+
+import pytest
+import torch
+from torch import nn
+
+from optimizer import AdamW, dequantize_blockwise, quantize_blockwise
+
+
+STEPS = 6
+OPTIONS = {
+    'loop': dict(),
+    'foreach': dict(foreach=True),
+    'flat': dict(flatten=True),
+    'bfloat16': dict(state_dtype='bfloat16'),
+    'int8': dict(state_dtype='int8'),
+}
+
+
+def make_model(dtype=torch.float32):
+    torch.manual_seed(0)
+    # The 300 x 7 weight spans several quantization blocks, the last one partially.
+    return nn.Sequential(nn.Linear(7, 300), nn.Tanh(), nn.Linear(300, 3)).to(dtype)
+
+
+def batches(steps):
+    generator = torch.Generator().manual_seed(1)
+    return [(torch.randn(16, 7, generator=generator), torch.randn(16, 3, generator=generator)) for _ in range(steps)]
+
+
+def train(model, optimizer, data):
+    for x, y in data:
+        optimizer.zero_grad()
+        loss = ((model(x.to(next(model.parameters()).dtype)) - y) ** 2).mean()
+        loss.backward()
+        optimizer.step()
+    return [p.detach().float().clone() for p in model.parameters()]
+
+
+def run(option, steps=STEPS, dtype=torch.float32):
+    model = make_model(dtype)
+    optimizer = AdamW(model.parameters(), lr=1e-2, weight_decay=0.01, **OPTIONS[option])
+    return train(model, optimizer, batches(steps))
+
+
+@pytest.mark.parametrize('option', ['foreach', 'flat'])
+def test_matches_loop_update(option):
+    for actual, expected in zip(run(option), run('loop')):
+        torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+# bf16 keeps 8 bits of mantissa; the 8-bit codes are up to ~7% apart (see test_blockwise_quantization_error),
+# on both m and sqrt(v).
+@pytest.mark.parametrize('option,tolerance', [('bfloat16', 2e-2), ('int8', 1e-1)])
+def test_compressed_moments_stay_close_to_loop_update(option, tolerance):
+    initial = [p.detach().clone() for p in make_model().parameters()]
+    for actual, expected, start in zip(run(option), run('loop'), initial):
+        # Relative to the size of the update since initialization.
+        error = (actual - expected).norm() / (expected - start).norm()
+        assert error < tolerance
+
+
+@pytest.mark.parametrize('signed', [True, False])
+def test_blockwise_quantization_error(signed):
+    torch.manual_seed(0)
+    values = torch.randn(1000) * torch.logspace(-4, 0, 1000)
+    if not signed:
+        values = values.abs()
+    codes, absmax = quantize_blockwise(values, signed)
+    restored = dequantize_blockwise(codes, absmax, values.shape, signed)
+    block_absmax = absmax.repeat_interleave(256)[:len(values)]
+    # Neighbouring codes are 10 ** (7 / 126) apart, so rounding on the log scale costs at most ~7%.
+    assert ((restored - values).abs() <= 0.07 * values.abs() + 1e-7 * block_absmax).all()
+
+
+@pytest.mark.parametrize('option', list(OPTIONS))
+def test_resume_from_state_dict(option):
+    expected = run(option)
+
+    model = make_model()
+    optimizer = AdamW(model.parameters(), lr=1e-2, weight_decay=0.01, **OPTIONS[option])
+    data = batches(STEPS)
+    train(model, optimizer, data[:STEPS // 2])
+    buffer = io.BytesIO()
+    torch.save({'model': model.state_dict(), 'optim': optimizer.state_dict()}, buffer)
+    buffer.seek(0)
+    saved = torch.load(buffer)
+
+    resumed = make_model()
+    resumed.load_state_dict(saved['model'])
+    optimizer = AdamW(resumed.parameters(), lr=1e-2, weight_decay=0.01, **OPTIONS[option])
+    optimizer.load_state_dict(saved['optim'])
+    actual = train(resumed, optimizer, data[STEPS // 2:])
+
+    for a, e in zip(actual, expected):
+        torch.testing.assert_close(a, e, rtol=0, atol=0)
+
+
+def test_resume_keeps_fp32_master_weights_of_bf16_parameters():
+    expected = run('loop', dtype=torch.bfloat16)
+
+    model = make_model(torch.bfloat16)
+    optimizer = AdamW(model.parameters(), lr=1e-2, weight_decay=0.01)
+    data = batches(STEPS)
+    train(model, optimizer, data[:STEPS // 2])
+    state_dict = optimizer.state_dict()
+
+    resumed = make_model(torch.bfloat16)
+    resumed.load_state_dict(model.state_dict())
+    optimizer = AdamW(resumed.parameters(), lr=1e-2, weight_decay=0.01)
+    optimizer.load_state_dict(state_dict)
+    assert all(state['master'].dtype == torch.float32 for state in optimizer.state.values())
+    actual = train(resumed, optimizer, data[STEPS // 2:])
+
+    for a, e in zip(actual, expected):
+        torch.testing.assert_close(a, e, rtol=0, atol=0)
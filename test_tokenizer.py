@@ -0,0 +1,187 @@
+'''
+Equivalence checks for the tokenizer fast paths, run with `pytest test_tokenizer.py`.
+
+The tokenizers are built on a small fixture vocabulary, so no pretrained files are downloaded.
+'''
+
+import random
+import sys
+
+import pytest
+from hypothesis import given, settings, strategies as st
+
+from tokenizer import (BasicTokenizer, BertTokenizer, BertTokenizerFast, ReferenceBasicTokenizer,
+                       TrieWordpieceTokenizer, WordpieceTokenizer)
+
+
+VOCAB = [
+    '[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]',
+    'the', 'a', 'un', 'want', 'wanted', 'running', 'run', 'movie', 'good', 'bad', 'great', 'film', 'is',
+    '##s', '##ed', '##ing', '##ning', '##n', '##able', '##aff', '##ff', '##a', '##b', '##e', '####', '##',
+    'a', 'b', 'c', 'd', 'e', 'f', 'n', 'r', 'u', 'w', '#', '##c', '##d', '##u', '##w', '##r',
+    '.', ',', '!', '?', "'", '-', '(', ')', '中', '国', 'é', 'ü', '0', '1', '##0', '##1',
+]
+
+# Characters random strings are drawn from: vocab characters, characters missing from the vocab,
+# accents, CJK, control characters and several kinds of whitespace.
+ALPHABET = 'abcdefnruw#0123.,!?\'-()中国日éüÉǺ­\x00\t\n　 '
+
+
+@pytest.fixture(scope='module')
+def vocab_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp('vocab') / 'vocab.txt'
+    path.write_text(''.join(token + '\n' for token in VOCAB), encoding='utf-8')
+    return str(path)
+
+
+def random_texts(count, seed=0, max_length=40):
+    rng = random.Random(seed)
+    words = [token for token in VOCAB if not token.startswith('[')]
+    texts = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 8)):
+            if rng.random() < 0.5:
+                parts.append(rng.choice(words) + rng.choice(words).lstrip('#'))
+            else:
+                parts.append(''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, max_length // 4))))
+        texts.append(rng.choice(['', ' ', '  ']).join(parts))
+    return texts
+
+
+EDGE_CASES = [
+    '',
+    ' ',
+    '#',
+    '##',
+    '###',
+    '####s',
+    'unwanted running',
+    'unwantedly',
+    'a' * 100,
+    'a' * 101,
+    'ab' * 60,
+    'x',
+    'the [UNK] movie',
+    '中国 movie',
+    'Éé ÜÜ',
+    'unaffable',
+    'f' * 99 + '#',
+]
+
+
+@pytest.mark.parametrize('text', EDGE_CASES + random_texts(500))
+def test_trie_wordpiece_matches_greedy(text):
+    vocab = {token: index for index, token in enumerate(VOCAB)}
+    greedy = WordpieceTokenizer(vocab=vocab, unk_token='[UNK]')
+    trie = TrieWordpieceTokenizer(vocab=vocab, unk_token='[UNK]')
+    assert trie.tokenize(text) == greedy.tokenize(text)
+
+
+@pytest.mark.parametrize('do_lower_case', [True, False])
+def test_bert_tokenizer_trie_engine_matches_greedy(vocab_file, do_lower_case):
+    greedy = BertTokenizer(vocab_file, do_lower_case=do_lower_case, wordpiece_engine='greedy', wordpiece_cache_size=0)
+    trie = BertTokenizer(vocab_file, do_lower_case=do_lower_case, wordpiece_engine='trie')
+    for text in EDGE_CASES + random_texts(500, seed=1):
+        assert trie.tokenize(text) == greedy.tokenize(text), repr(text)
+        assert trie.encode(text) == greedy.encode(text), repr(text)
+
+
+@pytest.mark.parametrize('add_special_tokens', [True, False])
+@pytest.mark.parametrize('pairs', [False, True])
+@pytest.mark.parametrize('padding_side', ['right', 'left'])
+def test_padded_tensor_batches_match_list_encoding(vocab_file, add_special_tokens, pairs, padding_side):
+    tokenizer = BertTokenizer(vocab_file, padding_side=padding_side)
+    texts = random_texts(16, seed=2)
+    text_pairs = random_texts(16, seed=3) if pairs else None
+    for padding, truncation, max_length, pad_to_multiple_of in [
+        (True, False, None, None),
+        (True, True, 8, None),
+        ('max_length', True, 12, None),
+        ('max_length', 'only_first', 40, 8),
+        (True, 'longest_first', 8, 4),
+    ]:
+        options = dict(add_special_tokens=add_special_tokens, padding=padding, truncation=truncation,
+                       max_length=max_length, pad_to_multiple_of=pad_to_multiple_of)
+        expected = tokenizer(texts, text_pairs, **options)
+        actual = tokenizer(texts, text_pairs, return_tensors='pt', **options)
+        assert set(actual.keys()) == set(expected.keys())
+        for key in expected:
+            assert actual[key].tolist() == expected[key], (key, options)
+
+
+# Any code point except surrogates, with the ASCII-only, BMP-only and mixed strings of the fast paths all likely.
+ANY_TEXT = st.one_of(
+    st.text(st.characters(max_codepoint=0x7F)),
+    st.text(st.characters(max_codepoint=0xFFFF, blacklist_categories=('Cs',))),
+    st.text(st.characters(blacklist_categories=('Cs',))),
+    st.text(st.sampled_from('aA .,!\u00e9\u0301\u4e2d\u3000\x00\ufffd\u200b\U00020000\U0001d400\U000e0001')),
+)
+BASIC_TOKENIZER_OPTIONS = [dict(do_lower_case=lower, strip_accents=strip, tokenize_chinese_chars=chinese)
+                           for lower in (True, False) for strip in (None, True, False) for chinese in (True, False)]
+
+
+@settings(max_examples=500, deadline=None)
+@given(ANY_TEXT)
+def test_basic_tokenizer_text_passes_match_per_character_reference(text):
+    fast, reference = BasicTokenizer(), ReferenceBasicTokenizer()
+    assert fast._clean_text(text) == reference._clean_text(text)
+    assert fast._tokenize_chinese_chars(text) == reference._tokenize_chinese_chars(text)
+    assert fast._run_split_on_punc(text) == reference._run_split_on_punc(text)
+    assert fast._run_strip_accents(text) == reference._run_strip_accents(text)
+
+
+@settings(max_examples=300, deadline=None)
+@given(ANY_TEXT, st.sampled_from(BASIC_TOKENIZER_OPTIONS))
+def test_basic_tokenizer_matches_per_character_reference(text, options):
+    assert BasicTokenizer(**options).tokenize(text) == ReferenceBasicTokenizer(**options).tokenize(text)
+
+
+def test_basic_tokenizer_character_tables_cover_every_code_point():
+    fast, reference = BasicTokenizer(), ReferenceBasicTokenizer()
+    code_points = [cp for cp in range(sys.maxunicode + 1) if not 0xD800 <= cp <= 0xDFFF]
+    for start in range(0, len(code_points), 4096):
+        # Separated by spaces, so every character is also seen on its own by the per-token passes.
+        text = ' '.join(chr(cp) for cp in code_points[start:start + 4096])
+        assert fast._clean_text(text) == reference._clean_text(text)
+        assert fast._tokenize_chinese_chars(text) == reference._tokenize_chinese_chars(text)
+        assert fast._run_split_on_punc(text) == reference._run_split_on_punc(text)
+        assert fast._run_strip_accents(text) == reference._run_strip_accents(text)
+
+
+def test_assigning_unique_no_split_tokens_rebuilds_the_split_regex(vocab_file):
+    # Without lowercasing, any set of no-split tokens is split on with the compiled regex.
+    tokenizer = BertTokenizer(vocab_file, do_lower_case=False)
+    reference = BertTokenizer(vocab_file, do_lower_case=False)
+    text = 'the movie[MASK]wanted good film,bad'
+    tokenizer.unique_no_split_tokens = ['[MASK]']
+    assert tokenizer.tokenize(text) == ['the', 'movie', '[MASK]', 'wanted', 'good', 'film', ',', 'bad']
+
+    for tokens in (['goodfilm'], ['film,bad', 'wanted'], ['[MASK]', 'movie[MASK]'], []):
+        tokenizer.unique_no_split_tokens = tokens
+        reference.unique_no_split_tokens = tokens
+        # Splits on the no-split tokens one by one instead of with the compiled regex.
+        reference._no_split_tokens_regex = False
+        assert tokenizer.tokenize(text) == reference.tokenize(text), tokens
+
+
+@pytest.mark.parametrize('add_special_tokens', [True, False])
+@pytest.mark.parametrize('truncation', ['longest_first', 'only_first', 'only_second'])
+def test_fast_tokenizer_matches_slow_on_pairs(vocab_file, add_special_tokens, truncation):
+    slow = BertTokenizer(vocab_file)
+    fast = BertTokenizerFast(vocab_file)
+    # Long and empty sequences on either side, so only_first/only_second often cannot truncate enough.
+    texts = random_texts(32, seed=4) + ['', 'the movie is good', 'a' * 20 + ' b c d e f']
+    text_pairs = random_texts(32, seed=5) + ['unwanted running a b c d e', '', 'bad']
+    for padding, max_length in [(False, 6), (False, 12), (True, 10), ('max_length', 16)]:
+        options = dict(add_special_tokens=add_special_tokens, padding=padding, truncation=truncation,
+                       max_length=max_length)
+        assert fast(texts, text_pairs, **options) == slow(texts, text_pairs, **options), options
+        # (An empty input on its own is returned unpadded by PreTrainedTokenizerBase.pad.)
+        for text, text_pair in zip(texts, text_pairs):
+            if not add_special_tokens and not slow.tokenize(text) and not slow.tokenize(text_pair):
+                continue
+            assert fast(text, text_pair, **options) == slow(text, text_pair, **options), (text, text_pair, options)
+    # Without truncation the type ids of pairs without special tokens come from the same wrapper code.
+    assert (fast(texts, text_pairs, add_special_tokens=add_special_tokens, padding=True)
+            == slow(texts, text_pairs, add_special_tokens=add_special_tokens, padding=True))
@@ -4,6 +4,7 @@ import os
 import re
 import unicodedata
 import itertools
+import functools
 import requests
 import copy
 import json
@@ -159,6 +160,71 @@ def _is_control(char):
   return False
 
 
+# Character classes used by BasicTokenizer. They are looked up in a table for the Basic Multilingual Plane and
+# computed (and cached) per code point above it.
+_CHAR_DROP = 1  # removed by _clean_text: NUL, U+FFFD and control characters
+_CHAR_WHITESPACE = 2  # replaced by a space in _clean_text
+_CHAR_PUNCTUATION = 4
+_CHAR_NONSPACING_MARK = 8  # "Mn", removed by _run_strip_accents
+_BMP_SIZE = 0x10000
+
+# Split of an ASCII string into single punctuation characters and runs of anything else (see _is_punctuation).
+_ASCII_PUNCTUATION_SPLIT_RE = re.compile(r"[!-/:-@\[-`{-~]|[^!-/:-@\[-`{-~]+")
+
+# The code point ranges of BasicTokenizer._is_chinese_char.
+_CHINESE_CHAR_RE = re.compile(
+  "([\u4e00-\u9fff\u3400-\u4dbf\U00020000-\U0002a6df\U0002a700-\U0002b73f\U0002b740-\U0002b81f"
+  "\U0002b820-\U0002ceaf\uf900-\ufaff\U0002f800-\U0002fa1f])"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _char_flags(cp):
+  char = chr(cp)
+  flags = 0
+  if cp == 0 or cp == 0xFFFD or _is_control(char):
+    flags |= _CHAR_DROP
+  if _is_whitespace(char):
+    flags |= _CHAR_WHITESPACE
+  if _is_punctuation(char):
+    flags |= _CHAR_PUNCTUATION
+  if unicodedata.category(char) == "Mn":
+    flags |= _CHAR_NONSPACING_MARK
+  return flags
+
+
+class _BMPCharTables(NamedTuple):
+  flags: bytes  # _CHAR_* flags of every code point below 0x10000
+  clean: Dict[int, Optional[str]]  # str.translate table of _clean_text
+  strip_marks: Dict[int, None]  # str.translate table dropping "Mn" characters
+  punctuation_split: "re.Pattern"  # _ASCII_PUNCTUATION_SPLIT_RE for any BMP string
+
+
+@functools.lru_cache(maxsize=None)
+def _bmp_char_tables():
+  """Built on first use (~0.1s), then shared by all tokenizers of the process and by forked workers."""
+  flags = bytes(_char_flags(cp) for cp in range(_BMP_SIZE))
+  clean = {}
+  strip_marks = {}
+  punctuation = []
+  for cp, f in enumerate(flags):
+    if f & _CHAR_DROP:
+      clean[cp] = None
+    elif f & _CHAR_WHITESPACE:
+      clean[cp] = " "
+    if f & _CHAR_NONSPACING_MARK:
+      strip_marks[cp] = None
+    if f & _CHAR_PUNCTUATION:
+      punctuation.append(re.escape(chr(cp)))
+  punctuation = "".join(punctuation)
+  punctuation_split = re.compile("[{0}]|[^{0}]+".format(punctuation))
+  return _BMPCharTables(flags, clean, strip_marks, punctuation_split)
+
+
+def _is_bmp(text):
+  return not text or max(text) < "\U00010000"
+
+
 def load_vocab(vocab_file):
   vocab = collections.OrderedDict()
   with open(vocab_file, "r", encoding="utf-8") as reader:
@@ -169,6 +235,78 @@ def load_vocab(vocab_file):
   return vocab
 
 
+class LRUCache(object):
+  """
+  Bounded least-recently-used mapping with hit/miss/eviction counters. A ``maxsize`` of 0 disables caching.
+
+  Entries are not pickled: each DataLoader worker (or any other unpickled copy) starts with an empty cache and
+  fresh counters, so workers never share or ship cached state.
+  """
+
+  def __init__(self, maxsize):
+    if maxsize < 0:
+      raise ValueError("Invalid cache size: {} - should be >= 0".format(maxsize))
+    self.maxsize = maxsize
+    self.clear()
+
+  def clear(self):
+    self._data = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    value = self._data.get(key)
+    if value is None:
+      self.misses += 1
+      return None
+    self._data.move_to_end(key)
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    if not self.maxsize:
+      return
+    self._data[key] = value
+    self._data.move_to_end(key)
+    if len(self._data) > self.maxsize:
+      self._data.popitem(last=False)
+      self.evictions += 1
+
+  def info(self) -> Dict[str, int]:
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+      "size": len(self._data),
+      "maxsize": self.maxsize,
+    }
+
+  def __len__(self):
+    return len(self._data)
+
+  def __getstate__(self):
+    return {"maxsize": self.maxsize}
+
+  def __setstate__(self, state):
+    self.maxsize = state["maxsize"]
+    self.clear()
+
+
+def _lower_per_char(text):
+  # str.lower() turns a word-final capital sigma into "ς"; lowercasing character by character gives "σ".
+  return text.replace("\u03a3", "\u03c3").lower()
+
+
+def _tokens_overlap(tokens):
+  """Whether one token contains another or ends with the beginning of another, so the order of splits matters."""
+  for a in tokens:
+    for b in tokens:
+      if a != b and (b in a or any(a.endswith(b[:k]) for k in range(1, min(len(a), len(b))))):
+        return True
+  return False
+
+
 def whitespace_tokenize(text):
   text = text.strip()
   if not text:
@@ -177,6 +315,40 @@ def whitespace_tokenize(text):
   return tokens
 
 
+# (function, items) of the running _map_in_forked_processes; forked workers inherit it instead of receiving the
+# tokenizer and the texts with every task.
+_FORKED_MAP_STATE = None
+
+
+def _map_shard(bounds):
+  function, items = _FORKED_MAP_STATE
+  return [function(item) for item in items[bounds[0]:bounds[1]]]
+
+
+def _map_in_forked_processes(function, items, num_proc):
+  """
+  ``[function(item) for item in items]`` computed by ``num_proc`` forked processes, in input order. ``function``
+  (with the tokenizer and its vocabulary) and ``items`` are shared copy-on-write through fork; only the shard
+  bounds and the results are pickled.
+  """
+  global _FORKED_MAP_STATE
+  import multiprocessing
+
+  if "fork" not in multiprocessing.get_all_start_methods():
+    raise ValueError("num_proc > 1 needs the 'fork' start method, which is not available on this platform")
+  num_proc = min(num_proc, len(items))
+  # A few shards per process, so processes that finish early take over work of the others.
+  shard_size = -(-len(items) // (4 * num_proc))
+  bounds = [(start, min(start + shard_size, len(items))) for start in range(0, len(items), shard_size)]
+  _FORKED_MAP_STATE = (function, items)
+  try:
+    with multiprocessing.get_context("fork").Pool(num_proc) as pool:
+      shards = pool.map(_map_shard, bounds, chunksize=1)
+  finally:
+    _FORKED_MAP_STATE = None
+  return list(itertools.chain.from_iterable(shards))
+
+
 class BatchEncoding(UserDict):
   def __init__(
     self,
@@ -576,34 +748,42 @@ class SpecialTokensMixin:
   @bos_token.setter
   def bos_token(self, value):
     self._bos_token = value
+    self._no_split_tokens_regex = None
 
   @eos_token.setter
   def eos_token(self, value):
     self._eos_token = value
+    self._no_split_tokens_regex = None
 
   @unk_token.setter
   def unk_token(self, value):
     self._unk_token = value
+    self._no_split_tokens_regex = None
 
   @sep_token.setter
   def sep_token(self, value):
     self._sep_token = value
+    self._no_split_tokens_regex = None
 
   @pad_token.setter
   def pad_token(self, value):
     self._pad_token = value
+    self._no_split_tokens_regex = None
 
   @cls_token.setter
   def cls_token(self, value):
     self._cls_token = value
+    self._no_split_tokens_regex = None
 
   @mask_token.setter
   def mask_token(self, value):
     self._mask_token = value
+    self._no_split_tokens_regex = None
 
   @additional_special_tokens.setter
   def additional_special_tokens(self, value):
     self._additional_special_tokens = value
+    self._no_split_tokens_regex = None
 
   @property
   def bos_token_id(self) -> Optional[int]:
@@ -1430,8 +1610,13 @@ class PreTrainedTokenizerBase(SpecialTokensMixin):
     return_offsets_mapping: bool = False,
     return_length: bool = False,
     verbose: bool = True,
+    num_proc: Optional[int] = None,
     **kwargs
   ) -> BatchEncoding:
+    """
+    Tokenizes and prepares a batch of sequences or sequence pairs. With ``num_proc`` > 1 the texts are tokenized
+    by that many forked processes (see :meth:`PreTrainedTokenizer._batch_encode_plus`); the result is the same.
+    """
     # Backward compatibility for 'truncation_strategy', 'pad_to_max_length'
     padding_strategy, truncation_strategy, max_length, kwargs = self._get_padding_truncation_strategies(
       padding=padding,
@@ -1459,6 +1644,7 @@ class PreTrainedTokenizerBase(SpecialTokensMixin):
       return_offsets_mapping=return_offsets_mapping,
       return_length=return_length,
       verbose=verbose,
+      num_proc=num_proc,
       **kwargs,
     )
 
@@ -1487,6 +1673,7 @@ class PreTrainedTokenizerBase(SpecialTokensMixin):
     return_offsets_mapping: bool = False,
     return_length: bool = False,
     verbose: bool = True,
+    num_proc: Optional[int] = None,
     **kwargs
   ) -> BatchEncoding:
     raise NotImplementedError
@@ -1960,6 +2147,22 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
     self.added_tokens_encoder: Dict[str, int] = {}
     self.added_tokens_decoder: Dict[int, str] = {}
     self.unique_no_split_tokens: List[str] = []
+    # (compiled alternation of unique_no_split_tokens or None, lowercasing allowed in the same pass), or None while
+    # it has to be rebuilt. False if tokenize has to split on the tokens one by one (see _compile_no_split_tokens_regex).
+    self._no_split_tokens_regex = None
+
+  @property
+  def unique_no_split_tokens(self) -> List[str]:
+    """
+    :obj:`List[str]`: Tokens ``tokenize`` never splits. Assign a new list to change them (the compiled split regex
+    is rebuilt on assignment, not on in-place changes).
+    """
+    return self._unique_no_split_tokens
+
+  @unique_no_split_tokens.setter
+  def unique_no_split_tokens(self, value):
+    self._unique_no_split_tokens = value
+    self._no_split_tokens_regex = None
 
   @property
   def is_fast(self) -> bool:
@@ -2065,15 +2268,23 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
     Returns:
         :obj:`List[str]`: The list of tokens.
     """
+    text, kwargs = self.prepare_for_tokenization(text, **kwargs)
+    lower = hasattr(self, "do_lower_case") and self.do_lower_case
+
+    if self._no_split_tokens_regex is None:
+      self._no_split_tokens_regex = self._compile_no_split_tokens_regex()
+    if self._no_split_tokens_regex:
+      regex, lowercase_in_one_pass = self._no_split_tokens_regex
+      if lowercase_in_one_pass or not lower:
+        return self._split_on_no_split_tokens(text, regex, lower)
+
     # Simple mapping string => AddedToken for special tokens with specific tokenization behaviors
     all_special_tokens_extended = dict(
       (str(t), t) for t in self.all_special_tokens_extended if isinstance(t, AddedToken)
     )
 
-    text, kwargs = self.prepare_for_tokenization(text, **kwargs)
-
     # TODO: should this be in the base class?
-    if hasattr(self, "do_lower_case") and self.do_lower_case:
+    if lower:
       # convert non-special tokens to lowercase
       escaped_special_toks = [re.escape(s_tok) for s_tok in self.all_special_tokens]
       pattern = r"(" + r"|".join(escaped_special_toks) + r")|" + r"(.+?)"
@@ -2162,6 +2373,56 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
     tokenized_text = split_on_tokens(no_split_token, text)
     return tokenized_text
 
+  def _compile_no_split_tokens_regex(self):
+    """
+    Builds the single-pass splitter used by tokenize. Splitting on the no-split tokens one after the other is only
+    needed (False is returned) if one of them is an AddedToken with its own whitespace rules or the tokens overlap,
+    so that the order of the splits matters. Lowercasing can only be done in the same pass if it protects exactly
+    the tokens that are split on.
+    """
+    tokens = self.unique_no_split_tokens
+    added_tokens = set(str(t) for t in self.all_special_tokens_extended if isinstance(t, AddedToken))
+    if "" in tokens or added_tokens.intersection(tokens) or _tokens_overlap(tokens):
+      return False
+    regex = None
+    if tokens:
+      regex = re.compile("(" + "|".join(re.escape(t) for t in sorted(tokens, key=len, reverse=True)) + ")")
+    return regex, set(tokens) == set(self.all_special_tokens)
+
+  def _split_on_no_split_tokens(self, text, regex, lower):
+    """
+    Same result as the token-by-token split of tokenize: no-split tokens are kept as they are, whitespace next to
+    them is stripped and the text in between is lowercased (if ``lower``) and passed to _tokenize.
+    """
+    if not text.strip():
+      return []
+    # With one capturing group, re.split alternates between the text around tokens and the tokens themselves.
+    pieces = regex.split(text) if regex is not None else [text]
+    if lower:
+      lowered = []
+      for i, piece in enumerate(pieces):
+        if i % 2:
+          lowered.append(piece)
+        else:
+          # Lowercasing may spell out a token, e.g. "<S>" -> "<s>", which is then split on as well.
+          piece = _lower_per_char(piece)
+          lowered.extend(regex.split(piece) if regex is not None else [piece])
+      pieces = lowered
+
+    tokenized_text = []
+    last = len(pieces) - 1
+    for i, piece in enumerate(pieces):
+      if i % 2:
+        tokenized_text.append(piece)
+        continue
+      if i < last:
+        piece = piece.rstrip()
+      if i > 0:
+        piece = piece.lstrip()
+      if piece:
+        tokenized_text.extend(self._tokenize(piece))
+    return tokenized_text
+
   def _tokenize(self, text, **kwargs):
     """
     Converts a string in a sequence of tokens (string), using the tokenizer. Split in words for word-based
@@ -2302,6 +2563,7 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
     return_offsets_mapping: bool = False,
     return_length: bool = False,
     verbose: bool = True,
+    num_proc: Optional[int] = None,
     **kwargs
   ) -> BatchEncoding:
     def get_input_ids(text):
@@ -2330,8 +2592,7 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
         "transformers.PreTrainedTokenizerFast."
       )
 
-    input_ids = []
-    for ids_or_pair_ids in batch_text_or_text_pairs:
+    def get_input_ids_pair(ids_or_pair_ids):
       if not isinstance(ids_or_pair_ids, (list, tuple)):
         ids, pair_ids = ids_or_pair_ids, None
       elif is_split_into_words and not isinstance(ids_or_pair_ids[0], (list, tuple)):
@@ -2341,7 +2602,13 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
 
       first_ids = get_input_ids(ids)
       second_ids = get_input_ids(pair_ids) if pair_ids is not None else None
-      input_ids.append((first_ids, second_ids))
+      return first_ids, second_ids
+
+    if num_proc is not None and num_proc > 1 and len(batch_text_or_text_pairs) > 1:
+      # Tokenization is the serial bottleneck; padding and tensor conversion below stay in this process.
+      input_ids = _map_in_forked_processes(get_input_ids_pair, batch_text_or_text_pairs, num_proc)
+    else:
+      input_ids = [get_input_ids_pair(ids_or_pair_ids) for ids_or_pair_ids in batch_text_or_text_pairs]
 
     batch_outputs = self._batch_prepare_for_model(
       input_ids,
@@ -2386,6 +2653,25 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
     Args:
         batch_ids_pairs: list of tokenized input ids or input ids pairs
     """
+    if (
+      batch_ids_pairs
+      and return_tensors in ("pt", "np", TensorType.PYTORCH, TensorType.NUMPY)
+      and padding_strategy != PaddingStrategy.DO_NOT_PAD
+      and not (return_overflowing_tokens or return_special_tokens_mask or return_length)
+    ):
+      return self._batch_prepare_into_buffers(
+        batch_ids_pairs,
+        add_special_tokens=add_special_tokens,
+        padding_strategy=padding_strategy,
+        truncation_strategy=truncation_strategy,
+        max_length=max_length,
+        stride=stride,
+        pad_to_multiple_of=pad_to_multiple_of,
+        return_tensors=return_tensors,
+        return_token_type_ids=return_token_type_ids,
+        return_attention_mask=return_attention_mask,
+        verbose=verbose,
+      )
 
     batch_outputs = {}
     for first_ids, second_ids in batch_ids_pairs:
@@ -2425,6 +2711,97 @@ class PreTrainedTokenizer(PreTrainedTokenizerBase):
 
     return batch_outputs
 
+  def _batch_prepare_into_buffers(
+    self,
+    batch_ids_pairs: List[Union[PreTokenizedInputPair, Tuple[List[int], None]]],
+    add_special_tokens: bool = True,
+    padding_strategy: PaddingStrategy = PaddingStrategy.LONGEST,
+    truncation_strategy: TruncationStrategy = TruncationStrategy.DO_NOT_TRUNCATE,
+    max_length: Optional[int] = None,
+    stride: int = 0,
+    pad_to_multiple_of: Optional[int] = None,
+    return_tensors: Optional[str] = None,
+    return_token_type_ids: Optional[bool] = None,
+    return_attention_mask: Optional[bool] = None,
+    verbose: bool = True,
+  ) -> BatchEncoding:
+    """
+    Fast path of :meth:`_batch_prepare_for_model` for padded NumPy or PyTorch output. Each example is truncated
+    and written straight into int64 arrays of the final padded shape; PyTorch tensors share their memory. Gives
+    the same result as preparing, padding and converting every example separately.
+    """
+    if return_token_type_ids and not add_special_tokens:
+      raise ValueError(
+        "Asking to return token_type_ids while setting add_special_tokens to False "
+        "results in an undefined behavior. Please set add_special_tokens to True or "
+        "set return_token_type_ids to None."
+      )
+    if return_token_type_ids is None:
+      return_token_type_ids = "token_type_ids" in self.model_input_names
+    if return_attention_mask is None:
+      return_attention_mask = "attention_mask" in self.model_input_names
+    if self.padding_side not in ("right", "left"):
+      raise ValueError("Invalid padding strategy:" + str(self.padding_side))
+
+    sequences = []
+    for ids, pair_ids in batch_ids_pairs:
+      pair = pair_ids is not None
+      total_len = len(ids) + (len(pair_ids) if pair else 0)
+      total_len += self.num_special_tokens_to_add(pair=pair) if add_special_tokens else 0
+      if truncation_strategy != TruncationStrategy.DO_NOT_TRUNCATE and max_length and total_len > max_length:
+        ids, pair_ids, _ = self.truncate_sequences(
+          ids,
+          pair_ids=pair_ids,
+          num_tokens_to_remove=total_len - max_length,
+          truncation_strategy=truncation_strategy,
+          stride=stride,
+        )
+      if add_special_tokens:
+        sequence = self.build_inputs_with_special_tokens(ids, pair_ids)
+      else:
+        sequence = ids + pair_ids if pair else ids
+      self._eventual_warn_about_too_long_sequence(sequence, max_length, verbose)
+      sequences.append((ids, pair_ids, sequence))
+
+    lengths = np.fromiter((len(sequence) for _, _, sequence in sequences), dtype=np.int64, count=len(sequences))
+    padded_length = int(lengths.max()) if padding_strategy == PaddingStrategy.LONGEST else max_length
+    if pad_to_multiple_of is not None and padded_length % pad_to_multiple_of != 0:
+      padded_length = ((padded_length // pad_to_multiple_of) + 1) * pad_to_multiple_of
+    # As in _pad, sequences longer than the padding length are kept whole; that only gives a tensor if they all
+    # end up with the same length.
+    final_lengths = np.maximum(lengths, padded_length)
+    if final_lengths.min() != final_lengths.max():
+      raise ValueError(
+        "Unable to create tensor, you should probably activate truncation and/or padding "
+        "with 'padding=True' 'truncation=True' to have batched tensors with the same length."
+      )
+    padded_length = int(final_lengths.max())
+
+    input_ids = np.full((len(sequences), padded_length), self.pad_token_id, dtype=np.int64)
+    # Single sequences, and pairs without special tokens, have token type 0 throughout (see prepare_for_model).
+    token_type_ids = np.zeros((len(sequences), padded_length), dtype=np.int64)
+    right = self.padding_side == "right"
+    for row, (ids, pair_ids, sequence), length in zip(range(len(sequences)), sequences, lengths.tolist()):
+      columns = slice(0, length) if right else slice(padded_length - length, padded_length)
+      input_ids[row, columns] = sequence
+      if return_token_type_ids and add_special_tokens and pair_ids is not None:
+        token_type_ids[row, columns] = self.create_token_type_ids_from_sequences(ids, pair_ids)
+    positions = np.arange(padded_length)
+    real = positions < lengths[:, None] if right else positions >= padded_length - lengths[:, None]
+    if return_token_type_ids and self.pad_token_type_id != 0:
+      token_type_ids[~real] = self.pad_token_type_id
+
+    batch_outputs = {"input_ids": input_ids}
+    if return_token_type_ids:
+      batch_outputs["token_type_ids"] = token_type_ids
+    if return_attention_mask:
+      batch_outputs["attention_mask"] = real.astype(np.int64)
+    if TensorType(return_tensors) == TensorType.PYTORCH:
+      import torch
+
+      batch_outputs = {key: torch.from_numpy(value) for key, value in batch_outputs.items()}
+    return BatchEncoding(batch_outputs)
+
   def prepare_for_tokenization(
     self, text: str, is_split_into_words: bool = False, **kwargs
   ) -> Tuple[str, Dict[str, Any]]:
@@ -2565,6 +2942,8 @@ class BertTokenizer(PreTrainedTokenizer):
     mask_token="[MASK]",
     tokenize_chinese_chars=True,
     strip_accents=None,
+    wordpiece_engine="trie",
+    wordpiece_cache_size=65536,
     **kwargs
   ):
     super().__init__(
@@ -2578,8 +2957,14 @@ class BertTokenizer(PreTrainedTokenizer):
       mask_token=mask_token,
       tokenize_chinese_chars=tokenize_chinese_chars,
       strip_accents=strip_accents,
+      wordpiece_engine=wordpiece_engine,
+      wordpiece_cache_size=wordpiece_cache_size,
       **kwargs,
     )
+    if wordpiece_engine not in WORDPIECE_ENGINES:
+      raise ValueError(
+        f"Unknown wordpiece_engine '{wordpiece_engine}', please select one of {list(WORDPIECE_ENGINES.keys())}"
+      )
     self.vocab = load_vocab(vocab_file)
     self.ids_to_tokens = collections.OrderedDict([(ids, tok) for tok, ids in self.vocab.items()])
     self.do_basic_tokenize = do_basic_tokenize
@@ -2590,7 +2975,10 @@ class BertTokenizer(PreTrainedTokenizer):
         tokenize_chinese_chars=tokenize_chinese_chars,
         strip_accents=strip_accents,
       )
-    self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, unk_token=self.unk_token)
+    self.wordpiece_engine = wordpiece_engine
+    self.wordpiece_tokenizer = WORDPIECE_ENGINES[wordpiece_engine](vocab=self.vocab, unk_token=self.unk_token)
+    # Memoizes basic token -> wordpieces. A size of 0 disables the cache.
+    self.wordpiece_cache = LRUCache(wordpiece_cache_size)
 
   @property
   def do_lower_case(self):
@@ -2603,6 +2991,22 @@ class BertTokenizer(PreTrainedTokenizer):
   def get_vocab(self):
     return dict(self.vocab, **self.added_tokens_encoder)
 
+  @property
+  def wordpiece_cache_info(self) -> Dict[str, int]:
+    """
+    :obj:`Dict[str, int]`: Hit, miss and eviction counters of the word-level wordpiece cache.
+    """
+    return self.wordpiece_cache.info()
+
+  def _wordpiece_tokenize(self, token):
+    if not self.wordpiece_cache.maxsize:
+      return self.wordpiece_tokenizer.tokenize(token)
+    pieces = self.wordpiece_cache.get(token)
+    if pieces is None:
+      pieces = tuple(self.wordpiece_tokenizer.tokenize(token))
+      self.wordpiece_cache.put(token, pieces)
+    return pieces
+
   def _tokenize(self, text):
     split_tokens = []
     if self.do_basic_tokenize:
@@ -2612,7 +3016,7 @@ class BertTokenizer(PreTrainedTokenizer):
         if token in self.basic_tokenizer.never_split:
           split_tokens.append(token)
         else:
-          split_tokens += self.wordpiece_tokenizer.tokenize(token)
+          split_tokens += self._wordpiece_tokenize(token)
     else:
       split_tokens = self.wordpiece_tokenizer.tokenize(text)
     return split_tokens
@@ -2715,11 +3119,17 @@ class BasicTokenizer(object):
     return output_tokens
 
   def _run_strip_accents(self, text):
+    if text.isascii():
+      # ASCII is its own NFD and has no combining marks.
+      return text
     text = unicodedata.normalize("NFD", text)
+    if _is_bmp(text):
+      return text.translate(_bmp_char_tables().strip_marks)
+    flags = _bmp_char_tables().flags
     output = []
     for char in text:
-      cat = unicodedata.category(char)
-      if cat == "Mn":
+      cp = ord(char)
+      if (flags[cp] if cp < _BMP_SIZE else _char_flags(cp)) & _CHAR_NONSPACING_MARK:
         continue
       output.append(char)
     return "".join(output)
@@ -2727,13 +3137,16 @@ class BasicTokenizer(object):
   def _run_split_on_punc(self, text, never_split=None):
     if never_split is not None and text in never_split:
       return [text]
-    chars = list(text)
-    i = 0
+    if text.isascii():
+      return _ASCII_PUNCTUATION_SPLIT_RE.findall(text)
+    if _is_bmp(text):
+      return _bmp_char_tables().punctuation_split.findall(text)
+    flags = _bmp_char_tables().flags
     start_new_word = True
     output = []
-    while i < len(chars):
-      char = chars[i]
-      if _is_punctuation(char):
+    for char in text:
+      cp = ord(char)
+      if (flags[cp] if cp < _BMP_SIZE else _char_flags(cp)) & _CHAR_PUNCTUATION:
         output.append([char])
         start_new_word = True
       else:
@@ -2741,21 +3154,13 @@ class BasicTokenizer(object):
           output.append([])
         start_new_word = False
         output[-1].append(char)
-      i += 1
 
     return ["".join(x) for x in output]
 
   def _tokenize_chinese_chars(self, text):
-    output = []
-    for char in text:
-      cp = ord(char)
-      if self._is_chinese_char(cp):
-        output.append(" ")
-        output.append(char)
-        output.append(" ")
-      else:
-        output.append(char)
-    return "".join(output)
+    if text.isascii():
+      return text
+    return _CHINESE_CHAR_RE.sub(r" \1 ", text)
 
   def _is_chinese_char(self, cp):
     # This defines a "chinese character" as anything in the CJK Unicode block:
@@ -2780,6 +3185,73 @@ class BasicTokenizer(object):
 
     return False
 
+  def _clean_text(self, text):
+    if _is_bmp(text):
+      return text.translate(_bmp_char_tables().clean)
+    flags = _bmp_char_tables().flags
+    output = []
+    for char in text:
+      cp = ord(char)
+      f = flags[cp] if cp < _BMP_SIZE else _char_flags(cp)
+      if f & _CHAR_DROP:
+        continue
+      if f & _CHAR_WHITESPACE:
+        output.append(" ")
+      else:
+        output.append(char)
+    return "".join(output)
+
+
+class ReferenceBasicTokenizer(BasicTokenizer):
+  """
+  :class:`BasicTokenizer` with the original per-character implementations of its text passes, which look every
+  character up in :mod:`unicodedata`. Output is identical; it is kept as the reference the precomputed character
+  tables are checked against (see test_tokenizer.py).
+  """
+
+  def _run_strip_accents(self, text):
+    text = unicodedata.normalize("NFD", text)
+    output = []
+    for char in text:
+      cat = unicodedata.category(char)
+      if cat == "Mn":
+        continue
+      output.append(char)
+    return "".join(output)
+
+  def _run_split_on_punc(self, text, never_split=None):
+    if never_split is not None and text in never_split:
+      return [text]
+    chars = list(text)
+    i = 0
+    start_new_word = True
+    output = []
+    while i < len(chars):
+      char = chars[i]
+      if _is_punctuation(char):
+        output.append([char])
+        start_new_word = True
+      else:
+        if start_new_word:
+          output.append([])
+        start_new_word = False
+        output[-1].append(char)
+      i += 1
+
+    return ["".join(x) for x in output]
+
+  def _tokenize_chinese_chars(self, text):
+    output = []
+    for char in text:
+      cp = ord(char)
+      if self._is_chinese_char(cp):
+        output.append(" ")
+        output.append(char)
+        output.append(" ")
+      else:
+        output.append(char)
+    return "".join(output)
+
   def _clean_text(self, text):
     output = []
     for char in text:
@@ -2792,7 +3264,6 @@ class BasicTokenizer(object):
         output.append(char)
     return "".join(output)
 
-
 class WordpieceTokenizer(object):
   def __init__(self, vocab, unk_token, max_input_chars_per_word=100):
     self.vocab = vocab
@@ -2832,3 +3303,505 @@ class WordpieceTokenizer(object):
       else:
         output_tokens.extend(sub_tokens)
     return output_tokens
+
+
+class TrieWordpieceTokenizer(WordpieceTokenizer):
+  """
+  Same greedy longest-match-first algorithm as :class:`WordpieceTokenizer`, but the vocabulary is precompiled into
+  two prefix tries (word-initial pieces and ``##`` continuation pieces). Each piece is found by a single
+  left-to-right walk over the characters instead of probing the vocab with every candidate substring, so no
+  intermediate strings are built. Output is identical to :class:`WordpieceTokenizer`.
+  """
+
+  # Key under which a trie node stores the vocabulary token that ends at that node.
+  _TERMINAL = ""
+
+  def __init__(self, vocab, unk_token, max_input_chars_per_word=100):
+    super().__init__(vocab, unk_token, max_input_chars_per_word=max_input_chars_per_word)
+    self.prefix_trie = {}
+    self.suffix_trie = {}
+    for token in vocab:
+      # At the start of a word the reference implementation looks the raw substring up in the vocab, so every
+      # token (including "##" ones) is reachable from the prefix trie.
+      self._insert(self.prefix_trie, token, token)
+      if token.startswith("##") and len(token) > 2:
+        self._insert(self.suffix_trie, token[2:], token)
+
+  @classmethod
+  def _insert(cls, trie, key, token):
+    node = trie
+    for char in key:
+      node = node.setdefault(char, {})
+    node[cls._TERMINAL] = token
+
+  def _longest_match(self, trie, token, start):
+    node = trie
+    match, match_end = None, start
+    for end in range(start, len(token)):
+      node = node.get(token[end])
+      if node is None:
+        break
+      piece = node.get(self._TERMINAL)
+      if piece is not None:
+        match, match_end = piece, end + 1
+    return match, match_end
+
+  def tokenize(self, text):
+    output_tokens = []
+    for token in whitespace_tokenize(text):
+      if len(token) > self.max_input_chars_per_word:
+        output_tokens.append(self.unk_token)
+        continue
+
+      sub_tokens = []
+      start = 0
+      trie = self.prefix_trie
+      while start < len(token):
+        piece, start = self._longest_match(trie, token, start)
+        if piece is None:
+          sub_tokens = None
+          break
+        sub_tokens.append(piece)
+        trie = self.suffix_trie
+
+      if sub_tokens is None:
+        output_tokens.append(self.unk_token)
+      else:
+        output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+WORDPIECE_ENGINES = {
+  "greedy": WordpieceTokenizer,
+  "trie": TrieWordpieceTokenizer,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _dropped_chars_regex():
+  """
+  Character class (Oniguruma syntax) of everything BasicTokenizer._clean_text drops, taken from Python's Unicode
+  tables. The Rust BertNormalizer keeps unassigned code points, which BasicTokenizer drops as category "Cn".
+  Built once per process (~0.5s).
+  """
+  flags = _bmp_char_tables().flags
+  ranges = []
+  start = None
+  for cp in range(0x110001):
+    if cp < _BMP_SIZE:
+      drop = flags[cp] & _CHAR_DROP
+    else:
+      drop = cp < 0x110000 and unicodedata.category(chr(cp))[0] == "C"
+    if drop and start is None:
+      start = cp
+    elif not drop and start is not None:
+      ranges.append("\\x{%X}-\\x{%X}" % (start, cp - 1))
+      start = None
+  return "[" + "".join(ranges) + "]"
+
+
+class BertTokenizerFast(PreTrainedTokenizerBase):
+  """
+  BertTokenizer backed by the Rust ``tokenizers`` library, built locally from the same ``vocab.txt``: BERT
+  normalization and pre-tokenization, the WordPiece model and [CLS]/[SEP] post-processing. Gives the same ids as
+  BertTokenizer, encodes batches on all cores and returns offsets and word ids (``return_offsets_mapping``,
+  :meth:`BatchEncoding.word_ids`, ...).
+
+  With ``return_overflowing_tokens=True``, pairs are truncated by the Rust library: longest_first may keep one token
+  more of the first sequence than BertTokenizer, and only_first/only_second raise when the sequence to truncate is
+  too short instead of leaving it untruncated.
+  """
+
+  vocab_files_names = VOCAB_FILES_NAMES
+  pretrained_vocab_files_map = PRETRAINED_VOCAB_FILES_MAP
+  pretrained_init_configuration = PRETRAINED_INIT_CONFIGURATION
+  max_model_input_sizes = PRETRAINED_POSITIONAL_EMBEDDINGS_SIZES
+
+  def __init__(
+    self,
+    vocab_file,
+    do_lower_case=True,
+    unk_token="[UNK]",
+    sep_token="[SEP]",
+    pad_token="[PAD]",
+    cls_token="[CLS]",
+    mask_token="[MASK]",
+    tokenize_chinese_chars=True,
+    strip_accents=None,
+    **kwargs
+  ):
+    from tokenizers import Regex, Tokenizer, decoders, normalizers, pre_tokenizers, processors
+    from tokenizers.models import WordPiece
+
+    # Options of the slow tokenizer that have no counterpart here.
+    for key in ("__slow_tokenizer", "do_basic_tokenize", "never_split", "wordpiece_engine", "wordpiece_cache_size"):
+      kwargs.pop(key, None)
+    super().__init__(
+      do_lower_case=do_lower_case,
+      unk_token=unk_token,
+      sep_token=sep_token,
+      pad_token=pad_token,
+      cls_token=cls_token,
+      mask_token=mask_token,
+      tokenize_chinese_chars=tokenize_chinese_chars,
+      strip_accents=strip_accents,
+      **kwargs,
+    )
+    self.do_lower_case = do_lower_case
+    self._tokenizer = Tokenizer(WordPiece(vocab=load_vocab(vocab_file), unk_token=str(unk_token)))
+    self._tokenizer.normalizer = normalizers.Sequence(
+      [
+        normalizers.Replace(Regex(_dropped_chars_regex()), ""),
+        normalizers.BertNormalizer(
+          clean_text=True,
+          handle_chinese_chars=tokenize_chinese_chars,
+          strip_accents=strip_accents,
+          lowercase=do_lower_case,
+        ),
+      ]
+    )
+    self._tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    self._tokenizer.post_processor = processors.BertProcessing(
+      (str(sep_token), self._tokenizer.token_to_id(str(sep_token))),
+      (str(cls_token), self._tokenizer.token_to_id(str(cls_token))),
+    )
+    self._tokenizer.decoder = decoders.WordPiece(prefix="##")
+    # Special tokens in the text are never split (as after sanitize_special_tokens in from_pretrained).
+    self._tokenizer.add_special_tokens(self.all_special_tokens)
+
+  @property
+  def is_fast(self) -> bool:
+    return True
+
+  @property
+  def backend_tokenizer(self):
+    """:obj:`tokenizers.Tokenizer`: The Rust tokenizer."""
+    return self._tokenizer
+
+  @property
+  def vocab_size(self) -> int:
+    return self._tokenizer.get_vocab_size(with_added_tokens=False)
+
+  def get_vocab(self) -> Dict[str, int]:
+    return self._tokenizer.get_vocab(with_added_tokens=True)
+
+  def __len__(self) -> int:
+    return self._tokenizer.get_vocab_size(with_added_tokens=True)
+
+  def _add_tokens(self, new_tokens: Union[List[str], List[AddedToken]], special_tokens: bool = False) -> int:
+    if special_tokens:
+      return self._tokenizer.add_special_tokens(new_tokens)
+    return self._tokenizer.add_tokens(new_tokens)
+
+  def num_special_tokens_to_add(self, pair: bool = False) -> int:
+    return self._tokenizer.num_special_tokens_to_add(pair)
+
+  def convert_tokens_to_ids(self, tokens: Union[str, List[str]]) -> Union[int, List[int]]:
+    if tokens is None:
+      return None
+    if isinstance(tokens, str):
+      return self._convert_token_to_id(tokens)
+    return [self._convert_token_to_id(token) for token in tokens]
+
+  def _convert_token_to_id(self, token: str) -> int:
+    index = self._tokenizer.token_to_id(token)
+    return self._tokenizer.token_to_id(self.unk_token) if index is None else index
+
+  def convert_ids_to_tokens(
+    self, ids: Union[int, List[int]], skip_special_tokens: bool = False
+  ) -> Union[str, List[str]]:
+    if isinstance(ids, int):
+      return self._tokenizer.id_to_token(ids)
+    all_special_ids = set(self.all_special_ids)
+    return [self._tokenizer.id_to_token(index) for index in ids if not (skip_special_tokens and index in all_special_ids)]
+
+  def tokenize(self, text: str, pair: Optional[str] = None, add_special_tokens: bool = False, **kwargs) -> List[str]:
+    return self._tokenizer.encode(text, pair, add_special_tokens=add_special_tokens).tokens
+
+  def convert_tokens_to_string(self, tokens: List[str]) -> str:
+    return self._tokenizer.decoder.decode(tokens)
+
+  def build_inputs_with_special_tokens(
+    self, token_ids_0: List[int], token_ids_1: Optional[List[int]] = None
+  ) -> List[int]:
+    if token_ids_1 is None:
+      return [self.cls_token_id] + token_ids_0 + [self.sep_token_id]
+    return [self.cls_token_id] + token_ids_0 + [self.sep_token_id] + token_ids_1 + [self.sep_token_id]
+
+  def create_token_type_ids_from_sequences(
+    self, token_ids_0: List[int], token_ids_1: Optional[List[int]] = None
+  ) -> List[int]:
+    if token_ids_1 is None:
+      return (len(token_ids_0) + 2) * [0]
+    return (len(token_ids_0) + 2) * [0] + (len(token_ids_1) + 1) * [1]
+
+  def _set_truncation_and_padding(
+    self,
+    padding_strategy: PaddingStrategy,
+    truncation_strategy: TruncationStrategy,
+    max_length: int,
+    stride: int,
+    pad_to_multiple_of: Optional[int],
+  ):
+    if truncation_strategy == TruncationStrategy.DO_NOT_TRUNCATE:
+      self._tokenizer.no_truncation()
+    else:
+      self._tokenizer.enable_truncation(max_length, stride=stride, strategy=truncation_strategy.value)
+
+    if padding_strategy == PaddingStrategy.DO_NOT_PAD:
+      self._tokenizer.no_padding()
+    else:
+      self._tokenizer.enable_padding(
+        length=max_length if padding_strategy == PaddingStrategy.MAX_LENGTH else None,
+        direction=self.padding_side,
+        pad_id=self.pad_token_id,
+        pad_type_id=self.pad_token_type_id,
+        pad_token=self.pad_token,
+        pad_to_multiple_of=pad_to_multiple_of,
+      )
+
+  def _convert_encoding(
+    self,
+    encoding: EncodingFast,
+    add_special_tokens: bool = True,
+    return_token_type_ids: Optional[bool] = None,
+    return_attention_mask: Optional[bool] = None,
+    return_overflowing_tokens: bool = False,
+    return_special_tokens_mask: bool = False,
+    return_offsets_mapping: bool = False,
+    return_length: bool = False,
+  ) -> Tuple[Dict[str, List[Any]], List[EncodingFast]]:
+    if return_token_type_ids is None:
+      return_token_type_ids = "token_type_ids" in self.model_input_names
+    if return_attention_mask is None:
+      return_attention_mask = "attention_mask" in self.model_input_names
+
+    encodings = [encoding] + encoding.overflowing if return_overflowing_tokens else [encoding]
+    encoding_dict = collections.defaultdict(list)
+    for e in encodings:
+      encoding_dict["input_ids"].append(e.ids)
+      if return_token_type_ids:
+        # Like the slow tokenizer, pairs without special tokens are a single segment; the Rust post-processor
+        # still gives the second sequence type id 1.
+        encoding_dict["token_type_ids"].append(e.type_ids if add_special_tokens else [0] * len(e.ids))
+      if return_attention_mask:
+        encoding_dict["attention_mask"].append(e.attention_mask)
+      if return_special_tokens_mask:
+        encoding_dict["special_tokens_mask"].append(e.special_tokens_mask)
+      if return_offsets_mapping:
+        encoding_dict["offset_mapping"].append(e.offsets)
+      if return_length:
+        encoding_dict["length"].append(len(e.ids))
+    return encoding_dict, encodings
+
+  def _batch_encode_plus(
+    self,
+    batch_text_or_text_pairs: Union[
+      List[TextInput],
+      List[TextInputPair],
+      List[PreTokenizedInput],
+      List[PreTokenizedInputPair],
+    ],
+    add_special_tokens: bool = True,
+    padding_strategy: PaddingStrategy = PaddingStrategy.DO_NOT_PAD,
+    truncation_strategy: TruncationStrategy = TruncationStrategy.DO_NOT_TRUNCATE,
+    max_length: Optional[int] = None,
+    stride: int = 0,
+    is_split_into_words: bool = False,
+    pad_to_multiple_of: Optional[int] = None,
+    return_tensors: Optional[Union[str, TensorType]] = None,
+    return_token_type_ids: Optional[bool] = None,
+    return_attention_mask: Optional[bool] = None,
+    return_overflowing_tokens: bool = False,
+    return_special_tokens_mask: bool = False,
+    return_offsets_mapping: bool = False,
+    return_length: bool = False,
+    verbose: bool = True,
+    num_proc: Optional[int] = None,
+    **kwargs
+  ) -> BatchEncoding:
+    # num_proc is not needed: encode_batch already spreads the batch over all cores.
+    batch_text_or_text_pairs = [
+      tuple(x) if isinstance(x, list) and not is_split_into_words else x for x in batch_text_or_text_pairs
+    ]
+    is_pair = bool(batch_text_or_text_pairs) and (
+      isinstance(batch_text_or_text_pairs[0], tuple)
+      if not is_split_into_words
+      else isinstance(batch_text_or_text_pairs[0][0], (list, tuple))
+    )
+    if (
+      is_pair
+      and truncation_strategy != TruncationStrategy.DO_NOT_TRUNCATE
+      and max_length is not None
+      and not return_overflowing_tokens
+    ):
+      encodings = self._encode_pairs(
+        batch_text_or_text_pairs, add_special_tokens, padding_strategy, truncation_strategy, max_length,
+        is_split_into_words, pad_to_multiple_of,
+      )
+    else:
+      self._set_truncation_and_padding(padding_strategy, truncation_strategy, max_length, stride, pad_to_multiple_of)
+      encodings = self._tokenizer.encode_batch(
+        batch_text_or_text_pairs, add_special_tokens=add_special_tokens, is_pretokenized=is_split_into_words
+      )
+
+    # One dict of lists and one list of encodings per example; with overflowing tokens an example can have several.
+    tokens_and_encodings = [
+      self._convert_encoding(
+        encoding,
+        add_special_tokens=add_special_tokens,
+        return_token_type_ids=return_token_type_ids,
+        return_attention_mask=return_attention_mask,
+        return_overflowing_tokens=return_overflowing_tokens,
+        return_special_tokens_mask=return_special_tokens_mask,
+        return_offsets_mapping=return_offsets_mapping,
+        return_length=return_length,
+      )
+      for encoding in encodings
+    ]
+    sanitized_tokens = {}
+    if tokens_and_encodings:
+      for key in tokens_and_encodings[0][0].keys():
+        sanitized_tokens[key] = [e for item, _ in tokens_and_encodings for e in item[key]]
+    sanitized_encodings = [e for _, item in tokens_and_encodings for e in item]
+    if return_overflowing_tokens:
+      sanitized_tokens["overflow_to_sample_mapping"] = [
+        i for i, (item, _) in enumerate(tokens_and_encodings) for _ in item["input_ids"]
+      ]
+    for input_ids in sanitized_tokens.get("input_ids", []):
+      self._eventual_warn_about_too_long_sequence(input_ids, max_length, verbose)
+    return BatchEncoding(sanitized_tokens, sanitized_encodings, tensor_type=return_tensors)
+
+  def _encode_pairs(
+    self, pairs, add_special_tokens, padding_strategy, truncation_strategy, max_length, is_split_into_words,
+    pad_to_multiple_of,
+  ) -> List[EncodingFast]:
+    """
+    Pairs truncated like PreTrainedTokenizer.truncate_sequences: with longest_first, one token at a time from the
+    longer sequence, from the second one on ties (the Rust truncation takes the odd token from the first sequence
+    instead); with only_first/only_second, a sequence too short to truncate is left untruncated (the Rust
+    truncation raises and fails the whole batch).
+    """
+    self._tokenizer.no_truncation()
+    self._tokenizer.no_padding()
+    firsts = self._tokenizer.encode_batch([a for a, _ in pairs], add_special_tokens=False, is_pretokenized=is_split_into_words)
+    seconds = self._tokenizer.encode_batch([b for _, b in pairs], add_special_tokens=False, is_pretokenized=is_split_into_words)
+    num_special_tokens = self.num_special_tokens_to_add(pair=True) if add_special_tokens else 0
+    encodings = []
+    for first, second in zip(firsts, seconds):
+      length, pair_length = len(first.ids), len(second.ids)
+      to_remove = length + pair_length + num_special_tokens - max_length
+      if to_remove <= 0:
+        pass
+      elif truncation_strategy == TruncationStrategy.ONLY_FIRST:
+        if length > to_remove:
+          first.truncate(length - to_remove)
+      elif truncation_strategy == TruncationStrategy.ONLY_SECOND:
+        if pair_length > to_remove:
+          second.truncate(pair_length - to_remove)
+      else:
+        difference = min(to_remove, abs(length - pair_length))
+        if length > pair_length:
+          length -= difference
+        else:
+          pair_length -= difference
+        to_remove -= difference
+        length -= to_remove // 2
+        pair_length -= to_remove - to_remove // 2
+        first.truncate(length)
+        second.truncate(pair_length)
+      encodings.append(self._tokenizer.post_process(first, second, add_special_tokens=add_special_tokens))
+
+    if padding_strategy != PaddingStrategy.DO_NOT_PAD and encodings:
+      padded_length = max_length
+      if padding_strategy == PaddingStrategy.LONGEST:
+        padded_length = max(len(encoding.ids) for encoding in encodings)
+      if pad_to_multiple_of is not None and padded_length % pad_to_multiple_of != 0:
+        padded_length = ((padded_length // pad_to_multiple_of) + 1) * pad_to_multiple_of
+      for encoding in encodings:
+        encoding.pad(
+          padded_length,
+          direction=self.padding_side,
+          pad_id=self.pad_token_id,
+          pad_type_id=self.pad_token_type_id,
+          pad_token=self.pad_token,
+        )
+    return encodings
+
+  def _encode_plus(
+    self,
+    text: Union[TextInput, PreTokenizedInput],
+    text_pair: Optional[Union[TextInput, PreTokenizedInput]] = None,
+    add_special_tokens: bool = True,
+    padding_strategy: PaddingStrategy = PaddingStrategy.DO_NOT_PAD,
+    truncation_strategy: TruncationStrategy = TruncationStrategy.DO_NOT_TRUNCATE,
+    max_length: Optional[int] = None,
+    stride: int = 0,
+    is_split_into_words: bool = False,
+    pad_to_multiple_of: Optional[int] = None,
+    return_tensors: Optional[bool] = None,
+    return_token_type_ids: Optional[bool] = None,
+    return_attention_mask: Optional[bool] = None,
+    return_overflowing_tokens: bool = False,
+    return_special_tokens_mask: bool = False,
+    return_offsets_mapping: bool = False,
+    return_length: bool = False,
+    verbose: bool = True,
+    **kwargs
+  ) -> BatchEncoding:
+    batched_input = [(text, text_pair)] if text_pair is not None else [text]
+    batched_output = self._batch_encode_plus(
+      batched_input,
+      is_split_into_words=is_split_into_words,
+      add_special_tokens=add_special_tokens,
+      padding_strategy=padding_strategy,
+      truncation_strategy=truncation_strategy,
+      max_length=max_length,
+      stride=stride,
+      pad_to_multiple_of=pad_to_multiple_of,
+      return_tensors=return_tensors,
+      return_token_type_ids=return_token_type_ids,
+      return_attention_mask=return_attention_mask,
+      return_overflowing_tokens=return_overflowing_tokens,
+      return_special_tokens_mask=return_special_tokens_mask,
+      return_offsets_mapping=return_offsets_mapping,
+      return_length=return_length,
+      verbose=verbose,
+      **kwargs,
+    )
+
+    # Without tensors or overflowing tokens, a single example is returned without the batch axis.
+    if return_tensors is None and not return_overflowing_tokens:
+      batched_output = BatchEncoding(
+        {
+          key: (value[0] if len(value) > 0 and isinstance(value[0], list) else value)
+          for key, value in batched_output.items()
+        },
+        batched_output.encodings,
+      )
+    return batched_output
+
+  def _decode(
+    self,
+    token_ids: Union[int, List[int]],
+    skip_special_tokens: bool = False,
+    clean_up_tokenization_spaces: bool = True,
+    **kwargs
+  ) -> str:
+    if isinstance(token_ids, int):
+      token_ids = [token_ids]
+    text = self._tokenizer.decode(token_ids, skip_special_tokens=skip_special_tokens)
+    return self.clean_up_tokenization(text) if clean_up_tokenization_spaces else text
+
+  def save_vocabulary(self, save_directory: str, filename_prefix: Optional[str] = None) -> Tuple[str]:
+    if os.path.isdir(save_directory):
+      vocab_file = os.path.join(
+        save_directory, (filename_prefix + "-" if filename_prefix else "") + VOCAB_FILES_NAMES["vocab_file"]
+      )
+    else:
+      vocab_file = (filename_prefix + "-" if filename_prefix else "") + save_directory
+    vocab = self._tokenizer.get_vocab(with_added_tokens=False)
+    with open(vocab_file, "w", encoding="utf-8") as writer:
+      for token, _ in sorted(vocab.items(), key=lambda kv: kv[1]):
+        writer.write(token + "\n")
+    return (vocab_file,)
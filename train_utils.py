@@ -0,0 +1,53 @@
+'''
+Training helpers shared by classifier.py and multitask_classifier.py: mixed precision and the command
+line options of the model and the optimizer.
+'''
+
+import argparse
+import contextlib
+
+import torch
+
+from datasets import data_arguments_parser
+
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast_context(precision, device):
+    '''Mixed-precision autocast for --precision; the parameters (AdamW's master weights) stay in fp32.'''
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=PRECISIONS[precision])
+
+
+def training_arguments_parser():
+    '''
+    Command line options shared by classifier.py and multitask_classifier.py (including the data loading
+    ones of datasets.data_arguments_parser), to be passed as ArgumentParser(parents=[training_arguments_parser()]).
+    '''
+    parser = argparse.ArgumentParser(add_help=False, parents=[data_arguments_parser()])
+    parser.add_argument("--precision", type=str, choices=tuple(PRECISIONS.keys()), default='fp32',
+                        help='fp32, or bf16/fp16 autocast for forward passes and losses (fp16 also scales the loss)')
+    parser.add_argument("--attention_backend", type=str,
+                        help='reference: the original attention implementation; sdpa: torch scaled_dot_product_attention',
+                        choices=('reference', 'sdpa'), default="reference")
+    parser.add_argument("--unpadded", action='store_true',
+                        help='run the dense/LayerNorm/feed forward parts of BERT on non-padding tokens only')
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help='recompute the activations of every k-th BERT layer during backward to save memory '
+                             '(1: every layer, 0: none)')
+    parser.add_argument("--adamw_impl", type=str, choices=('loop', 'foreach', 'flat'), default='loop',
+                        help='loop: update the parameters one by one; foreach: batched in-place torch._foreach_* update; '
+                             'flat: parameters, gradients and moments in contiguous buffers (see optimizer.FlatBuffers)')
+    parser.add_argument("--adamw_state_dtype", type=str, choices=('float32', 'bfloat16', 'int8'), default='float32',
+                        help='storage of the AdamW moments: float32, bfloat16 or blockwise-quantized 8 bits (loop only)')
+    parser.add_argument("--embedding_cache_dir", type=str, default=None,
+                        help="option 'pretrain' only: directory of cached BERT outputs (see embedding_cache.py); disabled if not set")
+    parser.add_argument("--embedding_cache_dtype", type=str, choices=('float16', 'float32'), default='float16')
+    return parser
+
+
+def training_options(args):
+    '''The values in `args` of every option of training_arguments_parser, e.g. to copy them into a SimpleNamespace.'''
+    return {name: getattr(args, name) for name in vars(training_arguments_parser().parse_args([]))}